@@ -0,0 +1,153 @@
+'''Benchmark ArcGIS REST layer downloads (`fetchers.fetch_arcgis_layer`)
+against a local mock server with per-request latency: one page at a time
+(like EsriDumper), concurrent pages, and an incremental refresh after a few
+edits. Checks that the incremental refresh matches a full download.
+
+    python -m benchmarks.bench_arcgis -n 50000 --latency 0.2
+
+'''
+import argparse
+from datetime import datetime, timezone
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import datahelpers as dh
+
+
+class MockLayer(http.server.BaseHTTPRequestHandler):
+    # A layer with editor tracking, served like an ArcGIS MapServer layer
+    features = {}
+    latency = 0.0
+    max_record_count = 1000
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, data):
+        time.sleep(self.latency)
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply({
+            'objectIdField': 'OBJECTID',
+            'maxRecordCount': self.max_record_count,
+            'editFieldsInfo': {'editDateField': 'EDITDATE'},
+        })
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        query = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        features = self.features
+
+        if 'outStatistics' in query:
+            last_edit = max(f['attributes']['EDITDATE']
+                            for f in features.values())
+            self.reply({'features': [{'attributes': {'last_edit': last_edit}}]})
+        elif query.get('returnIdsOnly') == 'true':
+            oids = list(features)
+            if 'timestamp' in query['where']:
+                since = query['where'].split("timestamp '")[1].rstrip("'")
+                since = datetime.strptime(since, '%Y-%m-%d %H:%M:%S')
+                since = since.replace(tzinfo=timezone.utc).timestamp() * 1000
+                oids = [oid for oid in oids
+                        if features[oid]['attributes']['EDITDATE'] >= since]
+            self.reply({'objectIdFieldName': 'OBJECTID', 'objectIds': oids})
+        else:
+            oids = [int(oid) for oid in query['objectIds'].split(',')]
+            self.reply({'features': [features[oid] for oid in oids
+                                     if oid in features]})
+
+
+def make_features(n):
+    # Sidewalk-like lines, last edited about a year before the benchmark
+    edited = 1577836800000
+    return {
+        oid: {
+            'attributes': {'OBJECTID': oid, 'WIDTH': oid % 12,
+                           'EDITDATE': edited + oid},
+            'geometry': {'paths': [[[-122.3 + oid * 1e-6, 47.6],
+                                    [-122.3 + oid * 1e-6, 47.6001]]]},
+        }
+        for oid in range(1, n + 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=50000,
+                        help='Number of features in the layer.')
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='Seconds of latency per request.')
+    parser.add_argument('--edits', type=int, default=20,
+                        help='Number of features edited before the refresh.')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    MockLayer.features = make_features(args.n)
+    MockLayer.latency = args.latency
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MockLayer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/MapServer/2'.format(server.server_address[1])
+
+    tempdir = tempfile.mkdtemp()
+    cache = dh.fetchers.DownloadCache(os.path.join(tempdir, 'cache'),
+                                      offline=False)
+    path = os.path.join(tempdir, 'layer.geojson')
+
+    start = time.perf_counter()
+    dh.fetchers.fetch_arcgis_layer(url, path, incremental=False,
+                                   max_workers=1, cache=cache)
+    t_sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dh.fetchers.fetch_arcgis_layer(url, path, incremental=False,
+                                   max_workers=args.workers, cache=cache)
+    t_concurrent = time.perf_counter() - start
+
+    # Edit a few features, then refresh
+    now = int(time.time() * 1000)
+    step = max(args.n // args.edits, 1)
+    for oid in range(1, args.n + 1, step):
+        MockLayer.features[oid]['attributes'].update(WIDTH=-1, EDITDATE=now)
+
+    start = time.perf_counter()
+    dh.fetchers.fetch_arcgis_layer(url, path, max_workers=args.workers,
+                                   cache=cache)
+    t_incremental = time.perf_counter() - start
+
+    full_path = os.path.join(tempdir, 'full.geojson')
+    dh.fetchers.fetch_arcgis_layer(url, full_path, incremental=False,
+                                   max_workers=args.workers, cache=cache)
+    with open(path) as f:
+        incremental = json.load(f)['features']
+    with open(full_path) as f:
+        full = json.load(f)['features']
+
+    def by_oid(features):
+        return sorted(features, key=lambda f: f['properties']['OBJECTID'])
+
+    print('features:    {}'.format(args.n))
+    print('sequential:  {:.2f} s'.format(t_sequential))
+    print('concurrent:  {:.2f} s'.format(t_concurrent))
+    print('incremental: {:.2f} s'.format(t_incremental))
+    print('speedup:     {:.1f}x (concurrent), {:.1f}x (incremental)'.format(
+        t_sequential / t_concurrent, t_sequential / t_incremental))
+    print('match:       {}'.format(by_oid(incremental) == by_oid(full)))
+
+    server.shutdown()
+    shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+'''Exercise the download cache (`fetchers.DownloadCache`) against a local
+stand-in for a data portal: a cold download, a revalidation (ETag / 304), a
+download resumed after the connection drops (Range / If-Range), a change on
+the server, offline mode, and several processes fetching the same URL into
+one cache at once. Checks that every fetch returns the server's content and
+reports the bytes served for each step.
+
+    python -m benchmarks.bench_download_cache --size 64 --processes 4
+
+'''
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import datahelpers as dh
+
+
+class MockFile(http.server.BaseHTTPRequestHandler):
+    # A single file with an ETag and Last-Modified date, which supports
+    # conditional and range requests. If `drop_after` is set, the next
+    # response is cut off after that many bytes.
+    content = b''
+    etag = ''
+    last_modified = ''
+    drop_after = None
+    served = 0
+    latency = 0.0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        cls = type(self)
+        content = cls.content
+        validators = (cls.etag, cls.last_modified)
+
+        if self.headers.get('If-None-Match') == cls.etag or \
+           self.headers.get('If-Modified-Since') == cls.last_modified:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range') in validators:
+            start = int(byte_range.split('=')[1].rstrip('-'))
+            if start >= len(content):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', cls.etag)
+        self.send_header('Last-Modified', cls.last_modified)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+
+        body = content[start:]
+        with cls.lock:
+            drop_after = cls.drop_after
+            cls.drop_after = None
+        if drop_after is not None:
+            body = body[:drop_after]
+        self.wfile.write(body)
+        with cls.lock:
+            cls.served += len(body)
+        if drop_after is not None:
+            self.close_connection = True
+
+
+def publish(size, version):
+    # A new version of the file on the server
+    MockFile.content = os.urandom(size)
+    MockFile.etag = '"{}"'.format(version)
+    MockFile.last_modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                                           time.gmtime(1577836800 + version))
+
+
+def sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def fetch(root, url):
+    cache = dh.fetchers.DownloadCache(root, offline=False)
+    return sha256(cache.fetch(url))
+
+
+def step(name, func, expected):
+    served = MockFile.served
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print('{:<12} {:.3f} s, {:>10} bytes served, correct: {}'.format(
+        name, elapsed, MockFile.served - served, result == expected))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=64,
+                        help='Size of the file, in MiB.')
+    parser.add_argument('--processes', type=int, default=4,
+                        help='Number of processes fetching at once.')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds of latency per request.')
+    args = parser.parse_args()
+
+    size = args.size * 2**20
+    publish(size, 1)
+    MockFile.latency = args.latency
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MockFile)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/data.zip'.format(server.server_address[1])
+
+    tempdir = tempfile.mkdtemp()
+    root = os.path.join(tempdir, 'cache')
+    cache = dh.fetchers.DownloadCache(root, offline=False)
+
+    def expected():
+        return hashlib.sha256(MockFile.content).hexdigest()
+
+    step('cold', lambda: sha256(cache.fetch(url)), expected())
+    step('revalidate', lambda: sha256(cache.fetch(url)), expected())
+
+    # The connection drops half way through a new version of the file
+    publish(size, 2)
+    MockFile.drop_after = size // 2
+    try:
+        cache.fetch(url)
+    except Exception:
+        pass
+    step('resume', lambda: sha256(cache.fetch(url)), expected())
+
+    offline = dh.fetchers.DownloadCache(root, offline=True)
+    step('offline', lambda: sha256(offline.fetch(url)), expected())
+    try:
+        offline.fetch(url + '?missing')
+        print('offline miss: not raised')
+    except dh.fetchers.CacheMiss:
+        print('offline miss: raised CacheMiss')
+
+    # Processes sharing a fresh cache, with a partial download to resume
+    publish(size, 3)
+    shared = os.path.join(tempdir, 'shared')
+    MockFile.drop_after = size // 4
+    try:
+        dh.fetchers.DownloadCache(shared, offline=False).fetch(url)
+    except Exception:
+        pass
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        step('processes', lambda: set(executor.map(
+            fetch, [shared] * args.processes, [url] * args.processes
+        )), {expected()})
+
+    server.shutdown()
+    shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+'''Benchmark incremental rebuilds (`tiling.TileStore`) of the crossings,
+inclines and network stages on a synthetic street grid: a full rebuild after
+editing 1% of the sidewalks in one area (and deleting a few) against an incremental
+rebuild that only reprocesses the tiles the edits touch. Checks that both
+give identical results.
+
+    python -m benchmarks.bench_incremental -n 120 --edit 0.01
+
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+from shapely.affinity import translate
+
+import datahelpers as dh
+
+from .bench_tiling import UTM, synthetic_layers
+
+
+def surface_for(streets, seed=0):
+    # Elevations at the street ends
+    rng = np.random.RandomState(seed)
+    coords, offsets = dh.geometry.coordinate_arrays(streets.geometry)
+    xy = np.unique(coords[offsets[:-1]], axis=0)
+    elevations = 50 + 0.05 * xy[:, 0] + rng.normal(scale=2, size=len(xy))
+    return dh.elevation_surface.ElevationSurface(xy, elevations)
+
+
+def build(sidewalks, streets, surface, root=None,
+          tile_size=dh.tiling.TILE_SIZE):
+    stores = {}
+    for stage in ('crossings', 'inclines', 'network'):
+        stores[stage] = None
+        if root is not None:
+            stores[stage] = dh.tiling.TileStore(os.path.join(root, stage))
+
+    crossings = dh.crossings.draw_crossings(
+        sidewalks, streets, tile_size=tile_size, store=stores['crossings']
+    )
+    sidewalks = sidewalks.copy()
+    sidewalks['incline'] = dh.elevation_surface.endpoint_inclines(
+        sidewalks.geometry, surface, tile_size=tile_size,
+        store=stores['inclines']
+    )
+    network = dh.ped_network.network_sidewalks(
+        sidewalks, [crossings], tile_size=tile_size, store=stores['network']
+    )
+    return crossings, network, stores
+
+
+def edit(sidewalks, fraction, scattered=False, seed=1):
+    # Move a fraction of the sidewalks by up to a meter and drop a few. Edits
+    # are to the sidewalks nearest a random point (as with a neighbourhood
+    # being resurveyed), or to random sidewalks if scattered.
+    rng = np.random.RandomState(seed)
+    sidewalks = sidewalks.copy()
+    n = max(int(fraction * sidewalks.shape[0]), 1)
+    if scattered:
+        moved = rng.choice(sidewalks.shape[0], n, replace=False)
+    else:
+        bounds = sidewalks.geometry.bounds.values
+        centers = (bounds[:, :2] + bounds[:, 2:]) / 2
+        center = centers[rng.randint(centers.shape[0])]
+        moved = np.argsort(((centers - center)**2).sum(axis=1))[:n]
+    geometry = list(sidewalks.geometry)
+    for i in moved:
+        geometry[i] = translate(geometry[i], *rng.uniform(-1, 1, size=2))
+    sidewalks['geometry'] = gpd.GeoSeries(geometry, index=sidewalks.index,
+                                          crs=UTM)
+    dropped = rng.choice(moved, max(n // 10, 1), replace=False)
+    return sidewalks.drop(sidewalks.index[dropped]).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=120,
+                        help='Number of intersections along each side of '
+                             'the grid.')
+    parser.add_argument('--edit', type=float, default=0.01,
+                        help='Fraction of sidewalks to edit.')
+    parser.add_argument('--scattered', action='store_true',
+                        help='Edit random sidewalks, rather than those in '
+                             'one area.')
+    parser.add_argument('--tile-size', type=float,
+                        default=dh.tiling.TILE_SIZE)
+    args = parser.parse_args()
+
+    sidewalks, streets = synthetic_layers(args.n)
+    surface = surface_for(streets)
+    root = tempfile.mkdtemp()
+
+    start = time.perf_counter()
+    build(sidewalks, streets, surface, root=root, tile_size=args.tile_size)
+    t_cold = time.perf_counter() - start
+
+    edited = edit(sidewalks, args.edit, scattered=args.scattered)
+
+    start = time.perf_counter()
+    full_crossings, full_network, _ = build(edited, streets, surface)
+    t_full = time.perf_counter() - start
+
+    start = time.perf_counter()
+    crossings, network, stores = build(edited, streets, surface, root=root,
+                                       tile_size=args.tile_size)
+    t_incremental = time.perf_counter() - start
+
+    print('streets:      {}'.format(streets.shape[0]))
+    print('sidewalks:    {} ({} edited)'.format(
+        sidewalks.shape[0], max(int(args.edit * sidewalks.shape[0]), 1)))
+    print('cold build:   {:.2f} s'.format(t_cold))
+    print('full:         {:.2f} s'.format(t_full))
+    print('incremental:  {:.2f} s ({:.1f}x)'.format(
+        t_incremental, t_full / t_incremental))
+    for stage, store in stores.items():
+        print('{:13} {} / {} tiles reprocessed'.format(
+            stage + ':', store.misses, store.hits + store.misses))
+    print('identical:    {}'.format(full_crossings.equals(crossings) and
+                                    full_network.equals(network)))
+
+    shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
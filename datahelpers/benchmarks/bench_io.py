@@ -0,0 +1,120 @@
+'''Benchmark the streaming GeoJSON writer against the previous per-row
+`gdf.apply` implementation, and check that both write identical bytes. Also
+checks that a layer with columns of mixed numbers, like a layer
+concatenated with its overrides, can be written to and read back from the
+binary format, and that a column of numbers and text is refused.
+
+    python -m benchmarks.bench_io -n 500000
+
+'''
+import argparse
+import filecmp
+import json
+import os
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import LineString, mapping
+
+import datahelpers as dh
+
+
+def gdf_to_geojson_apply(gdf, path):
+    # The original implementation of datahelpers.io.gdf_to_geojson
+    def row_to_feature(row):
+        properties = row.loc[~row.isna()].to_dict()
+        properties.pop('geometry')
+        return {
+            'type': 'Feature',
+            'geometry': mapping(row['geometry']),
+            'properties': properties
+        }
+
+    fc = {
+        'type': 'FeatureCollection',
+        'features': list(gdf.apply(row_to_feature, axis=1))
+    }
+
+    with open(path, 'w') as f:
+        json.dump(fc, f)
+
+
+def random_layer(n, seed=0):
+    rng = np.random.RandomState(seed)
+    starts = rng.uniform(-122.4, -122.2, size=(n, 2))
+    starts[:, 1] = rng.uniform(47.5, 47.7, size=n)
+    ends = starts + rng.normal(scale=1e-3, size=(n, 2))
+    width = rng.uniform(1, 3, size=n).round(2)
+    # Some missing values, as is typical of the SDOT layers
+    width[rng.uniform(size=n) < 0.1] = np.nan
+    return gpd.GeoDataFrame({
+        'pkey': np.arange(n),
+        'width': width,
+        'surface': rng.choice(['asphalt', 'concrete', None], size=n),
+        'geometry': [LineString([s, e]) for s, e in zip(starts, ends)]
+    })
+
+
+def mixed_layer(gdf, surface):
+    # Overrides with integer widths read from JSON, concatenated to the layer
+    # as override_sidewalks does
+    overrides = gdf.iloc[:10].copy()
+    overrides['width'] = pd.Series([2] * 10, index=overrides.index,
+                                   dtype=object)
+    overrides['surface'] = surface
+    return pd.concat([gdf, overrides], ignore_index=True)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=500000,
+                        help='Number of features in the layer.')
+    args = parser.parse_args()
+
+    gdf = random_layer(args.n)
+
+    tempdir = tempfile.mkdtemp()
+    path_apply = os.path.join(tempdir, 'apply.geojson')
+    path_stream = os.path.join(tempdir, 'stream.geojson')
+
+    t_apply = timed(gdf_to_geojson_apply, gdf, path_apply)
+    t_stream = timed(dh.io.gdf_to_geojson, gdf, path_stream)
+
+    print('features:  {}'.format(args.n))
+    print('apply:     {:.2f} s'.format(t_apply))
+    print('streaming: {:.2f} s'.format(t_stream))
+    print('speedup:   {:.1f}x'.format(t_apply / t_stream))
+    print('identical: {}'.format(
+        filecmp.cmp(path_apply, path_stream, shallow=False)
+    ))
+
+    mixed = mixed_layer(gdf, 'concrete')
+    path_binary = os.path.join(tempdir, 'mixed.parquet')
+    dh.storage.write_layer(mixed, path_binary)
+    dh.storage.cache.clear()
+    read = dh.storage.read_layer(path_binary)
+    print('mixed:     {} of {} features read back'.format(read.shape[0],
+                                                         mixed.shape[0]))
+    try:
+        dh.storage.write_layer(mixed_layer(gdf, 1), path_binary)
+        print('text:      not refused')
+    except ValueError as e:
+        print('text:      refused ({})'.format(e))
+
+    os.remove(path_apply)
+    os.remove(path_stream)
+    os.remove(path_binary)
+    os.rmdir(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''Benchmark noding (`network.node_ends`) on a layer of random segments, and
+check that every crossing ends up as a node shared by the lines that cross,
+including crossings near the end of one of the lines:
+
+    python -m benchmarks.bench_network -n 400
+
+'''
+import argparse
+import time
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import LineString
+
+import datahelpers as dh
+
+
+UTM = 32610
+
+
+def random_segments(n, size=100.0, seed=0):
+    rng = np.random.RandomState(seed)
+    starts = rng.uniform(0, size, (n, 2))
+    ends = starts + rng.uniform(-10, 10, (n, 2))
+    return gpd.GeoDataFrame({
+        'geometry': [LineString([a, b]) for a, b in zip(starts, ends)]
+    }, crs=UTM)
+
+
+def near_end_crossing():
+    # The crossing is 5.02 m along the first line and 0.15 m from the end of
+    # the second: between one and two tolerances (0.1 m) from its end
+    return gpd.GeoDataFrame({
+        'geometry': [LineString([(0, 0), (8.42, 0)]),
+                     LineString([(5.02, -4.27), (5.02, 0.15)])]
+    }, crs=UTM)
+
+
+def unnoded_crossings(gdf, tolerance):
+    # Points where lines meet that aren't (within the tolerance) an end of
+    # both of them
+    lines = list(gdf.geometry)
+    i, j = dh.geometry.query_bulk(gdf.sindex, gdf.geometry)
+    pair = i < j
+    missed = 0
+    for a, b in zip(i[pair], j[pair]):
+        meeting = lines[a].intersection(lines[b])
+        if meeting.is_empty or meeting.geom_type not in ('Point',
+                                                         'MultiPoint'):
+            continue
+        parts = getattr(meeting, 'geoms', [meeting])
+        for part in parts:
+            ends = [lines[k].boundary for k in (a, b)]
+            if any(end.distance(part) > tolerance for end in ends):
+                missed += 1
+    return missed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=400,
+                        help='Number of random segments.')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    near_end = dh.network.node_ends(near_end_crossing(), args.tolerance)
+    segments = random_segments(args.n)
+
+    start = time.perf_counter()
+    network = dh.network.node_ends(segments, args.tolerance)
+    elapsed = time.perf_counter() - start
+
+    print('near-end crossing: {} lines, unnoded crossings: {}'.format(
+        near_end.shape[0], unnoded_crossings(near_end, args.tolerance)))
+    print('segments: {} -> {} lines in {:.2f} s, unnoded crossings: {}'.format(
+        segments.shape[0], network.shape[0], elapsed,
+        unnoded_crossings(network, args.tolerance)))
+
+
+if __name__ == '__main__':
+    main()
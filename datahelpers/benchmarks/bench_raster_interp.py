@@ -0,0 +1,83 @@
+'''Benchmark bulk DEM sampling (`raster_interp.sample`) against calling
+`raster_interp.interpolated_value` once per point, and check that both give
+the same values.
+
+    python -m benchmarks.bench_raster_interp -n 100000
+
+'''
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+
+import datahelpers as dh
+
+
+def write_dem(path, size=4096, seed=0):
+    # A smooth-ish, tiled + compressed float32 GeoTIFF, like the USGS DEMs
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0, 8 * np.pi, size)
+    surface = 100 * np.outer(np.sin(x), np.cos(x / 2)) + \
+        rng.normal(scale=0.5, size=(size, size))
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'width': size,
+        'height': size,
+        'count': 1,
+        'crs': 'EPSG:26910',
+        'transform': from_origin(500000, 5300000, 10, 10),
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'lzw',
+    }
+    with rio.open(path, 'w', **profile) as dst:
+        dst.write(surface.astype('float32'), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=100000,
+                        help='Number of points to sample.')
+    parser.add_argument('--method', default='bilinear',
+                        choices=['bilinear', 'spline'])
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'dem.tif')
+    write_dem(path)
+
+    with rio.open(path) as dem:
+        left, bottom, right, top = dem.bounds
+        rng = np.random.RandomState(1)
+        xs = rng.uniform(left + 50, right - 50, size=args.n)
+        ys = rng.uniform(bottom + 50, top - 50, size=args.n)
+
+        start = time.perf_counter()
+        expected = [
+            dh.raster_interp.interpolated_value(x, y, dem, method=args.method)
+            for x, y in zip(xs, ys)
+        ]
+        t_point = time.perf_counter() - start
+
+        start = time.perf_counter()
+        values = dh.raster_interp.sample(dem, xs, ys, method=args.method)
+        t_bulk = time.perf_counter() - start
+
+    print('points:    {}'.format(args.n))
+    print('per-point: {:.2f} s'.format(t_point))
+    print('bulk:      {:.2f} s'.format(t_bulk))
+    print('speedup:   {:.1f}x'.format(t_point / t_bulk))
+    print('max diff:  {:.2e}'.format(np.abs(values - expected).max()))
+
+    os.remove(path)
+    os.rmdir(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+'''Benchmark batch side-of-street classification (`street_side.street_sides`)
+against the per-row loop that the Seattle `infer_sidewalk_offsets` rule used,
+and check that both give the same sides.
+
+Runs on the SDOT sidewalk and street layers when given their paths (e.g. the
+cleaned layers in cities/seattle/interim/clean), otherwise on a synthetic
+layer of about the same size:
+
+    python -m benchmarks.bench_street_side \
+        --sidewalks ../cities/seattle/interim/clean/sidewalks.parquet \
+        --streets ../cities/seattle/interim/clean/streets.parquet
+
+'''
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import LineString
+
+import datahelpers as dh
+
+
+def segment_side_point(point, segment):
+    dsx = segment[1][0] - segment[0][0]
+    dsy = segment[1][1] - segment[0][1]
+    dpx = point.x - segment[0][0]
+    dpy = point.y - segment[0][1]
+    cross_product = dsx * dpy - dsy * dpx
+    if (cross_product) > 0:
+        return 'left'
+    else:
+        return 'right'
+
+
+def line_side_point(point, linestring):
+    # The original per-row implementation
+    distance_along = linestring.project(point)
+
+    coords = linestring.coords
+    last = coords[0]
+    point_dist = 0
+    for i, p in enumerate(coords[1:]):
+        point_dist += dh.geometry.point_distance(last, p)
+        if point_dist > distance_along:
+            return segment_side_point(point, [coords[i-1], coords[i]])
+        last = p
+
+    return segment_side_point(point, [coords[-2], coords[-1]])
+
+
+def per_row_sides(sidewalks, streets):
+    sides = []
+    for sidewalk, street in zip(sidewalks, streets):
+        if street is None or street.is_empty or sidewalk is None or \
+                sidewalk.is_empty:
+            sides.append('unknown')
+            continue
+        test_point = sidewalk.interpolate(0.5, normalized=True)
+        sides.append(line_side_point(test_point, street))
+    return np.array(sides, dtype=object)
+
+
+def synthetic_layers(n, seed=0):
+    # Wiggly streets with a sidewalk offset to each side, in a projected CRS
+    rng = np.random.RandomState(seed)
+    sidewalks = []
+    streets = []
+    for _ in range(n // 2):
+        count = rng.randint(2, 10)
+        origin = rng.uniform(0, 20000, size=2)
+        heading = rng.uniform(0, 2 * np.pi)
+        headings = heading + np.cumsum(rng.normal(scale=0.3, size=count - 1))
+        steps = rng.uniform(5, 60, size=count - 1)[:, np.newaxis] * \
+            np.column_stack([np.cos(headings), np.sin(headings)])
+        xy = np.vstack([origin, origin + np.cumsum(steps, axis=0)])
+        street = LineString(xy)
+
+        # Offset the vertices along the normal of their outgoing segment
+        normals = np.vstack([steps, steps[-1:]])[:, ::-1] * [-1, 1]
+        normals /= np.linalg.norm(normals, axis=1)[:, np.newaxis]
+        for side in (-1, 1):
+            sidewalks.append(LineString(xy + side * 10 * normals))
+            streets.append(street)
+
+    return sidewalks, streets
+
+
+def read_layers(sidewalks_path, streets_path):
+    sidewalks = dh.storage.read_layer(sidewalks_path)
+    streets = dh.storage.read_layer(streets_path)
+    merged = pd.merge(sidewalks, streets, how='left', left_on='streets_pkey',
+                      right_on='pkey', suffixes=['_sdw', '_str'])
+    return list(merged['geometry_sdw']), list(merged['geometry_str'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sidewalks', help='Path to the sidewalks layer.')
+    parser.add_argument('--streets', help='Path to the streets layer.')
+    parser.add_argument('-n', type=int, default=46000,
+                        help='Number of synthetic sidewalks.')
+    args = parser.parse_args()
+
+    if args.sidewalks and args.streets:
+        sidewalks, streets = read_layers(args.sidewalks, args.streets)
+    else:
+        sidewalks, streets = synthetic_layers(args.n)
+
+    start = time.perf_counter()
+    expected = per_row_sides(sidewalks, streets)
+    t_row = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sides = dh.street_side.street_sides(sidewalks, streets)
+    t_batch = time.perf_counter() - start
+
+    print('sidewalks:  {}'.format(len(sidewalks)))
+    print('per-row:    {:.2f} s'.format(t_row))
+    print('batch:      {:.2f} s'.format(t_batch))
+    print('speedup:    {:.1f}x'.format(t_row / t_batch))
+    print('mismatches: {}'.format((sides != expected).sum()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''Benchmark tiled, multi-process crossing generation and noding
+(`crossings.draw_crossings` and `ped_network.network_sidewalks` with
+`max_workers`) against single-process runs on a synthetic street grid, and
+check that the results are identical.
+
+    python -m benchmarks.bench_tiling -n 120 -j 16
+
+'''
+import argparse
+import os
+import time
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import LineString
+
+import datahelpers as dh
+
+
+UTM = 32610
+
+
+def synthetic_layers(n, spacing=100.0, seed=0):
+    # An n by n grid of jittered intersections, with a few missing streets
+    # and sidewalks
+    rng = np.random.RandomState(seed)
+    nodes = np.stack(np.meshgrid(np.arange(n), np.arange(n), indexing='ij'),
+                     axis=-1) * spacing
+    nodes = nodes + rng.uniform(-3, 3, size=nodes.shape)
+
+    streets = []
+    sidewalks = []
+    for i in range(n):
+        for j in range(n):
+            for di, dj in ((1, 0), (0, 1)):
+                if i + di >= n or j + dj >= n or rng.rand() < 0.1:
+                    continue
+                a = nodes[i, j]
+                b = nodes[i + di, j + dj]
+                mid = (a + b) / 2 + rng.uniform(-5, 5, size=2)
+                keys = []
+                for side in (8, -8):
+                    if rng.rand() < 0.2:
+                        keys.append(np.nan)
+                        continue
+                    v = b - a
+                    normal = np.array([-v[1], v[0]]) / np.linalg.norm(v)
+                    keys.append(len(sidewalks))
+                    sidewalks.append({
+                        'pkey': len(sidewalks),
+                        'incline': 0.0,
+                        'geometry': LineString([a + side * normal + 0.1 * v,
+                                                b + side * normal - 0.1 * v]),
+                    })
+                streets.append({
+                    'id': len(streets),
+                    'pkey_left': keys[0],
+                    'pkey_right': keys[1],
+                    'geometry': LineString([a, mid, b]),
+                })
+
+    sidewalks = gpd.GeoDataFrame(sidewalks, geometry='geometry', crs=UTM)
+    streets = gpd.GeoDataFrame(streets, geometry='geometry', crs=UTM)
+    return sidewalks, streets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=120,
+                        help='Number of intersections along each side of '
+                             'the grid.')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--tile-size', type=float,
+                        default=dh.tiling.TILE_SIZE)
+    args = parser.parse_args()
+
+    sidewalks, streets = synthetic_layers(args.n)
+
+    start = time.perf_counter()
+    crossings = dh.crossings.draw_crossings(sidewalks, streets)
+    t_crossings = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tiled_crossings = dh.crossings.draw_crossings(
+        sidewalks, streets, max_workers=args.workers,
+        tile_size=args.tile_size
+    )
+    t_tiled_crossings = time.perf_counter() - start
+
+    start = time.perf_counter()
+    network = dh.ped_network.network_sidewalks(sidewalks, [crossings])
+    t_network = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tiled_network = dh.ped_network.network_sidewalks(
+        sidewalks, [crossings], max_workers=args.workers,
+        tile_size=args.tile_size
+    )
+    t_tiled_network = time.perf_counter() - start
+
+    print('streets:    {}'.format(streets.shape[0]))
+    print('sidewalks:  {}'.format(sidewalks.shape[0]))
+    print('workers:    {}'.format(args.workers))
+    print('crossings:  {:.2f} s -> {:.2f} s ({:.1f}x), identical: {}'.format(
+        t_crossings, t_tiled_crossings, t_crossings / t_tiled_crossings,
+        crossings.equals(tiled_crossings)))
+    print('noding:     {:.2f} s -> {:.2f} s ({:.1f}x), identical: {}'.format(
+        t_network, t_tiled_network, t_network / t_tiled_network,
+        network.equals(tiled_network)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+'''Time the hot paths of datahelpers, and the chain of stages that the
+Seattle build runs them in, on a synthetic city (see `benchmarks.synthetic`),
+and compare with a stored baseline. Everything runs offline.
+
+    python -m benchmarks.run --scale 10k
+    python -m benchmarks.run --scale 100k --only pipeline network_sidewalks
+    python -m benchmarks.run --scale 10k --save
+
+Scales are numbers of streets: 1k, 10k, 100k or 1m (or any number). Each
+benchmark is timed --repeat times and the fastest time is kept. Peak memory
+is measured in a separate, untimed run with `tracemalloc`, so it counts
+Python and numpy allocations but not those made inside GEOS or GDAL.
+
+Benchmarks more than --tolerance slower than the baseline for the same scale
+are reported as regressions, and the exit status is 1 if there are any.
+--save writes this run's results into the baseline instead. Baselines are
+only comparable on the same machine, so save a new one before comparing
+branches.
+
+'''
+import argparse
+from collections import OrderedDict
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
+import shapely
+
+import datahelpers as dh
+
+from .synthetic import synthetic_city, write_dem
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+SCALES = OrderedDict([
+    ('1k', 1000),
+    ('10k', 10000),
+    ('100k', 100000),
+    ('1m', 1000000),
+])
+# Per-call benchmarks (geometry.cut, raster_interp.interpolated_value) run on
+# at most this many lines or points, so that large scales finish
+MAX_CALLS = 100000
+WGS84 = 4326
+
+
+class City:
+    '''The inputs of the benchmarks: the layers of a synthetic city, its DEM
+    and a directory for output files.
+
+    '''
+    def __init__(self, edges, seed=0):
+        self.edges = edges
+        layers = synthetic_city(edges, seed=seed)
+        self.streets = layers['streets']
+        self.sidewalks = layers['sidewalks']
+        self.crossings = layers['crossings']
+        self.curbramps = layers['curbramps']
+
+        self.tempdir = tempfile.mkdtemp()
+        self.dem_path = os.path.join(self.tempdir, 'dem.tif')
+        write_dem(self.dem_path, self.streets.total_bounds, seed=seed)
+        self.output_path = os.path.join(self.tempdir, 'output.geojson')
+
+        # Street ends, where the build samples the DEM
+        coords, offsets = dh.geometry.coordinate_arrays(self.streets.geometry)
+        self.street_ends = np.unique(
+            np.concatenate([coords[offsets[:-1]], coords[offsets[1:] - 1]]),
+            axis=0
+        )
+
+    def close(self):
+        shutil.rmtree(self.tempdir)
+
+
+def bench_circular_ordered_graph(city):
+    dh.circular_ordered_graph.circular_ordered_graph(
+        city.streets, 2, columns=['pkey', 'pkey_left', 'pkey_right'],
+        swap=[('pkey_left', 'pkey_right')]
+    )
+
+
+def bench_network_sidewalks(city):
+    dh.ped_network.network_sidewalks(city.sidewalks, [city.crossings])
+
+
+def bench_cut(city):
+    for line in city.sidewalks.geometry.values[:MAX_CALLS]:
+        dh.geometry.cut(line, 0.4 * line.length)
+
+
+def bench_cut_lines(city):
+    lines = city.sidewalks.geometry.values
+    lengths = dh.geometry.line_lengths(lines)
+    distances = [[0.1 * length, 0.9 * length] for length in lengths]
+    dh.geometry.cut_lines(lines, distances)
+
+
+def bench_interpolated_value(city):
+    with rio.open(city.dem_path) as dem:
+        dem = dh.raster_interp.TileCache(dem)
+        for x, y in city.street_ends[:MAX_CALLS].tolist():
+            dh.raster_interp.interpolated_value(x, y, dem)
+
+
+def bench_sample(city):
+    with rio.open(city.dem_path) as dem:
+        dem = dh.raster_interp.TileCache(dem)
+        dh.raster_interp.sample(dem, city.street_ends[:, 0],
+                                city.street_ends[:, 1])
+
+
+def bench_draw_crossings(city):
+    dh.crossings.draw_crossings(city.sidewalks, city.streets)
+
+
+def bench_gdf_to_geojson(city):
+    dh.io.gdf_to_geojson(city.sidewalks.to_crs(WGS84), city.output_path)
+
+
+def bench_snap_points(city):
+    dh.snapping.snap_points(city.curbramps.geometry, city.sidewalks.geometry)
+
+
+def bench_snap_to_keys(city):
+    dh.snapping.snap_to_keys(city.curbramps.geometry,
+                             city.curbramps['sw_pkey'],
+                             city.sidewalks.geometry,
+                             city.sidewalks['pkey'])
+
+
+def bench_pipeline(city):
+    # The stages of the Seattle build from intersection_elevations to
+    # cleanup, on layers that are already clean and in UTM
+    with rio.open(city.dem_path) as dem:
+        dem = dh.raster_interp.TileCache(dem)
+        elevations = dh.raster_interp.sample(dem, city.street_ends[:, 0],
+                                             city.street_ends[:, 1])
+    intersections = gpd.GeoDataFrame({
+        'elevation': elevations,
+        'geometry': dh.geometry.points(city.street_ends),
+    }, geometry='geometry', crs=city.streets.crs)
+
+    crossings = dh.crossings.draw_crossings(city.sidewalks, city.streets)
+
+    surface = dh.elevation_surface.ElevationSurface.from_points(intersections)
+    sidewalks = city.sidewalks.copy()
+    sidewalks['incline'] = dh.elevation_surface.endpoint_inclines(
+        sidewalks.geometry, surface
+    ).round(3).clip(-1, 1)
+
+    network = dh.ped_network.network_sidewalks(sidewalks, [crossings])
+
+    for layer in (crossings, network):
+        layer = layer.to_crs(WGS84)
+        layer['length'] = dh.haversine_lengths(layer.geometry).round(2)
+        dh.io.gdf_to_geojson(layer, city.output_path, precision=8)
+
+
+BENCHMARKS = OrderedDict([
+    ('circular_ordered_graph', bench_circular_ordered_graph),
+    ('network_sidewalks', bench_network_sidewalks),
+    ('cut', bench_cut),
+    ('cut_lines', bench_cut_lines),
+    ('interpolated_value', bench_interpolated_value),
+    ('sample', bench_sample),
+    ('draw_crossings', bench_draw_crossings),
+    ('gdf_to_geojson', bench_gdf_to_geojson),
+    ('snap_points', bench_snap_points),
+    ('snap_to_keys', bench_snap_to_keys),
+    ('pipeline', bench_pipeline),
+])
+
+
+def run(func, city, repeat=3, memory=True):
+    '''Time a benchmark and measure its peak memory.
+
+    :returns: dict of the fastest time (`seconds`) and, if measured, the peak
+              traced memory in MB (`peak_mb`).
+
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(city)
+        times.append(time.perf_counter() - start)
+    result = {'seconds': round(min(times), 4)}
+
+    if memory:
+        tracemalloc.start()
+        try:
+            func(city)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result['peak_mb'] = round(peak / 2**20, 1)
+
+    return result
+
+
+def read_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_baseline(path, baseline):
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'shapely': shapely.__version__,
+        'geopandas': gpd.__version__,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''Compare results with the baseline for the same scale.
+
+    :returns: dict of the status of every benchmark: 'slower', 'faster',
+              'same' or 'new' (not in the baseline).
+
+    '''
+    statuses = {}
+    for name, result in results.items():
+        if name not in baseline:
+            statuses[name] = 'new'
+            continue
+        ratio = result['seconds'] / baseline[name]['seconds']
+        if ratio > 1 + tolerance:
+            statuses[name] = 'slower'
+        elif ratio < 1 / (1 + tolerance):
+            statuses[name] = 'faster'
+        else:
+            statuses[name] = 'same'
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--scale', default='10k',
+                        help='Number of streets: {} or a number.'.format(
+                            ', '.join(SCALES)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+                        help='Run only these benchmarks.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip measuring peak memory.')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fraction slower than the baseline that counts '
+                             'as a regression.')
+    parser.add_argument('--save', action='store_true',
+                        help='Save the results as the baseline for this '
+                             'scale.')
+    args = parser.parse_args()
+
+    scale = args.scale.lower()
+    edges = SCALES[scale] if scale in SCALES else int(scale)
+    names = args.only or list(BENCHMARKS)
+
+    start = time.perf_counter()
+    city = City(edges, seed=args.seed)
+    t_setup = time.perf_counter() - start
+
+    baseline = read_baseline(args.baseline)
+    scale_baseline = baseline.get(scale, {})
+    if scale_baseline.get('seed', args.seed) != args.seed:
+        scale_baseline = {}
+    base_results = scale_baseline.get('results', {})
+
+    print('streets: {}, sidewalks: {}, crossings: {} ({:.1f} s to '
+          'generate)'.format(city.streets.shape[0], city.sidewalks.shape[0],
+                             city.crossings.shape[0], t_setup))
+    print('{:24} {:>10} {:>10} {:>10} {:>8}'.format(
+        'benchmark', 'seconds', 'peak MB', 'baseline', 'ratio'))
+
+    results = OrderedDict()
+    try:
+        for name in names:
+            results[name] = run(BENCHMARKS[name], city, repeat=args.repeat,
+                                memory=not args.no_memory)
+            statuses = compare({name: results[name]}, base_results,
+                               args.tolerance)
+            result = results[name]
+            if name in base_results:
+                base = base_results[name]['seconds']
+                ratio = '{:.2f}'.format(result['seconds'] / base)
+                base = '{:.3f}'.format(base)
+            else:
+                base = ratio = '-'
+            print('{:24} {:10.3f} {:>10} {:>10} {:>8}  {}'.format(
+                name, result['seconds'], result.get('peak_mb', '-'), base,
+                ratio, statuses[name] if statuses[name] != 'same' else ''))
+    finally:
+        city.close()
+
+    if resource is not None:
+        # Kilobytes on Linux
+        print('peak RSS of the run: {:.0f} MB'.format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    if args.save:
+        saved = dict(base_results)
+        saved.update(results)
+        baseline[scale] = {
+            'edges': edges,
+            'seed': args.seed,
+            'environment': environment(),
+            'results': saved,
+        }
+        write_baseline(args.baseline, baseline)
+        print('saved baseline for {} to {}'.format(scale, args.baseline))
+        return 0
+
+    statuses = compare(results, base_results, args.tolerance)
+    slower = [name for name, status in statuses.items() if status == 'slower']
+    if slower:
+        print('slower than baseline: {}'.format(', '.join(slower)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
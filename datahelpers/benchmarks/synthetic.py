@@ -0,0 +1,259 @@
+'''Seeded synthetic cities for benchmarks, so that they run offline and give
+the same inputs every time: a grid-plus-noise street network with sidewalks
+offset to either side, crossings near the ends of every street, curb ramps
+at the ends of the crossings and a GeoTIFF DEM covering all of them.
+
+    city = synthetic_city(10000)
+    write_dem('dem.tif', city['streets'].total_bounds)
+
+All layers are in UTM zone 10N (meters), placed around Seattle.
+
+'''
+import math
+
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from shapely.geometry import LineString
+
+import datahelpers as dh
+
+try:
+    # shapely >= 2.0 creates lines from arrays in bulk
+    from shapely import linestrings as _linestrings
+except ImportError:
+    _linestrings = None
+
+
+UTM = 32610
+ORIGIN = (550000.0, 5270000.0)
+# Distance between intersections, in meters
+SPACING = 100.0
+# Fraction of the grid's streets that are missing, and of the streets'
+# sidewalks
+MISSING_STREETS = 0.1
+MISSING_SIDEWALKS = 0.15
+# Street widths (curb to curb) and the distance from curb to sidewalk
+WIDTHS = (8.0, 10.0, 12.0, 16.0)
+MARGIN = 2.5
+# Sidewalks stop short of intersections by this fraction of their street,
+# and crossings are this fraction of the way along their sidewalks
+TRIM = 0.1
+CROSSING_AT = 0.1
+SURFACES = ('concrete', 'asphalt', None)
+
+
+def synthetic_city(edges, seed=0, spacing=SPACING):
+    '''Generate the layers of a city with a given number of streets.
+
+    :param edges: The number of streets (edges of the street network).
+    :type edges: int
+    :param seed: The random seed. The same seed gives the same city.
+    :type seed: int
+    :param spacing: The distance between intersections.
+    :type spacing: float
+    :returns: dict of `streets`, `sidewalks`, `crossings` and `curbramps`
+              GeoDataFrames. Streets and sidewalks refer to each other with
+              the columns the Seattle build uses (`pkey_left`, `pkey_right`,
+              `streets_pkey`).
+
+    '''
+    rng = np.random.RandomState(seed)
+
+    # Enough intersections for the streets, given that some are missing
+    n = int(math.ceil(math.sqrt(edges / (2 * (1 - MISSING_STREETS))))) + 2
+    nodes = np.stack(np.meshgrid(np.arange(n), np.arange(n), indexing='ij'),
+                     axis=-1).reshape(-1, 2) * spacing
+    nodes = nodes + ORIGIN + rng.uniform(-0.05, 0.05, size=nodes.shape) * \
+        spacing
+
+    # Streets to the next intersection east and north, ordered by their
+    # first intersection so that the first `edges` streets cover a compact
+    # area
+    index = np.arange(n * n).reshape(n, n)
+    starts = np.concatenate([index[:-1, :].ravel(), index[:, :-1].ravel()])
+    ends = np.concatenate([index[1:, :].ravel(), index[:, 1:].ravel()])
+    order = np.argsort(starts, kind='mergesort')
+    starts = starts[order]
+    ends = ends[order]
+    kept = rng.uniform(size=starts.shape[0]) >= MISSING_STREETS
+    starts = starts[kept][:edges]
+    ends = ends[kept][:edges]
+    m = starts.shape[0]
+
+    a = nodes[starts]
+    b = nodes[ends]
+    v = b - a
+    normals = np.column_stack([-v[:, 1], v[:, 0]]) / \
+        np.linalg.norm(v, axis=1)[:, np.newaxis]
+    # Streets bend a little at their midpoints
+    mid = (a + b) / 2 + normals * rng.uniform(-0.02, 0.02, size=(m, 1)) * \
+        spacing
+    street_xy = np.stack([a, mid, b], axis=1)
+
+    widths = rng.choice(WIDTHS, size=m)
+    offsets = widths / 2 + MARGIN
+
+    # Sidewalks run alongside the streets, on the left (positive normal) and
+    # right, and stop short of the intersections
+    sidewalk_xy = {}
+    for side, sign in (('left', 1), ('right', -1)):
+        shift = sign * offsets[:, np.newaxis] * normals
+        sidewalk_xy[side] = np.stack([a + TRIM * v + shift, mid + shift,
+                                      b - TRIM * v + shift], axis=1)
+    has_left = rng.uniform(size=m) >= MISSING_SIDEWALKS
+    has_right = rng.uniform(size=m) >= MISSING_SIDEWALKS
+
+    street_idx = np.concatenate([np.flatnonzero(has_left),
+                                 np.flatnonzero(has_right)])
+    is_left = np.repeat([True, False], [has_left.sum(), has_right.sum()])
+    order = np.argsort(street_idx, kind='mergesort')
+    street_idx = street_idx[order]
+    is_left = is_left[order]
+    k = street_idx.shape[0]
+    sidewalk_keys = np.arange(k)
+
+    pkey_left = np.full(m, np.nan)
+    pkey_left[street_idx[is_left]] = sidewalk_keys[is_left]
+    pkey_right = np.full(m, np.nan)
+    pkey_right[street_idx[~is_left]] = sidewalk_keys[~is_left]
+
+    streets = gpd.GeoDataFrame({
+        'id': np.arange(m),
+        'pkey': np.arange(m),
+        'pkey_left': pkey_left,
+        'pkey_right': pkey_right,
+        'width': widths,
+        'layer': np.zeros(m, dtype=int),
+        'geometry': _lines(street_xy),
+    }, geometry='geometry', crs=UTM)
+
+    xy = np.where(is_left[:, np.newaxis, np.newaxis],
+                  sidewalk_xy['left'][street_idx],
+                  sidewalk_xy['right'][street_idx])
+    surfaces = np.array(SURFACES, dtype=object)[
+        rng.randint(len(SURFACES), size=k)
+    ]
+    sidewalk_widths = rng.uniform(1.5, 2.5, size=k).round(2)
+    sidewalks = gpd.GeoDataFrame({
+        'pkey': sidewalk_keys,
+        'streets_pkey': street_idx,
+        'side': np.where(is_left, 'left', 'right'),
+        'offset': np.where(is_left, -1, 1) * offsets[street_idx],
+        'width': sidewalk_widths,
+        'surface': surfaces,
+        'incline': np.zeros(k),
+        'layer': np.zeros(k, dtype=int),
+        'geometry': _lines(xy),
+    }, geometry='geometry', crs=UTM)
+
+    # Crossings between the two sidewalks near each end of streets that have
+    # both. Their ends are on the sidewalks' first and last segments, so
+    # noding splits the sidewalks there.
+    both = np.flatnonzero(has_left & has_right)
+    left = sidewalk_xy['left'][both]
+    right = sidewalk_xy['right'][both]
+    near_start = np.stack([
+        left[:, 0] + CROSSING_AT * (left[:, 1] - left[:, 0]),
+        right[:, 0] + CROSSING_AT * (right[:, 1] - right[:, 0]),
+    ], axis=1)
+    near_end = np.stack([
+        left[:, 2] + CROSSING_AT * (left[:, 1] - left[:, 2]),
+        right[:, 2] + CROSSING_AT * (right[:, 1] - right[:, 2]),
+    ], axis=1)
+    crossing_xy = np.stack([near_start, near_end], axis=1).reshape(-1, 2, 2)
+    j = crossing_xy.shape[0]
+    crossing_streets = np.repeat(both, 2)
+
+    crossings = gpd.GeoDataFrame({
+        'pkey': np.arange(j),
+        'st_pkey': crossing_streets,
+        'sw_left': pkey_left[crossing_streets].astype(int),
+        'sw_right': pkey_right[crossing_streets].astype(int),
+        'marked': (rng.uniform(size=j) < 0.3).astype(int),
+        'geometry': _lines(crossing_xy),
+    }, geometry='geometry', crs=UTM)
+
+    curbramp_xy = crossing_xy.reshape(-1, 2)
+    curbramps = gpd.GeoDataFrame({
+        'pkey': np.arange(2 * j),
+        'sw_pkey': np.column_stack([crossings['sw_left'].values,
+                                    crossings['sw_right'].values]).ravel(),
+        'geometry': dh.geometry.points(curbramp_xy),
+    }, geometry='geometry', crs=UTM)
+
+    return {
+        'streets': streets,
+        'sidewalks': sidewalks,
+        'crossings': crossings,
+        'curbramps': curbramps,
+    }
+
+
+def elevation(xs, ys, seed=0):
+    '''Synthetic terrain: rolling hills on a gentle slope.
+
+    '''
+    phase = np.random.RandomState(seed).uniform(0, 2 * np.pi, size=2)
+    xs = np.asarray(xs, dtype=float) - ORIGIN[0]
+    ys = np.asarray(ys, dtype=float) - ORIGIN[1]
+    return 60 + 0.004 * xs + \
+        40 * np.sin(xs / 1500 + phase[0]) * np.cos(ys / 1100 + phase[1])
+
+
+def write_dem(path, bounds, resolution=10.0, margin=200.0, seed=0):
+    '''Write a DEM covering some bounds as a tiled, compressed float32
+    GeoTIFF, like the USGS DEMs. Rows are written a block at a time, so large
+    DEMs don't need to fit in memory.
+
+    :param path: The path of the GeoTIFF.
+    :type path: str
+    :param bounds: The area to cover, (minx, miny, maxx, maxy).
+    :type bounds: array of float
+    :param resolution: The size of pixels, in meters.
+    :type resolution: float
+    :param margin: The distance to extend the DEM past the bounds.
+    :type margin: float
+    :param seed: The random seed for the terrain and its noise.
+    :type seed: int
+
+    '''
+    minx, miny, maxx, maxy = bounds
+    left = math.floor((minx - margin) / resolution) * resolution
+    top = math.ceil((maxy + margin) / resolution) * resolution
+    width = int(math.ceil((maxx + margin - left) / resolution))
+    height = int(math.ceil((top - (miny - margin)) / resolution))
+    block = 256
+
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'width': width,
+        'height': height,
+        'count': 1,
+        'crs': 'EPSG:{}'.format(UTM),
+        'transform': from_origin(left, top, resolution, resolution),
+        'tiled': True,
+        'blockxsize': block,
+        'blockysize': block,
+        'compress': 'lzw',
+    }
+    rng = np.random.RandomState(seed)
+    xs = left + (np.arange(width) + 0.5) * resolution
+    with rio.open(path, 'w', **profile) as dst:
+        for row in range(0, height, block):
+            rows = min(block, height - row)
+            ys = top - (np.arange(row, row + rows) + 0.5) * resolution
+            z = elevation(xs[np.newaxis, :], ys[:, np.newaxis], seed=seed)
+            z += rng.normal(scale=0.2, size=z.shape)
+            dst.write(z.astype('float32'), 1,
+                      window=Window(0, row, width, rows))
+
+
+def _lines(xy):
+    # LineStrings from an (n, vertices, 2) array
+    if _linestrings is not None:
+        return list(_linestrings(xy))
+    return [LineString(line) for line in xy.tolist()]
@@ -1,3 +1,7 @@
 from . import circular_ordered_graph
-from . import fetchers, geometry, io, ped_network, raster_interp, utm
-from .haversine import haversine
+from . import (crossings, elevation_surface, fetchers, geometry, graph,
+               instrumentation, io, network, osm, ped_network,
+               raster_interp, snapping, spatial_index, storage, street_side,
+               tiling, utm)
+from .haversine import (haversine, haversine_coordinate_lengths,
+                        haversine_lengths, haversine_segments)
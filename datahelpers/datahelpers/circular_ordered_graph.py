@@ -1,13 +1,17 @@
-from sidewalkify.graph.utils import azimuth_cartesian as azimuth
+import math
+
 import networkx as nx
 import numpy as np
-from shapely.geometry import LineString
+
+from .geometry import coordinate_arrays, reverse_lines
+from .instrumentation import timed
 
 
 # TODO: Some elements of this process may make more sense as a subclass of
 # networkx.MultiDiGraph. e.g., the circular embedding could be regenerated
 # whenever an edge is added/removed.
 
+@timed
 def circular_ordered_graph(linestring_gdf, precision, columns=None,
                            swap=None):
     '''Create a MultiDigraph from a GeoDataFrame that has LineString
@@ -35,67 +39,210 @@ def circular_ordered_graph(linestring_gdf, precision, columns=None,
                  swapped for a `reversed` edge.
     :type swap: list of lists
 
+    '''
+    ordering = circular_ordering(linestring_gdf, precision, columns=columns,
+                                 swap=swap)
+    return ordering.to_networkx()
+
+
+@timed
+def circular_ordering(linestring_gdf, precision, columns=None, swap=None):
+    '''Build the same graph as `circular_ordered_graph`, but as a compact,
+    array-backed structure (see `CircularOrdering`). Endpoints, node ids,
+    azimuths and reversed geometries are calculated for all rows at once.
+    Parameters are the same as for `circular_ordered_graph`.
+
     '''
     df = linestring_gdf
-    # A given geospatial network might have parallel paths - wouldn't want to
-    # miss any
-    G = nx.MultiDiGraph()
-    for idx, row in df.iterrows():
-        geometry = row['geometry']
-        coords = list(geometry.coords)
-
-        start = list(np.round(coords[0], precision))
-        end = list(np.round(coords[-1], precision))
-
-        # Use start and end points as graph nodes
-        start_node = str(start)
-        end_node = str(end)
-        G.add_node(start_node, x=start[0], y=start[1])
-        G.add_node(end_node, x=end[0], y=end[1])
-
-        # Create two directed edges - one 'forward', one 'reverse'
-        for forward in range(2):
-            if columns is not None:
-                edge_data = row[columns].to_dict()
-            else:
-                edge_data = {}
-
-            edge_data['forward'] = forward
-
-            if forward:
-                azimuth_out = azimuth(coords[0], coords[1])
-                edge_data['azimuth'] = azimuth_out
-                G.add_edge(start_node, end_node, **edge_data)
-            if not forward:
-                coords_r = list(reversed(coords))
-                geometry_r = LineString(coords_r)
-                edge_data['geometry'] = geometry_r
-                azimuth_out = azimuth(coords_r[0], coords_r[1])
-                edge_data['azimuth'] = azimuth_out
-
-                if swap is not None:
-                    for k1, k2 in swap:
-                        new_k1 = edge_data[k2]
-                        new_k2 = edge_data[k1]
-                        edge_data[k1] = new_k1
-                        edge_data[k2] = new_k2
-
-                G.add_edge(end_node, start_node, **edge_data)
-
-    # For ease of traversal, the initial circular ordering is embedded in each
-    # node as the 'next' node describing the edge (i.e. node u has a list of
-    # nodes v1, v2, ..., vn in clockwise ordering).
-    # FIXME: Treat streets with very similar azimuths and no 'in-between'
-    # sidewalks as a single edge for crossings
-    for u, d_node in G.nodes(data=True):
-        # Note: complexity of for loop is due to potential of more than one
-        # edge sharing the same u, v nodes.
-        out_data = []
-        for v, d_edges in G[u].items():
-            for i, d_edge in d_edges.items():
-                out_data.append([v, i, d_edge])
-        out_data_sorted = sorted(out_data, key=lambda x: x[2]['azimuth'])
-        sorted_edges = [(v, i) for v, i, d_edge in out_data_sorted]
-        G.nodes[u]['sorted_edges'] = sorted_edges
-
-    return G
+    n = df.shape[0]
+
+    # Endpoints and the coordinates next to them, for azimuths
+    coords, offsets = coordinate_arrays(df['geometry'])
+    firsts = coords[offsets[:-1]]
+    seconds = coords[offsets[:-1] + 1]
+    lasts = coords[offsets[1:] - 1]
+    second_lasts = coords[offsets[1:] - 2]
+
+    # Row i's start and end nodes are end_nodes[2 * i] and
+    # end_nodes[2 * i + 1]
+    ends = np.empty((2 * n, 2))
+    ends[0::2] = np.round(firsts, precision)
+    ends[1::2] = np.round(lasts, precision)
+    # Rounding can produce -0.0, which would otherwise get a node key that
+    # differs from 0.0's
+    ends += 0.0
+
+    # Integer node ids, numbered in order of first appearance
+    if n:
+        _, first_seen, inverse = np.unique(ends, axis=0, return_index=True,
+                                           return_inverse=True)
+        inverse = inverse.reshape(-1)
+    else:
+        first_seen = np.empty(0, dtype=int)
+        inverse = np.empty(0, dtype=int)
+    rank = np.empty(first_seen.shape[0], dtype=int)
+    rank[np.argsort(first_seen)] = np.arange(first_seen.shape[0])
+    end_nodes = rank[inverse]
+    node_xy = ends[np.sort(first_seen)]
+
+    # Directed edges are numbered in the order circular_ordered_graph adds
+    # them: edge 2 * i is row i's reverse edge, 2 * i + 1 its forward edge.
+    edge_u = np.empty(2 * n, dtype=int)
+    edge_v = np.empty(2 * n, dtype=int)
+    edge_u[0::2] = end_nodes[1::2]
+    edge_v[0::2] = end_nodes[0::2]
+    edge_u[1::2] = end_nodes[0::2]
+    edge_v[1::2] = end_nodes[1::2]
+
+    edge_azimuth = np.empty(2 * n)
+    edge_azimuth[0::2] = azimuths(lasts, second_lasts)
+    edge_azimuth[1::2] = azimuths(firsts, seconds)
+
+    return CircularOrdering(df, node_xy, edge_u, edge_v, edge_azimuth,
+                            columns=columns, swap=swap)
+
+
+class CircularOrdering:
+    '''A circular-ordered street graph stored as arrays. Nodes are
+    integers 0..n_nodes - 1, directed edges are integers 0..2 * n_rows - 1,
+    where edge 2 * i runs against row i ('forward' = 0) and edge 2 * i + 1
+    runs along it ('forward' = 1).
+
+    The clockwise ordering of each node's out-edges is stored CSR-style:
+    `indices[indptr[u]:indptr[u + 1]]` are the out-edges of node u, sorted by
+    azimuth, and `position[e]` is the position of edge e in that list.
+
+    `to_networkx` gives the MultiDiGraph view built by
+    `circular_ordered_graph`.
+
+    '''
+    def __init__(self, df, node_xy, edge_u, edge_v, edge_azimuth,
+                 columns=None, swap=None):
+        self.node_xy = node_xy
+        self.edge_u = edge_u
+        self.edge_v = edge_v
+        self.edge_azimuth = edge_azimuth
+        self.edge_row = np.arange(edge_u.shape[0]) // 2
+        self.edge_forward = np.arange(edge_u.shape[0]) % 2
+
+        self.columns = list(columns) if columns is not None else None
+        self.swap = swap
+        if self.columns is not None:
+            self.values = {c: df[c].tolist() for c in self.columns}
+        else:
+            self.values = {}
+        self.geometry = df['geometry'].tolist()
+        self.geometry_reversed = reverse_lines(self.geometry)
+
+        n_nodes = node_xy.shape[0]
+        n_edges = edge_u.shape[0]
+        edge_ids = np.arange(n_edges)
+
+        # Key of each edge among parallel edges (same u and v), numbered in
+        # the order they were added: a networkx MultiDiGraph's edge keys.
+        pair = edge_u * n_nodes + edge_v
+        by_pair = np.argsort(pair, kind='mergesort')
+        sorted_pair = pair[by_pair]
+        group_start = np.r_[True, sorted_pair[1:] != sorted_pair[:-1]]
+        group_first = np.maximum.accumulate(
+            np.where(group_start, np.arange(n_edges), 0)
+        )
+        self.edge_key = np.empty(n_edges, dtype=int)
+        self.edge_key[by_pair] = np.arange(n_edges) - group_first
+        # The first edge added between u and v, which decides where v is in
+        # the networkx adjacency of u.
+        self.pair_first = np.empty(n_edges, dtype=int)
+        self.pair_first[by_pair] = by_pair[group_first]
+
+        # Sort each node's out-edges by azimuth. Ties are kept in networkx
+        # adjacency order, as with a stable sort over G[u].
+        self.indices = np.lexsort((edge_ids, self.pair_first, edge_azimuth,
+                                   edge_u))
+        self.indptr = np.zeros(n_nodes + 1, dtype=int)
+        np.cumsum(np.bincount(edge_u, minlength=n_nodes),
+                  out=self.indptr[1:])
+        self.position = np.empty(n_edges, dtype=int)
+        self.position[self.indices] = \
+            np.arange(n_edges) - self.indptr[edge_u[self.indices]]
+
+    @property
+    def n_nodes(self):
+        return self.node_xy.shape[0]
+
+    @property
+    def n_edges(self):
+        return self.edge_u.shape[0]
+
+    def node_keys(self):
+        # The string node keys used by circular_ordered_graph
+        return [str(list(xy)) for xy in self.node_xy]
+
+    def out_edges(self, u):
+        '''The out-edges of node u, in clockwise order.'''
+        return self.indices[self.indptr[u]:self.indptr[u + 1]]
+
+    def edges(self):
+        '''All edges, in the order that the networkx view iterates over them:
+        by u, then by v in the order v was first connected to u, then by key.
+        '''
+        return np.lexsort((np.arange(self.n_edges), self.pair_first,
+                           self.edge_u))
+
+    def degree(self, u):
+        # Every row adds an edge in each direction, so the in-degree is equal
+        # to the out-degree.
+        return 2 * (self.indptr[u + 1] - self.indptr[u])
+
+    def edge_data(self, e):
+        '''The attributes of edge e, as embedded by `circular_ordered_graph`.
+        '''
+        row = self.edge_row[e]
+        edge_data = {c: values[row] for c, values in self.values.items()}
+        forward = int(self.edge_forward[e])
+        edge_data['forward'] = forward
+        if not forward:
+            edge_data['geometry'] = self.geometry_reversed[row]
+        edge_data['azimuth'] = float(self.edge_azimuth[e])
+
+        if not forward and self.swap is not None:
+            for k1, k2 in self.swap:
+                edge_data[k1], edge_data[k2] = edge_data[k2], edge_data[k1]
+
+        return edge_data
+
+    def to_networkx(self):
+        '''Build the networkx.MultiDiGraph view of the graph.'''
+        keys = self.node_keys()
+        edge_key = self.edge_key.tolist()
+
+        G = nx.MultiDiGraph()
+        for key, (x, y) in zip(keys, self.node_xy):
+            G.add_node(key, x=x, y=y)
+
+        for e, (u, v) in enumerate(zip(self.edge_u, self.edge_v)):
+            G.add_edge(keys[u], keys[v], key=edge_key[e],
+                       **self.edge_data(e))
+
+        # For ease of traversal, the initial circular ordering is embedded in
+        # each node as the 'next' node describing the edge (i.e. node u has a
+        # list of nodes v1, v2, ..., vn in clockwise ordering).
+        for u, key in enumerate(keys):
+            G.nodes[key]['sorted_edges'] = [
+                (keys[self.edge_v[e]], edge_key[e]) for e in self.out_edges(u)
+            ]
+
+        return G
+
+
+def azimuths(p1, p2):
+    '''Vectorized version of sidewalkify's `azimuth_cartesian`: the bearing
+    from each point in p1 to the corresponding point in p2, in degrees,
+    increasing in the clockwise direction.
+
+    '''
+    dx = (p2[:, 0] - p1[:, 0]).tolist()
+    dy = (p2[:, 1] - p1[:, 1]).tolist()
+    # math.atan2 rather than np.arctan2: numpy's may differ in the last bit,
+    # which is enough to change the ordering of (nearly) parallel edges
+    angle = np.array([math.atan2(x, y) for x, y in zip(dx, dy)], dtype=float)
+    return (np.degrees(angle) + 360) % 360
@@ -0,0 +1,369 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import LineString
+
+from .circular_ordered_graph import circular_ordering
+from .geometry import (coordinate_arrays, interpolate_points, points,
+                       project_points)
+from .tiling import (TILE_SIZE, imap, inputs_hash, make_tiles,
+                     parameters_hash, row_hashes)
+
+
+# Range of angles (in degrees) between a street and its neighbour at an
+# intersection within which they're considered to be 'parallel', i.e. a
+# 'T' intersection.
+T_RANGE = (160, 200)
+
+# The minimum degree of an intersection that gets crossings. Streets are
+# bidirectional edges, so this skips dead ends and continuing streets.
+MIN_DEGREE = 5
+
+# The number of intersections processed at a time
+CHUNKSIZE = 1000
+
+# The output columns, other than the geometry
+COLUMNS = ['st_pkey', 'sw_left', 'sw_right', 'ccw_sw_right', 'cw_sw_left']
+
+# Columns that order crossings drawn on tiles like those drawn all at once
+ORDER = ['_node', '_pair', '_edge']
+
+
+def draw_crossings(sidewalks, streets, precision=2, t_range=T_RANGE,
+                   chunksize=CHUNKSIZE, progress=None, max_workers=1,
+                   tile_size=TILE_SIZE, store=None):
+    '''Draw street crossings between the sidewalk corners around every
+    intersection of a street network. For every street leaving an
+    intersection, a crossing is drawn between the start of its left sidewalk
+    (or the end of the counter-clockwise street's right sidewalk) and the end
+    of its right sidewalk (or the start of the clockwise street's left
+    sidewalk). At 'T' intersections, the corner on the straight-through side
+    is moved to the point on that sidewalk closest to the other corner.
+
+    Sidewalks are looked up by primary key through precomputed arrays, and
+    the circular ordering of streets around intersections is array-backed
+    (see `circular_ordered_graph.CircularOrdering`), so intersections are
+    processed in vectorized batches.
+
+    With more than one worker, streets are split into spatial tiles that are
+    processed on a process pool (see `tiling`). Each tile gets the streets
+    that share intersections with the streets it owns, and the sidewalks
+    they refer to, and keeps the crossings of the streets it owns. The result
+    is the same. With a `tiling.TileStore`, only the tiles whose streets or
+    sidewalks changed since the last run are processed again.
+
+    :param sidewalks: Sidewalk lines with a (numeric) `pkey` column.
+    :type sidewalks: geopandas.GeoDataFrame
+    :param streets: Street lines with `id`, `pkey_left` and `pkey_right`
+                    columns, the latter two referring to sidewalk `pkey`s. Must
+                    be in the same (projected) CRS as the sidewalks.
+    :type streets: geopandas.GeoDataFrame
+    :param precision: The rounding precision for street endpoints to be
+                      considered the same intersection.
+    :type precision: int
+    :param t_range: The range of angles between streets that make a 'T'.
+    :type t_range: 2-tuple of float
+    :param chunksize: The number of intersections to process at a time.
+    :type chunksize: int
+    :param progress: If set, called with the number of intersections
+                     processed so far and the total number of intersections
+                     after every chunk (or, with more than one worker, after
+                     every tile, counting those of unchanged tiles as done).
+    :type progress: callable
+    :param max_workers: The number of processes. With None, the number of
+                        CPUs.
+    :type max_workers: int
+    :param tile_size: The width and height of tiles.
+    :type tile_size: float
+    :param store: The results of previous runs, by tile.
+    :type store: tiling.TileStore
+    :returns: geopandas.GeoDataFrame of crossings, with `st_pkey`, `sw_left`,
+              `sw_right`, `ccw_sw_right` and `cw_sw_left` columns.
+
+    '''
+    if max_workers != 1 or store is not None:
+        return _draw_tiled(sidewalks, streets, precision, t_range, chunksize,
+                           progress, max_workers, tile_size, store)
+    crossings, _, _ = _draw_crossings(sidewalks, streets, precision, t_range,
+                                      chunksize, progress)
+    return crossings
+
+
+def _draw_crossings(sidewalks, streets, precision, t_range, chunksize,
+                    progress):
+    # Draw crossings, also returning the edge of each crossing and the
+    # circular ordering of the streets
+    ordering = circular_ordering(streets, precision)
+
+    # The street attributes as seen from each (directed) edge: the sidewalks
+    # are swapped for edges that go against the direction of the street.
+    rows = ordering.edge_row
+    forward = ordering.edge_forward.astype(bool)
+    left = streets['pkey_left'].values.astype(float)[rows]
+    right = streets['pkey_right'].values.astype(float)[rows]
+    edge_left = np.where(forward, left, right)
+    edge_right = np.where(forward, right, left)
+    edge_ids = streets['id'].values[rows]
+
+    lookup = SidewalkLookup(sidewalks)
+
+    # Edges that leave intersections, in the order that the networkx graph
+    # built by circular_ordered_graph would iterate over them.
+    edges = ordering.edges()
+    edges = edges[ordering.degree(ordering.edge_u[edges]) >= MIN_DEGREE]
+    edge_nodes = ordering.edge_u[edges]
+    intersections = np.unique(edge_nodes)
+    total = intersections.shape[0]
+
+    chunks = []
+    for start in range(0, total, chunksize):
+        chunk_nodes = intersections[start:start + chunksize]
+        lo = np.searchsorted(edge_nodes, chunk_nodes[0], side='left')
+        hi = np.searchsorted(edge_nodes, chunk_nodes[-1], side='right')
+        chunks.append(_draw(ordering, edges[lo:hi], edge_left, edge_right,
+                            edge_ids, lookup, t_range))
+        if progress is not None:
+            progress(min(start + chunksize, total), total)
+
+    data = {'geometry': [g for chunk in chunks for g in chunk['geometry']]}
+    for column in COLUMNS:
+        if chunks:
+            data[column] = np.concatenate([chunk[column] for chunk in chunks])
+        else:
+            data[column] = np.empty(0)
+    drawn = np.concatenate([chunk['edge'] for chunk in chunks]) if chunks \
+        else np.empty(0, dtype=int)
+
+    crossings = gpd.GeoDataFrame(data, columns=['geometry'] + COLUMNS,
+                                 crs=streets.crs)
+    return crossings, drawn, ordering
+
+
+def _draw_tiled(sidewalks, streets, precision, t_range, chunksize, progress,
+                max_workers, tile_size, store):
+    # Street ends that round to the same intersection are less than
+    # 10**-precision apart
+    tiles = make_tiles(streets, buffer=10.0**-precision, tile_size=tile_size)
+    if not tiles:
+        return draw_crossings(sidewalks, streets, precision=precision,
+                              t_range=t_range, chunksize=chunksize)
+
+    # Each tile's streets are its halo, with the positions of the streets it
+    # owns among them, and its sidewalks are those the streets refer to
+    pkeys = sidewalks['pkey'].values.astype(float)
+    owned = [np.searchsorted(tile.halo, tile.rows) for tile in tiles]
+    sidewalk_rows = []
+    for tile in tiles:
+        tile_streets = streets.iloc[tile.halo]
+        refs = np.union1d(tile_streets['pkey_left'].values.astype(float),
+                          tile_streets['pkey_right'].values.astype(float))
+        sidewalk_rows.append(np.flatnonzero(np.isin(pkeys, refs)))
+
+    results = [None] * len(tiles)
+    if store is not None:
+        params = parameters_hash(draw_crossings, [sidewalks, streets],
+                                 precision=precision, t_range=t_range,
+                                 tile_size=tile_size)
+        street_hashes = row_hashes(streets)
+        sidewalk_hashes = row_hashes(sidewalks)
+        hashes = [
+            inputs_hash(params, [street_hashes[tile.halo], tile_owned,
+                                 sidewalk_hashes[rows]])
+            for tile, tile_owned, rows in zip(tiles, owned, sidewalk_rows)
+        ]
+        results = store.load(tiles, hashes)
+
+    dirty = [i for i, result in enumerate(results) if result is None]
+    tasks = [(sidewalks.iloc[sidewalk_rows[i]], streets.iloc[tiles[i].halo],
+              owned[i], precision, t_range, chunksize) for i in dirty]
+
+    # Every tile counts the intersections it draws crossings for, so
+    # progress is in intersections, as when drawing all at once
+    if progress is not None:
+        total = _count_intersections(streets, precision)
+        done = sum(result[1] for result in results if result is not None)
+    for i, result in zip(dirty, imap(_draw_tile, tasks,
+                                     max_workers=max_workers)):
+        results[i] = result
+        if progress is not None:
+            done += result[1]
+            progress(done, total)
+
+    if store is not None:
+        store.save(tiles, hashes, results, dirty)
+
+    # Map street end and edge ids in tiles to those in the whole layer. The
+    # mapping keeps their order, as tile streets are in layer order.
+    crossings = []
+    for (result, _), tile in zip(results, tiles):
+        result = result.copy()
+        for column in ORDER:
+            local = result[column].values
+            result[column] = 2 * tile.halo[local // 2] + local % 2
+        crossings.append(result)
+
+    # Tiles without crossings have float columns, which would upcast the rest
+    crossings = pd.concat([c for c in crossings if c.shape[0]] or
+                          crossings[:1])
+    order = np.lexsort([crossings[c].values for c in ORDER[::-1]])
+    crossings = crossings.iloc[order].drop(columns=ORDER)
+
+    return gpd.GeoDataFrame(crossings.reset_index(drop=True),
+                            crs=streets.crs)
+
+
+def _draw_tile(sidewalks, streets, owned, precision, t_range, chunksize):
+    # Draw the crossings of a tile's streets, keeping those of the streets it
+    # owns (by position in `streets`). Also returns the number of
+    # intersections the tile owns: those whose first street end is on a
+    # street it owns, so that every intersection is owned by one tile.
+    crossings, drawn, ordering = _draw_crossings(sidewalks, streets,
+                                                 precision, t_range,
+                                                 chunksize, None)
+
+    # Street ends 2 * i and 2 * i + 1 are the start and end of row i, and
+    # edge e leaves the end 2 * (e // 2) + 1 - e % 2.
+    edges = np.arange(ordering.n_edges)
+    ends = 2 * ordering.edge_row + 1 - ordering.edge_forward
+
+    # Draw order: intersections in order of first appearance, then edges in
+    # adjacency order, as in `CircularOrdering.edges`
+    node_first = np.full(ordering.n_nodes, ends.max() + 1 if ends.size else 0)
+    np.minimum.at(node_first, ordering.edge_u, ends)
+    crossings['_node'] = node_first[ordering.edge_u[drawn]]
+    crossings['_pair'] = edges[ordering.pair_first[drawn]]
+    crossings['_edge'] = edges[drawn]
+
+    keep = np.isin(ordering.edge_row[drawn], owned)
+
+    nodes = np.arange(ordering.n_nodes)
+    intersections = nodes[ordering.degree(nodes) >= MIN_DEGREE]
+    n_owned = np.isin(node_first[intersections] // 2, owned).sum()
+
+    return crossings.iloc[np.flatnonzero(keep)], int(n_owned)
+
+
+def _count_intersections(streets, precision):
+    # The number of intersections that get crossings, as in
+    # `circular_ordering`: street ends that round to the same point are an
+    # intersection, and every street adds two edges to the degree of each
+    # of its ends.
+    if not streets.shape[0]:
+        return 0
+    coords, offsets = coordinate_arrays(streets['geometry'])
+    ends = np.concatenate([coords[offsets[:-1]], coords[offsets[1:] - 1]])
+    ends = np.round(ends, precision) + 0.0
+    _, counts = np.unique(ends, axis=0, return_counts=True)
+    return int((2 * counts >= MIN_DEGREE).sum())
+
+
+class SidewalkLookup:
+    '''Sidewalk geometries and corners (start and end points), looked up by
+    primary key. Where primary keys are repeated, the first sidewalk wins.
+
+    :param sidewalks: Sidewalk lines with a (numeric) `pkey` column.
+    :type sidewalks: geopandas.GeoDataFrame
+
+    '''
+    def __init__(self, sidewalks):
+        pkeys = sidewalks['pkey'].values.astype(float)
+        valid = np.flatnonzero(~np.isnan(pkeys))
+        self.pkeys, first = np.unique(pkeys[valid], return_index=True)
+        self.positions = valid[first]
+
+        self.geometry = list(sidewalks.geometry)
+        coords, offsets = coordinate_arrays(self.geometry)
+        self.firsts = coords[offsets[:-1]]
+        self.lasts = coords[offsets[1:] - 1]
+
+    def find(self, pkeys):
+        '''The positions of the sidewalks with the given primary keys, -1 for
+        keys that are missing (or NaN).
+
+        '''
+        pkeys = np.asarray(pkeys, dtype=float)
+        found = np.full(pkeys.shape, -1, dtype=int)
+        if not self.pkeys.shape[0]:
+            return found
+        idx = np.minimum(np.searchsorted(self.pkeys, pkeys),
+                         self.pkeys.shape[0] - 1)
+        match = self.pkeys[idx] == pkeys
+        found[match] = self.positions[idx[match]]
+        return found
+
+
+def _draw(ordering, edges, edge_left, edge_right, edge_ids, lookup, t_range):
+    # Draw the crossings for a batch of edges leaving intersections
+    u = ordering.edge_u[edges]
+    start = ordering.indptr[u]
+    n = ordering.indptr[u + 1] - start
+    position = ordering.position[edges]
+
+    # Find left and right streets
+    ccw = ordering.indices[start + (position - 1) % n]
+    cw = ordering.indices[start + (position + 1) % n]
+
+    # Corners: the start of the left sidewalk, or the end of the sidewalk on
+    # the right of the counter-clockwise street (and vice versa)
+    sw_left = lookup.find(edge_left[edges])
+    ccw_right = lookup.find(edge_right[ccw])
+    sw_right = lookup.find(edge_right[edges])
+    cw_left = lookup.find(edge_left[cw])
+
+    has_ccw = (sw_left >= 0) | (ccw_right >= 0)
+    has_cw = (sw_right >= 0) | (cw_left >= 0)
+    # Skip streets that don't have a corner on both sides
+    keep = has_ccw & has_cw
+    edges = edges[keep]
+    ccw = ccw[keep]
+    cw = cw[keep]
+    sw_left = sw_left[keep]
+    ccw_right = ccw_right[keep]
+    sw_right = sw_right[keep]
+    cw_left = cw_left[keep]
+
+    corner_ccw = np.where((sw_left >= 0)[:, np.newaxis],
+                          lookup.firsts[sw_left], lookup.lasts[ccw_right])
+    corner_cw = np.where((sw_right >= 0)[:, np.newaxis],
+                         lookup.lasts[sw_right], lookup.firsts[cw_left])
+
+    # Check for 'T' intersections, 'straighten' crossings at them
+    azimuth = ordering.edge_azimuth
+    dccw = (azimuth[edges] - azimuth[ccw]) % 360
+    dcw = (azimuth[edges] - azimuth[cw]) % 360
+
+    # They're basically parallel - it's a T intersection ending on the left.
+    # Adjust the 'left' corner to be whatever point on the left sidewalk is
+    # closest to the 'right' corner.
+    t_ccw = (dccw > t_range[0]) & (dccw < t_range[1]) & (sw_left >= 0)
+    corner_ccw[t_ccw] = _closest_on(lookup, sw_left[t_ccw], corner_cw[t_ccw])
+
+    # Same for a T intersection ending on the right, closest to the (possibly
+    # adjusted) 'left' corner.
+    t_cw = (dcw > t_range[0]) & (dcw < t_range[1]) & (sw_right >= 0)
+    corner_cw[t_cw] = _closest_on(lookup, sw_right[t_cw], corner_ccw[t_cw])
+
+    # The crossing is just connected corners. This is the step where some
+    # constraints can be added.
+    geometry = [LineString([a, b]) for a, b in zip(corner_ccw.tolist(),
+                                                   corner_cw.tolist())]
+
+    return {
+        'geometry': geometry,
+        'st_pkey': edge_ids[edges],
+        'sw_left': edge_left[edges],
+        'sw_right': edge_right[edges],
+        'ccw_sw_right': edge_right[ccw],
+        'cw_sw_left': edge_left[cw],
+        'edge': edges,
+    }
+
+
+def _closest_on(lookup, sidewalk_positions, xy):
+    # The points on sidewalks closest to other points
+    if not sidewalk_positions.shape[0]:
+        return np.empty((0, 2))
+    lines = [lookup.geometry[i] for i in sidewalk_positions]
+    distances = project_points(lines, points(xy))
+    closest = interpolate_points(lines, distances)
+    return np.array([(p.x, p.y) for p in closest])
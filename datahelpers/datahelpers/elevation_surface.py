@@ -0,0 +1,289 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from scipy.spatial import Delaunay, cKDTree
+from shapely.geometry import LinearRing, MultiPoint
+
+from .geometry import (coordinate_arrays, interpolate_points, line_lengths,
+                       points, project_points)
+from .tiling import ROW, TILE_SIZE, map_tiles
+
+
+class ElevationSurface:
+    '''A linearly interpolated elevation surface over scattered points (e.g.
+    intersection elevations), built once and evaluated for arrays of points.
+
+    Inside the convex hull of the points, elevations are interpolated
+    linearly on the Delaunay triangulation of the points, as with scipy's
+    `LinearNDInterpolator`. Points outside of the hull are moved onto the
+    hull and nudged `nudge` units inwards (or, with `inverse_nudge`, `nudge`
+    divided by their distance to the hull), then interpolated. Any that still
+    miss get the elevation of the nearest point, found with a KD-tree.
+
+    The triangulation is stored as plain arrays (simplices, neighbours and
+    barycentric transforms), and points are located by walking the
+    triangulation from the simplex of their nearest vertex, so a surface can
+    be saved with `save`, or pickled, and reused for many layers without
+    triangulating again.
+
+    :param xy: An (n, 2) array of the (projected) coordinates of the points.
+    :type xy: numpy.ndarray
+    :param elevations: The elevation of every point.
+    :type elevations: array of float
+    :param nudge: The distance to move out-of-hull points inside the hull.
+    :type nudge: float
+    :param inverse_nudge: Whether to divide the nudge by the distance from
+                          the point to the hull, as the Seattle rule always
+                          has: points far outside of the hull are barely
+                          moved inside it.
+    :type inverse_nudge: bool
+
+    '''
+    def __init__(self, xy, elevations, nudge=1.0, inverse_nudge=False,
+                 _arrays=None):
+        self.xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        self.elevations = np.asarray(elevations, dtype=float)
+        self.nudge = nudge
+        self.inverse_nudge = inverse_nudge
+
+        if _arrays is None:
+            triangulation = Delaunay(self.xy)
+            _arrays = {
+                'simplices': triangulation.simplices,
+                'neighbors': triangulation.neighbors,
+                'transform': triangulation.transform,
+                'vertex_simplex': triangulation.vertex_to_simplex,
+                'hull': np.asarray(
+                    MultiPoint(self.xy.tolist()).convex_hull.exterior.coords
+                ),
+            }
+        self.simplices = _arrays['simplices']
+        self.neighbors = _arrays['neighbors']
+        self.transform = _arrays['transform']
+        self.vertex_simplex = _arrays['vertex_simplex']
+        self.hull = LinearRing(_arrays['hull'])
+
+        self._tree = None
+
+    @classmethod
+    def from_points(cls, gdf, column='elevation', nudge=1.0,
+                    inverse_nudge=False):
+        '''Create a surface from a GeoDataFrame of Points.
+
+        :param gdf: Points with an elevation column.
+        :type gdf: geopandas.GeoDataFrame
+        :param column: The name of the elevation column.
+        :type column: str
+
+        '''
+        xy = np.array([(p.x, p.y) for p in gdf.geometry], dtype=float)
+        return cls(xy, gdf[column].values, nudge=nudge,
+                   inverse_nudge=inverse_nudge)
+
+    @classmethod
+    def load(cls, path):
+        '''Load a surface written by `save`.'''
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+        # Surfaces saved before inverse_nudge was added don't have it
+        inverse_nudge = bool(arrays.pop('inverse_nudge', False))
+        return cls(arrays.pop('xy'), arrays.pop('elevations'),
+                   nudge=float(arrays.pop('nudge')),
+                   inverse_nudge=inverse_nudge, _arrays=arrays)
+
+    def save(self, path):
+        '''Write the surface, including its triangulation, to a .npz file.'''
+        np.savez(
+            path,
+            xy=self.xy,
+            elevations=self.elevations,
+            nudge=self.nudge,
+            inverse_nudge=self.inverse_nudge,
+            simplices=self.simplices,
+            neighbors=self.neighbors,
+            transform=self.transform,
+            vertex_simplex=self.vertex_simplex,
+            hull=np.asarray(self.hull.coords),
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Cheap to rebuild, and not picklable with all versions of scipy
+        state['_tree'] = None
+        state['hull'] = np.asarray(self.hull.coords)
+        return state
+
+    def __setstate__(self, state):
+        state['hull'] = LinearRing(state['hull'])
+        state.setdefault('inverse_nudge', False)
+        self.__dict__.update(state)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.xy)
+        return self._tree
+
+    def __call__(self, xs, ys):
+        '''Evaluate the surface at arrays of points, using the out-of-hull
+        fallbacks described above: every point gets an elevation.
+
+        :param xs: x coordinates.
+        :type xs: array of float
+        :param ys: y coordinates.
+        :type ys: array of float
+        :returns: numpy.ndarray of elevations.
+
+        '''
+        xy = np.column_stack([np.asarray(xs, dtype=float).reshape(-1),
+                              np.asarray(ys, dtype=float).reshape(-1)])
+        values = self.interpolate(xy[:, 0], xy[:, 1])
+
+        missed = np.flatnonzero(np.isnan(values))
+        if missed.size:
+            values[missed] = self.interpolate(*self._nudged(xy[missed]).T)
+
+        missed = missed[np.isnan(values[missed])]
+        if missed.size:
+            values[missed] = self.nearest(xy[missed, 0], xy[missed, 1])
+
+        return values
+
+    def interpolate(self, xs, ys):
+        '''Linearly interpolate elevations at arrays of points. Points outside
+        of the convex hull get NaN.
+
+        '''
+        xy = np.column_stack([np.asarray(xs, dtype=float).reshape(-1),
+                              np.asarray(ys, dtype=float).reshape(-1)])
+        values = np.full(xy.shape[0], np.nan)
+        if not xy.shape[0]:
+            return values
+
+        simplex, barycentric = self.find_simplices(xy)
+        inside = simplex >= 0
+        corners = self.elevations[self.simplices[simplex[inside]]]
+        values[inside] = (barycentric[inside] * corners).sum(axis=1)
+
+        return values
+
+    def nearest(self, xs, ys):
+        '''The elevation of the nearest point to each of arrays of points.'''
+        xy = np.column_stack([np.asarray(xs, dtype=float).reshape(-1),
+                              np.asarray(ys, dtype=float).reshape(-1)])
+        if not xy.shape[0]:
+            return np.empty(0)
+        _, idx = self.tree.query(xy)
+        return self.elevations[idx]
+
+    def find_simplices(self, xy, eps=1e-10):
+        '''Find the triangle containing each point by walking from a triangle
+        of its nearest vertex towards it. As the triangulation is Delaunay,
+        the walk always terminates.
+
+        :param xy: An (n, 2) array of points.
+        :type xy: numpy.ndarray
+        :param eps: Tolerance for barycentric coordinates.
+        :type eps: float
+        :returns: The index of the simplex containing each point (-1 if
+                  outside of the hull) and the points' (n, 3) barycentric
+                  coordinates within it.
+        :rtype: tuple of numpy.ndarray
+
+        '''
+        n = xy.shape[0]
+        _, vertex = self.tree.query(xy)
+        simplex = self.vertex_simplex[vertex]
+        # Vertices dropped from the triangulation (duplicates) have no simplex
+        simplex[simplex < 0] = 0
+        barycentric = np.zeros((n, 3))
+
+        active = np.arange(n)
+        for _ in range(self.simplices.shape[0] + 1):
+            if not active.size:
+                break
+            current = simplex[active]
+            coords = self._barycentric(current, xy[active])
+            barycentric[active] = coords
+
+            worst = np.argmin(coords, axis=1)
+            done = coords[np.arange(active.size), worst] >= -eps
+            # Cross the edge opposite the most negative coordinate. If there
+            # is no neighbour there, the point is outside of the hull.
+            step = self.neighbors[current[~done], worst[~done]]
+            moving = active[~done]
+            simplex[moving] = step
+            active = moving[step >= 0]
+
+        return simplex, barycentric
+
+    def _barycentric(self, simplices, xy):
+        transform = self.transform[simplices]
+        delta = xy - transform[:, 2]
+        c = np.einsum('nij,nj->ni', transform[:, :2], delta)
+        return np.column_stack([c, 1 - c.sum(axis=1)])
+
+    def _nudged(self, xy):
+        # Move points onto the hull, then `nudge` further inwards (divided by
+        # their distance to the hull, with inverse_nudge)
+        hull = [self.hull] * xy.shape[0]
+        on_hull = interpolate_points(hull,
+                                     project_points(hull, points(xy)))
+        on_hull = np.array([(p.x, p.y) for p in on_hull]).reshape(-1, 2)
+        direction = on_hull - xy
+        distance = np.sqrt((direction**2).sum(axis=1))[:, np.newaxis]
+        if self.inverse_nudge:
+            distance = distance**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            direction /= distance
+        direction[~np.isfinite(direction)] = 0
+        return on_hull + self.nudge * direction
+
+
+def endpoint_inclines(lines, surface, max_workers=1, tile_size=TILE_SIZE,
+                      store=None):
+    '''The incline of every line from its start to its end: the difference
+    between the surface's elevations at its end and start over its length.
+
+    With more than one worker, lines are processed in spatial tiles on a
+    process pool (see `tiling.map_tiles`). The result is the same. With a
+    `tiling.TileStore`, only the tiles whose lines changed since the last run
+    (or all of them, if the surface changed) are processed again.
+
+    :param lines: LineStrings, in the same CRS as the surface.
+    :type lines: geopandas.GeoSeries
+    :param surface: The elevation surface.
+    :type surface: ElevationSurface
+    :param max_workers: The number of processes. With None, the number of
+                        CPUs.
+    :type max_workers: int
+    :param tile_size: The width and height of tiles.
+    :type tile_size: float
+    :param store: The results of previous runs, by tile.
+    :type store: tiling.TileStore
+    :returns: numpy.ndarray of inclines.
+
+    '''
+    if max_workers != 1 or store is not None:
+        gdf = gpd.GeoDataFrame(
+            geometry=gpd.GeoSeries(lines).reset_index(drop=True)
+        )
+        inclines = map_tiles(_inclines_tile, gdf, tile_size=tile_size,
+                             max_workers=max_workers, store=store,
+                             surface=surface)
+        return inclines['incline'].values
+
+    coords, offsets = coordinate_arrays(lines)
+    starts = coords[offsets[:-1]]
+    ends = coords[offsets[1:] - 1]
+    rise = surface(ends[:, 0], ends[:, 1]) - surface(starts[:, 0],
+                                                     starts[:, 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return rise / line_lengths(lines)
+
+
+def _inclines_tile(lines, context, surface):
+    return pd.DataFrame({
+        'incline': endpoint_inclines(lines.geometry, surface),
+        ROW: lines[ROW].values,
+    })
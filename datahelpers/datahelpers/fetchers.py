@@ -1,11 +1,528 @@
-from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import hashlib
+import json
 import os
 import tempfile
+import threading
 import shutil
 from zipfile import ZipFile
 
+from esridump.esri2geojson import esri2geojson
 import geopandas as gpd
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+
+# The size of the chunks that downloads are streamed to disk in, in bytes
+CHUNKSIZE = 2**20
+
+# The default number of concurrent downloads
+MAX_WORKERS = 4
+
+# The largest number of features to request per page from ArcGIS REST layers.
+# Servers may limit this further (their maxRecordCount).
+ARCGIS_PAGE_SIZE = 1000
+
+# The number of attempts for each ArcGIS REST request
+ARCGIS_ATTEMPTS = 3
+
+
+class CacheMiss(Exception):
+    '''Raised in offline mode when a URL has not been downloaded before.'''
+
+
+class ArcGISError(Exception):
+    '''Raised when an ArcGIS REST request returns an error.'''
+
+
+class DownloadCache:
+    '''An on-disk cache of downloaded files. Downloads are streamed to disk
+    in chunks and stored by the SHA-256 of their content, with an index entry
+    per URL that records the content hash and the response's `ETag` and
+    `Last-Modified` headers. Cached URLs are revalidated with a conditional
+    request and only downloaded again if they changed. Interrupted downloads
+    are resumed with a range request, if the server still has the same
+    version of the file. Downloads of a URL are serialized across threads
+    and, with a lock file, across processes sharing the cache. Where file
+    locks aren't available, every process keeps its own partial downloads.
+
+    In offline mode, nothing is requested and only cached files are
+    returned: this rebuilds from cache only. The default cache (`cache`)
+    lives in the directory given by the `DATAHELPERS_CACHE` environment
+    variable (by default, ~/.cache/datahelpers) and is offline if
+    `DATAHELPERS_OFFLINE` is set to a non-empty value other than 0.
+
+    :param root: The cache directory.
+    :type root: str
+    :param offline: Whether to only use cached files.
+    :type offline: bool
+    :param session: The session to make requests with.
+    :type session: requests.Session
+    :param chunksize: The size of the chunks to stream downloads in, in bytes.
+    :type chunksize: int
+
+    '''
+    def __init__(self, root=None, offline=None, session=None,
+                 chunksize=CHUNKSIZE):
+        if root is None:
+            root = os.environ.get('DATAHELPERS_CACHE',
+                                  os.path.join('~', '.cache', 'datahelpers'))
+        if offline is None:
+            offline = os.environ.get('DATAHELPERS_OFFLINE', '') not in ('',
+                                                                        '0')
+        self.root = os.path.expanduser(root)
+        self.offline = offline
+        self.session = session
+        self.chunksize = chunksize
+        self.hits = 0
+        self.misses = 0
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, url):
+        '''Get the path to a cached copy of a URL, downloading it if it isn't
+        cached or has changed.
+
+        :param url: The URL to download.
+        :type url: str
+        :returns: The path to the cached file. Treat it as read-only.
+        :rtype: str
+
+        '''
+        with self._url_lock(url):
+            if self.offline:
+                entry = self._entry(url)
+                if not self._cached(entry):
+                    raise CacheMiss('{} is not cached'.format(url))
+                self.hits += 1
+                return self._blob_path(entry['sha256'])
+
+            with self._file_lock(url):
+                # Another process may have downloaded it while this one
+                # waited for the lock: the entry is only read now
+                entry = self._entry(url)
+                return self._download(url,
+                                      entry if self._cached(entry) else None)
+
+    def fetch_many(self, urls, max_workers=MAX_WORKERS):
+        '''Fetch many URLs concurrently: see `fetch`.
+
+        :param urls: The URLs to download.
+        :type urls: iterable of str
+        :param max_workers: The maximum number of concurrent downloads.
+        :type max_workers: int
+        :returns: The path to the cached copy of every URL, in the same order.
+        :rtype: list of str
+
+        '''
+        urls = list(urls)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.fetch, urls))
+
+    def _download(self, url, entry):
+        headers = {}
+        partial_path, partial_meta_path = self._partial_paths(url)
+        partial = _read_json(partial_meta_path)
+        offset = 0
+        if partial is not None and os.path.exists(partial_path):
+            # Resume, but only if the file hasn't changed on the server
+            validator = partial.get('etag') or partial.get('last_modified')
+            offset = os.path.getsize(partial_path)
+            if validator and offset:
+                headers['Range'] = 'bytes={}-'.format(offset)
+                headers['If-Range'] = validator
+        elif entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        session = self.session or requests
+        with session.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 416 and 'Range' in headers:
+                # The partial download can't be resumed: start over
+                os.remove(partial_path)
+                os.remove(partial_meta_path)
+                return self._download(url, entry)
+            if response.status_code == 304:
+                self.hits += 1
+                return self._blob_path(entry['sha256'])
+            response.raise_for_status()
+            self.misses += 1
+
+            validators = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+            os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+            if response.status_code == 206:
+                mode = 'ab'
+            else:
+                # A full response: the server ignored the range, or it's a
+                # new download
+                mode = 'wb'
+                _write_json(partial_meta_path, validators)
+
+            with open(partial_path, mode) as f:
+                for chunk in response.iter_content(self.chunksize):
+                    f.write(chunk)
+
+        sha256 = _file_sha256(partial_path, self.chunksize)
+        blob_path = self._blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(partial_path, blob_path)
+        os.remove(partial_meta_path)
+
+        entry = dict(validators, url=url, sha256=sha256)
+        if response.status_code == 206:
+            # Headers of a partial response describe the same version
+            entry = dict(partial, url=url, sha256=sha256)
+        _write_json(self._entry_path(url), entry)
+
+        return blob_path
+
+    def _entry(self, url):
+        return _read_json(self._entry_path(url))
+
+    def _cached(self, entry):
+        return entry is not None and os.path.exists(
+            self._blob_path(entry['sha256'])
+        )
+
+    def _entry_path(self, url):
+        return os.path.join(self.root, 'urls', _sha256(url) + '.json')
+
+    def _partial_paths(self, url):
+        base = os.path.join(self.root, 'partial', _sha256(url))
+        if fcntl is None:
+            base = '{}.{}'.format(base, os.getpid())
+        return base + '.part', base + '.json'
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.root, 'blobs', sha256[:2], sha256)
+
+    def _url_lock(self, url):
+        # Only one thread downloads a given URL at a time
+        with self._lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    @contextmanager
+    def _file_lock(self, url):
+        # Only one process downloads a given URL at a time. The lock is
+        # released when the file is closed, even if the process dies.
+        if fcntl is None:
+            yield
+            return
+        path = os.path.join(self.root, 'locks', _sha256(url) + '.lock')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+
+cache = DownloadCache()
+
+
+def fetch_file(url, destination, cache=cache):
+    '''Download a file (through the download cache) to a destination path.
+
+    :param url: The URL to download.
+    :type url: str
+    :param destination: The path to copy the file to.
+    :type destination: str
+    :param cache: The download cache to use.
+    :type cache: DownloadCache
+
+    '''
+    shutil.copyfile(cache.fetch(url), destination)
+
+
+def extract(archive_path, member, destination):
+    '''Extract a single file or directory (and its contents) from a zip
+    archive, streaming it straight from the archive on disk.
+
+    :param archive_path: The path to the zip archive.
+    :type archive_path: str
+    :param member: The path of the file or directory in the archive.
+    :type member: str
+    :param destination: The path to extract the file or directory to.
+    :type destination: str
+
+    '''
+    member = member.rstrip('/')
+    with ZipFile(archive_path) as archive:
+        names = archive.namelist()
+        if member in names:
+            matches = [(member, destination)]
+        else:
+            prefix = member + '/'
+            matches = [
+                (name, os.path.join(destination, name[len(prefix):]))
+                for name in names
+                if name.startswith(prefix) and not name.endswith('/')
+            ]
+        if not matches:
+            raise Exception('Could not find matching files in zip archive.')
+
+        for name, path in matches:
+            parent = os.path.dirname(path)
+            if parent:
+                os.makedirs(parent, exist_ok=True)
+            with archive.open(name) as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNKSIZE)
+
+
+def fetch_arcgis_layer(url, destination, fields=None, where='1=1',
+                       extra_query_args=None, keep=None, incremental=True,
+                       page_size=ARCGIS_PAGE_SIZE, max_workers=MAX_WORKERS,
+                       cache=cache):
+    '''Download the features of an ArcGIS REST (FeatureServer or MapServer)
+    layer as a GeoJSON FeatureCollection in WGS84. The layer's object IDs are
+    listed first and then requested in pages over a pool of concurrent
+    connections. Pages are streamed to disk in order as they arrive.
+
+    Every download is kept as a snapshot in the download cache. If the layer
+    records edit dates (editor tracking) and `incremental` is set, later
+    downloads only request features that were edited since the snapshot was
+    taken. Deleted features are dropped from the snapshot. In offline mode,
+    the snapshot is used as-is.
+
+    :param url: The URL of the layer, e.g. .../MapServer/2.
+    :type url: str
+    :param destination: The path to write the GeoJSON to.
+    :type destination: str
+    :param fields: The fields to download. The object ID field is always
+                   included. Defaults to all fields.
+    :type fields: list of str
+    :param where: A where clause to filter features.
+    :type where: str
+    :param extra_query_args: Additional arguments for every query request.
+    :type extra_query_args: dict
+    :param keep: If set, only features (GeoJSON dicts) for which this
+                 returns True are written to `destination`. The snapshot
+                 keeps every feature, so it can be shared by calls with
+                 different filters.
+    :type keep: callable
+    :param incremental: Whether to only request edited features when
+                        possible.
+    :type incremental: bool
+    :param page_size: The maximum number of features per request.
+    :type page_size: int
+    :param max_workers: The maximum number of concurrent requests.
+    :type max_workers: int
+    :param cache: The download cache to store snapshots in.
+    :type cache: DownloadCache
+    :returns: The number of features written.
+    :rtype: int
+
+    '''
+    key = _sha256(json.dumps([url, fields, where, extra_query_args],
+                             sort_keys=True))
+    snapshot_path = os.path.join(cache.root, 'arcgis', key + '.geojson')
+    state_path = os.path.join(cache.root, 'arcgis', key + '.json')
+    state = _read_json(state_path)
+    if not os.path.exists(snapshot_path):
+        state = None
+
+    if cache.offline:
+        if state is None:
+            raise CacheMiss('{} is not cached'.format(url))
+        return _copy_snapshot(snapshot_path, destination, keep,
+                              state['count'])
+
+    session = cache.session
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    layer = _ArcGISLayer(session, url, extra_query_args)
+
+    metadata = layer.request('', {'f': 'json'}, method='GET')
+    oid_field = metadata.get('objectIdField')
+    if oid_field is None:
+        for field in metadata.get('fields', []):
+            if field.get('type') == 'esriFieldTypeOID':
+                oid_field = field['name']
+                break
+    if oid_field is None:
+        raise ArcGISError('Could not find the object ID field of ' + url)
+    edit_field = (metadata.get('editFieldsInfo') or {}).get('editDateField')
+    page_size = min(page_size, metadata.get('maxRecordCount') or page_size)
+
+    if fields is not None and oid_field not in fields:
+        fields = [oid_field] + list(fields)
+    out_fields = ','.join(fields or ['*'])
+
+    # The latest edit is recorded before downloading, so that any edits made
+    # during the download are requested again next time.
+    last_edit = layer.last_edit(edit_field, where) if edit_field else None
+
+    oids = layer.object_ids(where)
+    if (incremental and state is not None and edit_field and
+            state.get('edit_field') == edit_field and
+            state.get('last_edit') is not None):
+        since = datetime.fromtimestamp(state['last_edit'] // 1000,
+                                       tz=timezone.utc)
+        edited = layer.object_ids(
+            "({}) AND {} >= timestamp '{}'".format(
+                where, edit_field, since.strftime('%Y-%m-%d %H:%M:%S')
+            )
+        )
+        current = set(oids)
+        replaced = set(edited)
+        previous = (f for f in _read_features(snapshot_path)
+                    if f['properties'].get(oid_field) in current and
+                    f['properties'].get(oid_field) not in replaced)
+        oids = edited
+    else:
+        previous = iter([])
+
+    pages = [oids[i:i + page_size] for i in range(0, len(oids), page_size)]
+
+    def fetch_page(page):
+        data = layer.request('/query', {
+            'objectIds': ','.join(str(oid) for oid in page),
+            'geometryPrecision': 7,
+            'returnGeometry': 'true',
+            'outSR': 4326,
+            'outFields': out_fields,
+            'f': 'json',
+        })
+        return [esri2geojson(feature) for feature in data.get('features', [])]
+
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(snapshot_path, os.getpid())
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloaded = (feature
+                      for page in _ordered_map(executor, fetch_page, pages,
+                                               2 * max_workers)
+                      for feature in page)
+        features = (f for source in (previous, downloaded) for f in source)
+        count = _write_features(tmp_path, features)
+    os.replace(tmp_path, snapshot_path)
+
+    _write_json(state_path, {
+        'url': url,
+        'edit_field': edit_field,
+        'last_edit': last_edit,
+        'count': count,
+    })
+
+    return _copy_snapshot(snapshot_path, destination, keep, count)
+
+
+def _copy_snapshot(snapshot_path, destination, keep, count):
+    # Copy a layer's snapshot to its destination, filtering its features if
+    # needed. Returns the number of features written.
+    if keep is None:
+        shutil.copyfile(snapshot_path, destination)
+        return count
+    features = (f for f in _read_features(snapshot_path) if keep(f))
+    return _write_features(destination, features)
+
+
+class _ArcGISLayer:
+    def __init__(self, session, url, extra_query_args=None):
+        self.session = session
+        self.url = url.rstrip('/')
+        self.extra_query_args = extra_query_args or {}
+
+    def request(self, path, params, method='POST'):
+        if path == '/query':
+            params = dict(self.extra_query_args, **params)
+        for attempt in range(ARCGIS_ATTEMPTS):
+            try:
+                if method == 'GET':
+                    response = self.session.get(self.url + path,
+                                                params=params)
+                else:
+                    response = self.session.post(self.url + path, data=params)
+                response.raise_for_status()
+                data = response.json()
+                break
+            except (requests.RequestException, ValueError):
+                if attempt == ARCGIS_ATTEMPTS - 1:
+                    raise
+        if 'error' in data:
+            raise ArcGISError('{}{}: {}'.format(self.url, path,
+                                                data['error']))
+        return data
+
+    def object_ids(self, where):
+        data = self.request('/query', {
+            'where': where,
+            'returnIdsOnly': 'true',
+            'f': 'json',
+        })
+        return sorted(data.get('objectIds') or [])
+
+    def last_edit(self, edit_field, where):
+        # The latest edit date, in milliseconds since the epoch
+        try:
+            data = self.request('/query', {
+                'where': where,
+                'outStatistics': json.dumps([{
+                    'statisticType': 'max',
+                    'onStatisticField': edit_field,
+                    'outStatisticFieldName': 'last_edit',
+                }]),
+                'f': 'json',
+            })
+            features = data.get('features') or []
+            attributes = features[0]['attributes'] if features else {}
+            # Some servers change the case of the output field
+            values = [v for k, v in attributes.items()
+                      if k.lower() == 'last_edit']
+            return values[0] if values else None
+        except ArcGISError:
+            # Statistics aren't supported: incremental updates aren't either
+            return None
+
+
+def _ordered_map(executor, fn, items, window):
+    # executor.map, but with at most `window` items in flight at a time
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _write_features(path, features):
+    # Write a FeatureCollection with one feature per line, so that it can be
+    # read back one feature at a time by `_read_features`.
+    count = 0
+    with open(path, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for feature in features:
+            if count:
+                f.write(',\n')
+            f.write(json.dumps(feature))
+            count += 1
+        f.write('\n]}\n')
+    return count
+
+
+def _read_features(path):
+    with open(path) as f:
+        # Skip the FeatureCollection's opening line
+        next(f, None)
+        for line in f:
+            line = line.strip().rstrip(',')
+            if line.startswith('{'):
+                yield json.loads(line)
 
 
 def fetch_shapefile(url, unzipped_path, bounds=None):
@@ -48,17 +565,38 @@ def fetch_gdb(url, expanded_path, destination, bounds=None):
     return gdf
 
 
-def fetch_and_unzip(url, expanded_path, destination):
-    response = requests.get(url)
-    tempdir = tempfile.mkdtemp()
+def fetch_and_unzip(url, expanded_path, destination, cache=cache):
+    '''Download a zip archive (through the download cache) and extract one
+    file or directory from it: see `extract`.
+
+    '''
+    extract(cache.fetch(url), expanded_path, destination)
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _file_sha256(path, chunksize=CHUNKSIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_json(path):
     try:
-        archive = ZipFile(BytesIO(response.content))
-        archive.extractall(tempdir)
-        unzipped_path = os.path.join(tempdir, expanded_path)
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-        if not os.path.exists(unzipped_path):
-            raise Exception('Could not find matching files in zip archive.')
 
-        shutil.move(unzipped_path, destination)
-    finally:
-        shutil.rmtree(tempdir)
+def _write_json(path, data):
+    # Write atomically, so that an interrupted write can't corrupt the index
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
@@ -1,4 +1,45 @@
-from shapely.geometry import LineString, Point
+import math
+
+import geopandas as gpd
+import numpy as np
+from shapely import wkb
+from shapely.geometry import LineString, Point, box
+
+from .instrumentation import timed
+
+try:
+    # shapely >= 2.0 has vectorized (array) functions
+    from shapely import get_coordinates, reverse
+    from shapely import box as _boxes
+    from shapely import distance as _distance
+    from shapely import from_wkb as _from_wkb
+    from shapely import intersection as _intersection
+    from shapely import length as _length
+    from shapely import line_interpolate_point as _line_interpolate_point
+    from shapely import line_locate_point as _line_locate_point
+    from shapely import linestrings as _linestrings
+    from shapely import points as _points
+    from shapely import to_wkb as _to_wkb
+except ImportError:
+    get_coordinates = None
+    reverse = None
+    _boxes = None
+    _distance = None
+    _from_wkb = None
+    _intersection = None
+    _length = None
+    _line_interpolate_point = None
+    _line_locate_point = None
+    _linestrings = None
+    _points = None
+    _to_wkb = None
+
+try:
+    # shapely >= 2.0 finds the nearest geometries in bulk
+    from shapely import STRtree as _STRtree
+    _STRtree.query_nearest
+except (ImportError, AttributeError):
+    _STRtree = None
 
 
 # def cut(line, distance):
@@ -65,3 +106,419 @@ def point_distance(p1, p2):
     dy = (p2[1] - p1[1])
 
     return (dx**2 + dy**2)**0.5
+
+
+def cut_many(line, distances):
+    '''Cut a line at multiple distances from its starting point in a single
+    pass. Equivalent to repeatedly calling `cut`, starting from the largest
+    distance, but the cumulative length along the line is only calculated
+    once.
+
+    Distances outside of the line (<= 0 or >= its length) are ignored, as are
+    repeated distances. As with `cut`, a distance that lands exactly on a
+    vertex splits the line at that vertex.
+
+    :param line: The line to cut.
+    :type line: shapely.geometry.LineString
+    :param distances: Distances along the line at which to cut it, in any
+                      order.
+    :type distances: iterable of float
+    :returns: The pieces of the line, in order from its starting point.
+    :rtype: list of shapely.geometry.LineString
+
+    '''
+    coords = np.asarray(line.coords)
+    return _cut_coords(line, coords, _cumulative_lengths(coords), line.length,
+                       distances)
+
+
+def cut_lines(lines, distances):
+    '''Bulk version of `cut_many`: cut each of many (2D) lines at its own set
+    of distances. The coordinates and segment lengths of all lines are
+    extracted and calculated at once.
+
+    :param lines: The lines to cut, e.g. a GeoSeries.
+    :type lines: iterable of shapely.geometry.LineString
+    :param distances: For each line, the distances at which to cut it.
+    :type distances: iterable of iterables of float
+    :returns: For each line, the pieces of the line.
+    :rtype: list of lists of shapely.geometry.LineString
+
+    '''
+    lines = list(lines)
+    coords, offsets = coordinate_arrays(lines)
+    lengths = [line.length for line in lines]
+
+    pieces = []
+    for line, start, end, length, line_distances in zip(lines, offsets[:-1],
+                                                        offsets[1:], lengths,
+                                                        distances):
+        if not len(line_distances):
+            # Nothing to cut: keep the line as-is
+            pieces.append([line])
+            continue
+        line_coords = coords[start:end]
+        pieces.append(_cut_coords(line, line_coords,
+                                  _cumulative_lengths(line_coords), length,
+                                  line_distances))
+
+    return pieces
+
+
+def _cumulative_lengths(coords):
+    # Distance along the line to every vertex, accumulated in the same order
+    # and with the same `point_distance` as in `cut` so that the results are
+    # identical: numpy's square root can differ from ** 0.5 in the last bit.
+    xy = coords[:, :2].tolist()
+    cumulative = np.zeros(coords.shape[0])
+    np.cumsum([point_distance(p1, p2) for p1, p2 in zip(xy[:-1], xy[1:])],
+              out=cumulative[1:])
+    return cumulative
+
+
+def _cut_coords(line, coords, cumulative, length, distances):
+    # Typically only a handful of distances: plain Python is fastest
+    distances = sorted(set(d for d in map(float, distances)
+                           if 0.0 < d < length))
+    if not distances:
+        return [LineString(coords)]
+    distances = np.array(distances)
+
+    # For each distance, the first vertex that is at least that far along
+    vertices = np.searchsorted(cumulative, distances, side='left')
+    # See `cut`: a floating point gap between the summed segment lengths and
+    # the line's length means the distance is past the last vertex - assume
+    # it's between the second to last and last point.
+    last = coords.shape[0] - 1
+    vertices = np.minimum(vertices, last)
+    exact = cumulative[vertices] == distances
+
+    # Cut points between vertices are interpolated by GEOS, as in `cut`, on
+    # the line as cut so far from its far end: a cut on the same segment as
+    # the previous one is on the shortened segment.
+    vertex_list = coords.tolist()
+    vertices = vertices.tolist()
+    exact = exact.tolist()
+    points = [None] * len(distances)
+    previous = None
+    for k in range(len(distances) - 1, -1, -1):
+        if exact[k]:
+            previous = None
+            continue
+        i = vertices[k]
+        if previous is not None and vertices[previous] == i:
+            prefix = LineString(vertex_list[:i] + [points[previous]])
+        else:
+            prefix = line
+        point = prefix.interpolate(distances[k])
+        points[k] = [point.x, point.y]
+        previous = k
+
+    pieces = []
+    head = []
+    start = 0
+    for i, is_exact, point in zip(vertices, exact, points):
+        if is_exact:
+            # Split at the vertex: both pieces share it
+            pieces.append(LineString(head + vertex_list[start:i + 1]))
+            head = []
+        else:
+            pieces.append(LineString(head + vertex_list[start:i] + [point]))
+            head = [point]
+        start = i
+    pieces.append(LineString(head + vertex_list[start:]))
+
+    return pieces
+
+
+def coordinate_arrays(geometries):
+    '''Extract the (2D) coordinates of a sequence of LineStrings and/or Points
+    into a single flat array, along with offsets describing which rows belong
+    to which geometry: the coordinates of geometry i are
+    coords[offsets[i]:offsets[i + 1]].
+
+    :param geometries: LineString and/or Point geometries, e.g. a GeoSeries.
+    :type geometries: iterable of shapely geometries
+    :returns: an (n, 2) array of coordinates and an array of offsets with one
+              more entry than there are geometries.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    # Note: kept as a list - shapely 1.x geometries expose the numpy array
+    # interface, so a numpy object array would get 'unpacked' into coordinates
+    geometries = list(geometries)
+    if get_coordinates is not None:
+        coords, index = get_coordinates(geometries, return_index=True)
+        counts = np.bincount(index, minlength=len(geometries))
+    else:
+        arrays = [_coords_2d(g) for g in geometries]
+        counts = np.array([len(a) for a in arrays], dtype=int)
+        if arrays:
+            coords = np.concatenate(arrays)
+        else:
+            coords = np.empty((0, 2))
+
+    offsets = np.zeros(len(geometries) + 1, dtype=int)
+    np.cumsum(counts, out=offsets[1:])
+
+    return coords, offsets
+
+
+def reverse_lines(lines):
+    '''Reverse the coordinate order of a sequence of LineStrings.
+
+    :param lines: LineStrings, e.g. a GeoSeries.
+    :type lines: iterable of shapely.geometry.LineString
+    :returns: list of shapely.geometry.LineString
+
+    '''
+    lines = list(lines)
+    if reverse is not None:
+        return list(reverse(lines))
+    return [LineString(list(reversed(line.coords))) for line in lines]
+
+
+def _coords_2d(geometry):
+    if geometry is None or geometry.is_empty:
+        return np.empty((0, 2))
+    return np.asarray(geometry.coords)[:, :2]
+
+
+def points(coords):
+    '''Create Points from an (n, 2) array of coordinates.
+
+    :returns: list of shapely.geometry.Point
+
+    '''
+    coords = np.asarray(coords, dtype=float)
+    if _points is not None:
+        return list(_points(coords))
+    return [Point(xy) for xy in coords.tolist()]
+
+
+def lines(coords, offsets):
+    '''Create LineStrings from a flat (n, 2) array of coordinates and offsets
+    into it, as returned by `coordinate_arrays`: line i has the coordinates
+    coords[offsets[i]:offsets[i + 1]].
+
+    :returns: list of shapely.geometry.LineString
+
+    '''
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=int)
+    if _linestrings is not None:
+        counts = np.diff(offsets)
+        index = np.repeat(np.arange(counts.shape[0]), counts)
+        return list(_linestrings(coords[offsets[0]:offsets[-1]],
+                                 indices=index))
+    return [LineString(coords[start:end].tolist()) for start, end
+            in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def boxes(bounds):
+    '''Create rectangular Polygons from an (n, 4) array of bounds, each row
+    in (minx, miny, maxx, maxy) order, e.g. the `bounds` of a GeoSeries.
+
+    :returns: list of shapely.geometry.Polygon
+
+    '''
+    bounds = np.asarray(bounds, dtype=float)
+    if _boxes is not None:
+        return list(_boxes(bounds[:, 0], bounds[:, 1], bounds[:, 2],
+                           bounds[:, 3]))
+    return [box(*b) for b in bounds.tolist()]
+
+
+def pairwise_distances(geometries1, geometries2):
+    '''The distance between each geometry in geometries1 and the geometry
+    at the same position in geometries2.
+
+    :returns: numpy.ndarray of float
+
+    '''
+    geometries1 = list(geometries1)
+    geometries2 = list(geometries2)
+    if _distance is not None:
+        return np.asarray(_distance(geometries1, geometries2), dtype=float)
+    return np.array([g1.distance(g2) for g1, g2
+                     in zip(geometries1, geometries2)], dtype=float)
+
+
+def line_lengths(lines):
+    '''The length of every line, i.e. the vectorized `line.length`. Missing
+    lines give NaN.
+
+    :returns: numpy.ndarray of float
+
+    '''
+    lines = list(lines)
+    if _length is not None:
+        return np.asarray(_length(lines), dtype=float)
+    return np.array([np.nan if line is None else line.length
+                     for line in lines], dtype=float)
+
+
+def to_wkb(geometries):
+    '''The WKB of every geometry, i.e. the vectorized `geometry.wkb`. Missing
+    geometries give None.
+
+    :returns: list of bytes
+
+    '''
+    if _to_wkb is not None:
+        # Geometry arrays (e.g. a GeoSeries' values) convert without a copy
+        return list(_to_wkb(np.asarray(geometries, dtype=object)))
+    return [None if g is None else g.wkb for g in geometries]
+
+
+def from_wkb(values):
+    '''Geometries from their WKB, i.e. the vectorized `shapely.wkb.loads`.
+
+    :returns: list of shapely geometries
+
+    '''
+    values = list(values)
+    if _from_wkb is not None:
+        return list(_from_wkb(np.array(values, dtype=object)))
+    return [wkb.loads(bytes(value)) for value in values]
+
+
+def project_points(lines, points):
+    '''The distance along each line to the point on it closest to the point
+    at the same position in points, i.e. the vectorized `line.project(point)`.
+
+    :returns: numpy.ndarray of float
+
+    '''
+    lines = list(lines)
+    points = list(points)
+    if _line_locate_point is not None:
+        return np.asarray(_line_locate_point(lines, points), dtype=float)
+    return np.array([line.project(point) for line, point
+                     in zip(lines, points)], dtype=float)
+
+
+def interpolate_points(lines, distances):
+    '''The point at each distance along the line at the same position in
+    lines, i.e. the vectorized `line.interpolate(distance)`.
+
+    :returns: list of shapely.geometry.Point
+
+    '''
+    lines = list(lines)
+    distances = np.asarray(distances, dtype=float)
+    if _line_interpolate_point is not None:
+        return list(_line_interpolate_point(lines, distances))
+    return [line.interpolate(distance) for line, distance
+            in zip(lines, distances.tolist())]
+
+
+def pairwise_intersections(geometries1, geometries2):
+    '''The intersection of each geometry in geometries1 with the geometry at
+    the same position in geometries2.
+
+    :returns: list of shapely geometries
+
+    '''
+    geometries1 = list(geometries1)
+    geometries2 = list(geometries2)
+    if _intersection is not None:
+        return list(_intersection(geometries1, geometries2))
+    return [g1.intersection(g2) for g1, g2 in zip(geometries1, geometries2)]
+
+
+@timed
+def query_bulk(sindex, geometries):
+    '''Query a GeoDataFrame's spatial index with many geometries at once,
+    returning every pair whose bounding boxes intersect.
+
+    :param sindex: The spatial index, i.e. the `sindex` of a GeoDataFrame or
+                   GeoSeries.
+    :param geometries: The query geometries.
+    :type geometries: geopandas.GeoSeries
+    :returns: A (2, n) array: positions in geometries and the matching
+              positions in the indexed GeoDataFrame.
+    :rtype: numpy.ndarray
+
+    '''
+    if not len(geometries):
+        return np.empty((2, 0), dtype=int)
+    query_bulk = getattr(sindex, 'query_bulk', None)
+    if query_bulk is not None:
+        # geopandas < 1.0
+        return query_bulk(geometries)
+    return sindex.query(geometries)
+
+
+@timed
+def query_nearest(geometries, targets, max_distance=None):
+    '''Find the nearest target to every geometry, in one bulk query of a
+    spatial index of the targets. Ties go to the first target.
+
+    :param geometries: The geometries to find targets for, e.g. Points.
+    :type geometries: list of shapely geometries
+    :param targets: The geometries to search, e.g. LineStrings.
+    :type targets: list of shapely geometries
+    :param max_distance: If set, targets farther than this are not found.
+    :type max_distance: float
+    :returns: The position of the nearest target to every geometry (-1 if
+              none was found) and the distance to it (inf if none).
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    geometries = list(geometries)
+    targets = list(targets)
+    nearest = np.full(len(geometries), -1, dtype=int)
+    distances = np.full(len(geometries), np.inf)
+    if not geometries or not targets:
+        return nearest, distances
+
+    if _STRtree is not None:
+        tree = _STRtree(np.asarray(targets, dtype=object))
+        (i, j), d = tree.query_nearest(np.asarray(geometries, dtype=object),
+                                       max_distance=max_distance,
+                                       return_distance=True)
+        _keep_nearest(nearest, distances, i, j, d)
+        return nearest, distances
+
+    # Query boxes around the geometries, growing those of the geometries
+    # whose nearest target may be outside of their box. A target within the
+    # box's radius always intersects it.
+    sindex = gpd.GeoSeries(targets).sindex
+    bounds = np.array([g.bounds for g in geometries], dtype=float)
+    if max_distance is not None:
+        radius = float(max_distance)
+    else:
+        minx, miny, maxx, maxy = gpd.GeoSeries(targets).total_bounds
+        radius = max(maxx - minx, maxy - miny, 1.0) / \
+            math.sqrt(len(targets))
+    todo = np.arange(len(geometries))
+    while todo.shape[0]:
+        expand = np.array([-radius, -radius, radius, radius])
+        i, j = query_bulk(sindex, gpd.GeoSeries(boxes(bounds[todo] +
+                                                      expand)))
+        i = todo[i]
+        d = pairwise_distances([geometries[k] for k in i],
+                               [targets[k] for k in j])
+        _keep_nearest(nearest, distances, i, j, d)
+        if max_distance is not None:
+            nearest[distances > max_distance] = -1
+            distances[distances > max_distance] = np.inf
+            break
+        todo = todo[distances[todo] > radius]
+        radius *= 2
+
+    return nearest, distances
+
+
+def _keep_nearest(nearest, distances, i, j, d):
+    # For every geometry in i, the target in j at the smallest distance d,
+    # the first of them if there's a tie
+    if not i.shape[0]:
+        return
+    order = np.lexsort((j, d, i))
+    i = i[order]
+    first = np.ones(i.shape[0], dtype=bool)
+    first[1:] = i[1:] != i[:-1]
+    nearest[i[first]] = j[order][first]
+    distances[i[first]] = d[order][first]
@@ -0,0 +1,377 @@
+from itertools import chain
+import json
+import math
+import struct
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import shape
+
+from .geometry import from_wkb, to_wkb
+from .instrumentation import count, timed
+from .io import CHUNKSIZE, iter_features
+from .spatial_index import hilbert_values
+
+
+MAGIC = b'DHGRAPH1'
+
+# magic, number of nodes, number of edges, length of the JSON metadata
+HEADER = struct.Struct('<8sQQQ')
+
+# Sections start at multiples of this many bytes (relative to a page-aligned
+# memory map), so they can be viewed as arrays in place
+ALIGNMENT = 8
+
+# Decimal places that endpoint coordinates are rounded to for them to be
+# the same node. 7 is about 1 cm for lon-lat.
+PRECISION = 7
+
+# Edge attributes exported by default, from the transportation schema
+COLUMNS = ('length', 'incline', 'footway', 'curbramps')
+
+WGS84 = 4326
+
+# The arrays of every graph, in file order, and their dtypes
+SECTIONS = (
+    ('node_xy', '<f8'),
+    ('indptr', '<i8'),
+    ('indices', '<u4'),
+    ('arc_edges', '<u4'),
+    ('arc_forward', '|b1'),
+    ('edge_u', '<u4'),
+    ('edge_v', '<u4'),
+    ('wkb_offsets', '<i8'),
+    ('wkb', '|u1'),
+)
+
+# Node and edge ids are stored as uint32
+MAX_ID = 2**32 - 1
+
+
+class RoutableGraph:
+    '''A pedestrian network as a compact, array-backed graph that can be
+    saved to a single file and memory-mapped back, so that routers can load
+    it without parsing GeoJSON or re-noding anything.
+
+    Nodes are the distinct (rounded) endpoints of the network's lines,
+    numbered along a Hilbert curve so that nearby nodes are near each other
+    in memory, and edges are the lines, in input order. Every edge can be
+    walked both ways, so it has two arcs: forward from its first node (`u`)
+    to its last (`v`), and back. Arcs are stored in compressed sparse row
+    (CSR) form: the arcs leaving node `n` are at positions
+    `indptr[n]:indptr[n + 1]` of `indices` (their target nodes), `arc_edges`
+    and `arc_forward`.
+
+    Edge attributes are stored column by column: numbers as float64 (NaN
+    when missing) and text as int32 codes into a list of categories (-1 when
+    missing). Edge `e`'s geometry is the WKB at
+    `wkb[wkb_offsets[e]:wkb_offsets[e + 1]]`.
+
+    :param arrays: The arrays of the graph, by name (see SECTIONS).
+    :type arrays: dict of numpy.ndarray
+    :param columns: Edge attributes, by name.
+    :type columns: dict of numpy.ndarray
+    :param categories: For text columns, the text of each code.
+    :type categories: dict of list of str
+    :param precision: The rounding precision of nodes.
+    :type precision: int
+
+    '''
+    def __init__(self, arrays, columns, categories=None, precision=PRECISION):
+        self.node_xy = arrays['node_xy']
+        self.indptr = arrays['indptr']
+        self.indices = arrays['indices']
+        self.arc_edges = arrays['arc_edges']
+        self.arc_forward = arrays['arc_forward']
+        self.edge_u = arrays['edge_u']
+        self.edge_v = arrays['edge_v']
+        self.wkb_offsets = arrays['wkb_offsets']
+        self.wkb = arrays['wkb']
+        self.columns = columns
+        self.categories = categories or {}
+        self.precision = precision
+
+    @classmethod
+    def from_features(cls, features, columns=COLUMNS, precision=PRECISION):
+        '''Build a graph from GeoJSON features (dicts), e.g. those of
+        `transportation.geojson`. Features are read one at a time and only
+        their endpoints, WKB and exported properties are kept. Features that
+        aren't LineStrings of at least two positions are skipped.
+
+        :param features: GeoJSON LineString features.
+        :type features: iterable of dict
+        :param columns: The properties to keep as edge attributes. Missing
+                        properties are NaN (numbers) or None (text).
+        :type columns: list of str
+        :param precision: The number of decimal places to round endpoints to
+                          for them to be the same node.
+        :type precision: int
+
+        '''
+        firsts = []
+        lasts = []
+        values = {column: [] for column in columns}
+        wkbs = []
+        pending = []
+        skipped = 0
+        for feature in features:
+            geometry = feature.get('geometry')
+            if geometry is None or geometry['type'] != 'LineString' or \
+                    len(geometry['coordinates']) < 2:
+                skipped += 1
+                continue
+            coordinates = geometry['coordinates']
+            firsts.append(coordinates[0][:2])
+            lasts.append(coordinates[-1][:2])
+            properties = feature.get('properties') or {}
+            for column in columns:
+                values[column].append(properties.get(column))
+            pending.append(shape(geometry))
+            if len(pending) == CHUNKSIZE:
+                wkbs.extend(to_wkb(pending))
+                pending = []
+        wkbs.extend(to_wkb(pending))
+        count('graph.features_skipped', skipped)
+
+        m = len(wkbs)
+        if m > MAX_ID:
+            raise ValueError('Too many edges: {}'.format(m))
+
+        # Nodes: distinct rounded endpoints, numbered along a Hilbert curve
+        ends = np.array(firsts + lasts, dtype=float).reshape(-1, 2)
+        keys = np.rint(ends * 10.0**precision).astype(np.int64)
+        _, first_seen, inverse = np.unique(keys, axis=0, return_index=True,
+                                           return_inverse=True)
+        node_xy = ends[first_seen]
+        order = np.argsort(hilbert_values(np.hstack([node_xy, node_xy])),
+                           kind='mergesort')
+        node_xy = node_xy[order]
+        n = node_xy.shape[0]
+        if n > MAX_ID:
+            raise ValueError('Too many nodes: {}'.format(n))
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n)
+        node_ids = rank[inverse.reshape(-1)]
+        edge_u = node_ids[:m]
+        edge_v = node_ids[m:]
+
+        # Arcs, grouped by the node they leave
+        sources = np.concatenate([edge_u, edge_v])
+        arc_order = np.argsort(sources, kind='mergesort')
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=n), out=indptr[1:])
+
+        lengths = np.array([len(value) for value in wkbs], dtype=np.int64)
+        wkb_offsets = np.zeros(m + 1, dtype=np.int64)
+        np.cumsum(lengths, out=wkb_offsets[1:])
+
+        arrays = {
+            'node_xy': node_xy,
+            'indptr': indptr,
+            'indices': np.concatenate([edge_v, edge_u])[arc_order],
+            'arc_edges': np.tile(np.arange(m), 2)[arc_order],
+            'arc_forward': np.repeat([True, False], m)[arc_order],
+            'edge_u': edge_u,
+            'edge_v': edge_v,
+            'wkb_offsets': wkb_offsets,
+            'wkb': np.frombuffer(b''.join(wkbs), dtype=np.uint8),
+        }
+        arrays = {name: np.ascontiguousarray(arrays[name], dtype=dtype)
+                  for name, dtype in SECTIONS}
+
+        edge_columns = {}
+        categories = {}
+        for column in columns:
+            edge_columns[column], column_categories = _encode(values[column])
+            if column_categories is not None:
+                categories[column] = column_categories
+
+        return cls(arrays, edge_columns, categories=categories,
+                   precision=precision)
+
+    @classmethod
+    def load(cls, path):
+        '''Memory-map a graph written by `save`. Only the header and metadata
+        are read: arrays are read from disk as they are used.
+
+        '''
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, _, _, metadata_size = HEADER.unpack(
+            bytes(data[:HEADER.size])
+        )
+        if magic != MAGIC:
+            raise ValueError('{} is not a routable graph'.format(path))
+        end = HEADER.size + metadata_size
+        metadata = json.loads(bytes(data[HEADER.size:end]).decode('utf-8'))
+        start = _aligned(end)
+
+        def view(section):
+            dtype = np.dtype(section['dtype'])
+            shape = tuple(section['shape'])
+            offset = start + section['offset']
+            size = dtype.itemsize * int(np.prod(shape))
+            return data[offset:offset + size].view(dtype).reshape(shape)
+
+        arrays = {section['name']: view(section)
+                  for section in metadata['sections']}
+        columns = {}
+        categories = {}
+        for column in metadata['columns']:
+            columns[column['name']] = view(column)
+            if column.get('categories') is not None:
+                categories[column['name']] = column['categories']
+
+        return cls(arrays, columns, categories=categories,
+                   precision=metadata['precision'])
+
+    def save(self, path):
+        '''Write the graph to a file: a header, JSON metadata describing the
+        arrays, then the arrays themselves.
+
+        '''
+        entries = []
+        offset = 0
+        sections = []
+        for name, dtype in SECTIONS:
+            array = np.ascontiguousarray(getattr(self, name), dtype=dtype)
+            entry = {'name': name, 'dtype': dtype, 'shape': array.shape,
+                     'offset': offset}
+            sections.append(entry)
+            entries.append((entry, array))
+            offset = _aligned(offset + array.nbytes)
+        columns = []
+        for name, values in self.columns.items():
+            array = np.ascontiguousarray(values)
+            entry = {'name': name, 'dtype': array.dtype.str,
+                     'shape': array.shape, 'offset': offset,
+                     'categories': self.categories.get(name)}
+            columns.append(entry)
+            entries.append((entry, array))
+            offset = _aligned(offset + array.nbytes)
+
+        metadata = json.dumps({
+            'precision': self.precision,
+            'crs': 'EPSG:{}'.format(WGS84),
+            'sections': sections,
+            'columns': columns,
+        }).encode('utf-8')
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.n_nodes, self.n_edges,
+                                len(metadata)))
+            f.write(metadata)
+            start = _aligned(HEADER.size + len(metadata))
+            f.write(b'\0' * (start - f.tell()))
+            for entry, array in entries:
+                f.write(b'\0' * (start + entry['offset'] - f.tell()))
+                f.write(array.tobytes())
+
+    @property
+    def n_nodes(self):
+        return self.node_xy.shape[0]
+
+    @property
+    def n_edges(self):
+        return self.edge_u.shape[0]
+
+    def degree(self, n):
+        return int(self.indptr[n + 1] - self.indptr[n])
+
+    def out_arcs(self, n):
+        '''The arcs leaving a node.
+
+        :returns: The target nodes, edges and whether each arc is in the
+                  direction of its edge's geometry.
+        :rtype: tuple of numpy.ndarray
+
+        '''
+        start, end = self.indptr[n], self.indptr[n + 1]
+        return (self.indices[start:end], self.arc_edges[start:end],
+                self.arc_forward[start:end])
+
+    def column(self, name):
+        '''The values of an edge attribute, with text codes decoded.
+
+        :returns: numpy.ndarray (float, or object for text)
+
+        '''
+        values = self.columns[name]
+        categories = self.categories.get(name)
+        if categories is None:
+            return np.asarray(values)
+        decoded = np.array(list(categories) + [None], dtype=object)
+        return decoded[np.where(values < 0, len(categories), values)]
+
+    def geometry(self, e):
+        start, end = self.wkb_offsets[e], self.wkb_offsets[e + 1]
+        return from_wkb([self.wkb[start:end].tobytes()])[0]
+
+    def geometries(self):
+        wkb = self.wkb.tobytes()
+        offsets = self.wkb_offsets.tolist()
+        return from_wkb([wkb[start:end] for start, end
+                         in zip(offsets[:-1], offsets[1:])])
+
+    def to_geodataframe(self):
+        '''The edges, with their nodes (`u`, `v`), attributes and
+        geometries, e.g. to write back to GeoJSON.
+
+        :returns: geopandas.GeoDataFrame
+
+        '''
+        data = {'u': np.asarray(self.edge_u, dtype=np.int64),
+                'v': np.asarray(self.edge_v, dtype=np.int64)}
+        for name in self.columns:
+            data[name] = self.column(name)
+        data['geometry'] = self.geometries()
+        return gpd.GeoDataFrame(data, geometry='geometry', crs=WGS84)
+
+
+@timed
+def export_graph(geojson_path, path, columns=COLUMNS, precision=PRECISION,
+                 chunksize=CHUNKSIZE):
+    '''Write the routable graph (see `RoutableGraph`) of a GeoJSON
+    FeatureCollection of lines, e.g. `transportation.geojson`, streaming its
+    features a chunk at a time.
+
+    :param geojson_path: The path of the GeoJSON file.
+    :type geojson_path: str
+    :param path: The path of the graph.
+    :type path: str
+    :param columns: The properties to keep as edge attributes.
+    :type columns: list of str
+    :param precision: The number of decimal places to round endpoints to
+                      for them to be the same node.
+    :type precision: int
+    :param chunksize: The number of features read at a time.
+    :type chunksize: int
+    :returns: RoutableGraph
+
+    '''
+    features = chain.from_iterable(iter_features(geojson_path,
+                                                 chunksize=chunksize))
+    graph = RoutableGraph.from_features(features, columns=columns,
+                                        precision=precision)
+    graph.save(path)
+    return graph
+
+
+def _encode(values):
+    # Numbers (and booleans) as float64 with NaN for missing values, anything
+    # else as int32 codes into sorted categories, with -1 for missing values
+    if all(value is None or isinstance(value, (bool, int, float))
+           for value in values):
+        return np.array([np.nan if value is None else float(value)
+                         for value in values], dtype='<f8'), None
+
+    text = [None if value is None else
+            value if isinstance(value, str) else json.dumps(value)
+            for value in values]
+    categories = sorted(set(value for value in text if value is not None))
+    codes = {category: i for i, category in enumerate(categories)}
+    return np.array([-1 if value is None else codes[value] for value in text],
+                    dtype='<i4'), categories
+
+
+def _aligned(offset):
+    return int(math.ceil(offset / ALIGNMENT)) * ALIGNMENT
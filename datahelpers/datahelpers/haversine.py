@@ -1,5 +1,10 @@
+from itertools import chain
 import math
 
+import numpy as np
+
+from .geometry import coordinate_arrays
+
 
 RADIUS = 6371000  # Radius of the earth in meters
 
@@ -28,3 +33,91 @@ def haversine(coords):
         d_tot += d
 
     return d_tot
+
+
+def haversine_segments(coords):
+    '''Calculate the great circle length of every segment between consecutive
+    lon-lat coordinates, in meters. Vectorized version of `haversine` that
+    doesn't sum the segments.
+
+    :param coords: An (n, 2) array of lon-lat coordinates.
+    :type coords: numpy.ndarray
+    :returns: The n - 1 segment lengths.
+    :rtype: numpy.ndarray
+
+    '''
+    coords = np.asarray(coords, dtype=float)
+    lon = np.radians(coords[:, 0])
+    lat = np.radians(coords[:, 1])
+
+    dlon = np.diff(lon)
+    dlat = np.diff(lat)
+
+    a = np.sin(dlat / 2)**2 + \
+        np.cos(lat[1:]) * np.cos(lat[:-1]) * np.sin(dlon / 2)**2
+
+    return RADIUS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def haversine_coordinate_lengths(coords, offsets):
+    '''Calculate the great circle lengths of many lines at once, given their
+    coordinates as a flat array (see `geometry.coordinate_arrays`).
+
+    :param coords: An (n, 2) array of the lon-lat coordinates of all lines.
+    :type coords: numpy.ndarray
+    :param offsets: The coordinates of line i are
+                    coords[offsets[i]:offsets[i + 1]].
+    :type offsets: array of int
+    :returns: The length of each line, in meters.
+    :rtype: numpy.ndarray
+
+    '''
+    offsets = np.asarray(offsets, dtype=int)
+    n = offsets.shape[0] - 1
+    if not coords.shape[0]:
+        return np.zeros(n)
+
+    segments = haversine_segments(coords)
+    # Segment k joins coordinates k and k + 1. Drop the ones that join the
+    # last coordinate of one line to the first of the next. Empty lines
+    # start or end at the first or last coordinate, where no segment joins
+    # two lines.
+    owners = np.repeat(np.arange(n), np.diff(offsets))[:-1]
+    within = np.ones(segments.shape[0], dtype=bool)
+    starts = offsets[1:-1]
+    starts = starts[(starts > 0) & (starts < coords.shape[0])]
+    within[starts - 1] = False
+
+    return np.bincount(owners[within], weights=segments[within],
+                       minlength=n)
+
+
+def haversine_lengths(lines):
+    '''Calculate the great circle lengths of many lon-lat lines at once, in
+    meters: e.g. to get a length column without reprojecting a layer.
+
+    :param lines: LineStrings (e.g. a GeoSeries) or lists of coordinates (e.g.
+                  the coordinates of GeoJSON LineStrings).
+    :type lines: iterable
+    :returns: The length of each line, in meters.
+    :rtype: numpy.ndarray
+
+    '''
+    lines = list(lines)
+    if lines and isinstance(lines[0], (list, tuple)):
+        counts = [len(line) for line in lines]
+        offsets = np.zeros(len(lines) + 1, dtype=int)
+        np.cumsum(counts, out=offsets[1:])
+        coordinates = list(chain.from_iterable(lines))
+        values = np.array(list(chain.from_iterable(coordinates)),
+                          dtype=float)
+        if values.shape[0] == 2 * len(coordinates):
+            coords = values.reshape(-1, 2)
+        else:
+            # Some coordinates have a z value
+            coords = np.array([c[:2] for c in coordinates],
+                              dtype=float).reshape(-1, 2)
+    else:
+        coords, offsets = coordinate_arrays(lines)
+
+    return haversine_coordinate_lengths(coords, offsets)
@@ -0,0 +1,439 @@
+'''Timers, counters and memory sampling for the stages of a build, e.g. the
+rules of a city's Snakefile. Off by default: instrumented functions check one
+module global and call straight through until `enable` is called.
+
+    dh.instrumentation.enable(profile=True)
+    with dh.instrumentation.stage('draw_crossings'):
+        ...
+    dh.instrumentation.write_report('report.json')
+
+While enabled, every call of a function decorated with `timed` adds to the
+calls and (inclusive) time of that function, and `count` adds to named
+counters, in the stage open on the calling thread (or 'main'). A background
+thread samples the process's resident memory while stages are open and, with
+`profile`, the call stacks of the threads running them, which are written in
+the folded format of flame graph tools for the slowest stage.
+
+Stages running at the same time (e.g. Snakemake jobs on threads) all see the
+process's memory. Work done in other processes (e.g. tiles on a process pool)
+is part of the time of the function that started it, but isn't broken down.
+
+'''
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+# Seconds between samples of memory (and stacks)
+INTERVAL = 0.01
+# Where time spent outside of any stage is recorded
+MAIN = 'main'
+# Deepest call stack kept by the profiler
+MAX_DEPTH = 100
+
+_recorder = None
+
+
+class Stage:
+    '''What was recorded for a stage: its wall time over all `runs`, peak
+    resident memory, timers ({name: [calls, seconds]}), counters and sampled
+    call stacks.
+
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.seconds = 0.0
+        self.peak_rss = 0
+        self.timers = {}
+        self.counters = Counter()
+        self.stacks = Counter()
+
+    def to_dict(self):
+        timers = OrderedDict(
+            (name, {'calls': calls, 'seconds': round(seconds, 6)})
+            for name, (calls, seconds) in sorted(
+                self.timers.items(), key=lambda item: -item[1][1]
+            )
+        )
+        return {
+            'runs': self.runs,
+            'seconds': round(self.seconds, 6),
+            'peak_rss_mb': round(self.peak_rss / 2**20, 1),
+            'timers': timers,
+            'counters': dict(sorted(self.counters.items())),
+            'samples': sum(self.stacks.values()),
+        }
+
+
+class Recorder:
+    '''Collects the timers, counters and samples of stages. Use the module
+    functions (`enable`, `stage`, `write_report`) rather than creating one.
+
+    :param path: The default path of the report.
+    :type path: str
+    :param profile: Whether to sample the call stacks of stages.
+    :type profile: bool
+    :param interval: Seconds between samples.
+    :type interval: float
+
+    '''
+    def __init__(self, path=None, profile=False, interval=INTERVAL):
+        self.path = path
+        self.profile = profile
+        self.interval = interval
+        self.stages = OrderedDict()
+        self.started = time.perf_counter()
+        self._local = threading.local()
+        # The stage open on every thread running one, by thread id
+        self._running = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True,
+                                         name='datahelpers-sampler')
+        self._sampler.start()
+
+    def get(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            with self._lock:
+                stage = self.stages.setdefault(name, Stage(name))
+        return stage
+
+    def current(self):
+        stages = getattr(self._local, 'stages', None)
+        if stages:
+            return stages[-1]
+        return self.get(MAIN)
+
+    @contextmanager
+    def stage(self, name):
+        stage = self.get(name)
+        stages = getattr(self._local, 'stages', None)
+        if stages is None:
+            stages = self._local.stages = []
+        thread = threading.get_ident()
+        stages.append(stage)
+        with self._lock:
+            self._running[thread] = stage
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            elapsed = time.perf_counter() - start
+            rss = current_rss()
+            stages.pop()
+            with self._lock:
+                stage.runs += 1
+                stage.seconds += elapsed
+                stage.peak_rss = max(stage.peak_rss, rss)
+                if stages:
+                    self._running[thread] = stages[-1]
+                else:
+                    del self._running[thread]
+
+    def add_time(self, name, seconds):
+        stage = self.current()
+        with self._lock:
+            timer = stage.timers.get(name)
+            if timer is None:
+                stage.timers[name] = [1, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+
+    def add_count(self, name, n):
+        stage = self.current()
+        with self._lock:
+            stage.counters[name] += n
+
+    def close(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def report(self):
+        '''The recorded stages, as a JSON-serializable dict.'''
+        with self._lock:
+            stages = OrderedDict((name, stage.to_dict())
+                                 for name, stage in self.stages.items())
+        slowest = self.slowest()
+        return {
+            'seconds': round(time.perf_counter() - self.started, 6),
+            'peak_rss_mb': round(peak_rss() / 2**20, 1),
+            'slowest': None if slowest is None else slowest.name,
+            'stages': stages,
+        }
+
+    def slowest(self):
+        stages = [stage for stage in self.stages.values() if stage.runs]
+        if not stages:
+            return None
+        return max(stages, key=lambda stage: stage.seconds)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                running = dict(self._running)
+            if not running:
+                continue
+            rss = current_rss()
+            frames = sys._current_frames() if self.profile else {}
+            stacks = [(stage, _folded(frames.get(thread)))
+                      for thread, stage in running.items()]
+            with self._lock:
+                for stage in set(running.values()):
+                    stage.peak_rss = max(stage.peak_rss, rss)
+                for stage, stack in stacks:
+                    if stack:
+                        stage.stacks[stack] += 1
+
+
+def enable(path=None, profile=False, interval=INTERVAL):
+    '''Start recording. Anything recorded before is discarded.
+
+    :param path: The default path of the report, for `write_report`.
+    :type path: str
+    :param profile: Whether to sample the call stacks of stages, for
+                    `write_report`.
+    :type profile: bool
+    :param interval: Seconds between samples of memory (and stacks).
+    :type interval: float
+
+    '''
+    global _recorder
+    disable()
+    _recorder = Recorder(path=path, profile=profile, interval=interval)
+
+
+def enable_from_environment():
+    '''Enable recording if the `DATAHELPERS_PROFILE` environment variable is
+    set to the path of a report, for `write_report`. Call stacks are sampled
+    if `DATAHELPERS_PROFILE_STACKS` is set to a non-empty value other than 0.
+
+    :returns: The report path, or None if not enabled.
+
+    '''
+    path = os.environ.get('DATAHELPERS_PROFILE')
+    if not path:
+        return None
+    profile = os.environ.get('DATAHELPERS_PROFILE_STACKS', '') not in ('',
+                                                                       '0')
+    enable(path=path, profile=profile)
+    return path
+
+
+def disable():
+    '''Stop recording.
+
+    :returns: The report of what was recorded, or None if not enabled.
+
+    '''
+    global _recorder
+    recorder = _recorder
+    if recorder is None:
+        return None
+    _recorder = None
+    recorder.close()
+    return recorder.report()
+
+
+def enabled():
+    return _recorder is not None
+
+
+def stage(name):
+    '''A context manager for a stage of a build: while it is open, timers
+    and counters on this thread are recorded for the stage. Stages can be
+    nested, and the same stage can be run more than once.
+
+    :param name: The name of the stage, e.g. a rule name.
+    :type name: str
+
+    '''
+    recorder = _recorder
+    if recorder is None:
+        return _nothing()
+    return recorder.stage(name)
+
+
+def stage_rules(rules):
+    '''Run every job of some Snakemake rules in a stage named after its rule,
+    e.g. `stage_rules(workflow.rules)` in a Snakefile's `onstart` handler,
+    rather than opening a stage in every `run:` block. Rules that are already
+    staged are left as they are.
+
+    :param rules: The rules, e.g. `workflow.rules`.
+    :type rules: iterable of snakemake.rules.Rule
+
+    '''
+    for rule in rules:
+        func = getattr(rule, 'run_func', None)
+        if func is None or getattr(func, 'stage_name', None) is not None:
+            continue
+        rule.run_func = _staged(rule.name, func)
+
+
+def timed(func):
+    '''Decorate a function to record its calls and time while enabled, as
+    '<module>.<name>', e.g. 'utm.gdf_to_utm'.
+
+    '''
+    name = '{}.{}'.format(func.__module__.rpartition('.')[2],
+                          func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        recorder = _recorder
+        if recorder is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            recorder.add_time(name, time.perf_counter() - start)
+
+    return wrapper
+
+
+def count(name, n=1):
+    '''Add to a counter, e.g. of rows read, while enabled.
+
+    :param name: The name of the counter.
+    :type name: str
+    :param n: The amount to add.
+    :type n: int
+
+    '''
+    recorder = _recorder
+    if recorder is not None:
+        recorder.add_count(name, n)
+
+
+def report():
+    '''The stages recorded so far, as a JSON-serializable dict with the
+    overall `seconds`, `peak_rss_mb` and `slowest` stage and, for every stage
+    (by name), its `runs`, `seconds`, `peak_rss_mb`, `timers` ({name:
+    {'calls', 'seconds'}}, slowest first), `counters` and number of stack
+    `samples`.
+
+    :returns: dict, or None if not enabled.
+
+    '''
+    if _recorder is None:
+        return None
+    return _recorder.report()
+
+
+def write_report(path=None):
+    '''Write the report as JSON and, if call stacks were sampled, the stacks
+    of the slowest stage in folded format ('frame;frame;frame count' lines,
+    for e.g. flamegraph.pl or speedscope) next to it, as
+    '<path without extension>.<stage>.folded'. Does nothing if not enabled.
+
+    :param path: The path of the report. By default, the path given to
+                 `enable`.
+    :type path: str
+    :returns: The report, or None if not enabled.
+
+    '''
+    recorder = _recorder
+    if recorder is None:
+        return None
+    if path is None:
+        path = recorder.path
+        if path is None:
+            raise ValueError('No report path given')
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    data = recorder.report()
+    slowest = recorder.slowest()
+    if recorder.profile and slowest is not None and slowest.stacks:
+        folded_path = '{}.{}.folded'.format(os.path.splitext(path)[0],
+                                            slowest.name)
+        with recorder._lock:
+            stacks = sorted(slowest.stacks.items())
+        with open(folded_path, 'w') as f:
+            for stack, samples in stacks:
+                f.write('{} {}\n'.format(stack, samples))
+        data['profile'] = folded_path
+
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+    return data
+
+
+def current_rss():
+    '''The resident memory of this process, in bytes. Where that isn't
+    available (outside of Linux), the peak so far.
+
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss():
+    '''The peak resident memory of this process, in bytes (0 if unknown).'''
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _forget():
+    global _recorder
+    _recorder = None
+
+
+if hasattr(os, 'register_at_fork'):
+    # Forked workers (e.g. of a process pool) don't record: the sampler thread
+    # isn't copied into them, and its lock may have been held
+    os.register_at_fork(after_in_child=_forget)
+
+
+def _staged(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return func(*args, **kwargs)
+
+    wrapper.stage_name = name
+    return wrapper
+
+
+@contextmanager
+def _nothing():
+    yield None
+
+
+def _folded(frame):
+    # A call stack as 'outermost;...;innermost' frames, without the frames of
+    # this module (`timed` wrappers, `stage`)
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        if code.co_filename != __file__:
+            names.append('{} ({}:{})'.format(
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno
+            ))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
@@ -1,21 +1,265 @@
+from itertools import chain
 import json
+import re
+
+import numpy as np
 from shapely.geometry import mapping
 
+from .geometry import coordinate_arrays
+from .instrumentation import count, timed
+
+
+# Number of rows serialized at a time when streaming a layer to disk
+CHUNKSIZE = 10000
+
+# Geometry types whose coordinates can be extracted in bulk
+FLAT_TYPES = ('Point', 'LineString')
+
+# Characters read at a time when streaming a GeoJSON file
+READ_SIZE = 2**20
+
+# Nesting depth of the positions of GeoJSON geometries
+POSITION_DEPTHS = {
+    'Point': 0,
+    'MultiPoint': 1,
+    'LineString': 1,
+    'MultiLineString': 2,
+    'Polygon': 2,
+    'MultiPolygon': 3,
+}
 
-def gdf_to_geojson(gdf, path):
-    def row_to_feature(row):
-        properties = row.loc[~row.isna()].to_dict()
-        properties.pop('geometry')
-        return {
+FEATURES_START = re.compile(r'"features"\s*:\s*\[')
+
+
+@timed
+def gdf_to_geojson(gdf, path, precision=None, chunksize=CHUNKSIZE):
+    '''Write a GeoDataFrame to a GeoJSON FeatureCollection. Features are
+    serialized and written a chunk at a time, so memory use is bounded by the
+    chunk size rather than the size of the layer. Null properties are omitted.
+
+    :param gdf: A GeoDataFrame with a `geometry` column.
+    :type gdf: geopandas.GeoDataFrame
+    :param path: The output path.
+    :type path: str
+    :param precision: If set, the number of decimal places to which
+                      coordinates are rounded.
+    :type precision: int
+    :param chunksize: The number of rows serialized at a time.
+    :type chunksize: int
+
+    '''
+    count('io.features_written', gdf.shape[0])
+    with open(path, 'w') as f:
+        # The output is byte-for-byte identical to json.dump-ing the whole
+        # FeatureCollection dict at once.
+        f.write('{"type": "FeatureCollection", "features": [')
+        for start in range(0, gdf.shape[0], chunksize):
+            if start:
+                f.write(', ')
+            chunk = gdf.iloc[start:start + chunksize]
+            features = chunk_to_features(chunk, precision=precision)
+            f.write(', '.join(json.dumps(feature) for feature in features))
+        f.write(']}')
+
+
+def chunk_to_features(gdf, precision=None):
+    '''Convert (a chunk of) a GeoDataFrame into a list of GeoJSON Feature
+    dicts, pulling geometry coordinates and property columns out in bulk
+    rather than row-by-row.
+
+    '''
+    columns = [i for i, c in enumerate(gdf.columns) if c != 'geometry']
+    names = [gdf.columns[i] for i in columns]
+    values = [gdf.iloc[:, i].tolist() for i in columns]
+    missing = [gdf.iloc[:, i].isna().values for i in columns]
+
+    # If no values are missing, rows don't need to be checked one-by-one
+    any_missing = any(isna.any() for isna in missing)
+
+    geometries = geometries_to_geojson(gdf['geometry'], precision=precision)
+
+    features = []
+    for i, geometry in enumerate(geometries):
+        if any_missing:
+            properties = {}
+            # Keep the column order of the input
+            for name, vals, isna in zip(names, values, missing):
+                if not isna[i]:
+                    properties[name] = vals[i]
+        else:
+            properties = {name: vals[i] for name, vals in zip(names, values)}
+        features.append({
             'type': 'Feature',
-            'geometry': mapping(row['geometry']),
+            'geometry': geometry,
             'properties': properties
-        }
+        })
 
-    fc = {
-        'type': 'FeatureCollection',
-        'features': list(gdf.apply(row_to_feature, axis=1))
-    }
+    return features
 
-    with open(path, 'w') as f:
-        json.dump(fc, f)
+
+def geometries_to_geojson(geoseries, precision=None):
+    '''Convert a GeoSeries into a list of GeoJSON geometry dicts. Points and
+    LineStrings are extracted in bulk, other geometries use shapely's
+    `mapping`.
+
+    '''
+    geom_types = geoseries.geom_type
+    if geom_types.isin(FLAT_TYPES).all() and not geoseries.has_z.any():
+        coords, offsets = coordinate_arrays(geoseries)
+        if precision is not None:
+            coords = coords.round(precision)
+        coords = coords.tolist()
+
+        geometries = []
+        for geom_type, start, end in zip(geom_types, offsets[:-1],
+                                         offsets[1:]):
+            geom_coords = coords[start:end]
+            if geom_type == 'Point' and geom_coords:
+                geom_coords = geom_coords[0]
+            geometries.append({
+                'type': geom_type,
+                'coordinates': geom_coords
+            })
+        return geometries
+
+    geometries = []
+    for geometry in geoseries:
+        if geometry is None:
+            geometries.append(None)
+            continue
+        geometry = mapping(geometry)
+        if precision is not None:
+            geometry = round_geometry(geometry, precision)
+        geometries.append(geometry)
+    return geometries
+
+
+def round_geometry(geometry, precision):
+    # Round the coordinates of a GeoJSON-like geometry dict
+    if geometry['type'] == 'GeometryCollection':
+        geoms = [round_geometry(g, precision) for g in geometry['geometries']]
+        return {'type': geometry['type'], 'geometries': geoms}
+    coordinates = geometry['coordinates']
+    if geometry['type'] == 'Point':
+        coordinates = np.round(np.asarray(coordinates, dtype=float),
+                               precision).tolist()
+    else:
+        coordinates = _round_coordinates(coordinates, precision)
+    return {'type': geometry['type'], 'coordinates': coordinates}
+
+
+def _round_coordinates(coordinates, precision):
+    if coordinates and isinstance(coordinates[0][0], (list, tuple)):
+        return [_round_coordinates(c, precision) for c in coordinates]
+    return np.round(np.asarray(coordinates, dtype=float), precision).tolist()
+
+
+def iter_features(path, chunksize=CHUNKSIZE, read_size=READ_SIZE):
+    '''Read the features of a GeoJSON FeatureCollection a chunk at a time,
+    so that memory use is bounded by the chunk size rather than the size of
+    the file. Members of the FeatureCollection other than `features` are
+    ignored.
+
+    :param path: The path to the GeoJSON file.
+    :type path: str
+    :param chunksize: The number of features per chunk.
+    :type chunksize: int
+    :param read_size: The number of characters read from the file at a time.
+    :type read_size: int
+    :returns: generator of lists of GeoJSON Feature dicts.
+
+    '''
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        buffer = ''
+        match = None
+        while match is None:
+            data = f.read(read_size)
+            if not data:
+                raise ValueError('No features found in {}'.format(path))
+            # Keep enough of the previous read to match across reads
+            buffer = buffer[-64:] + data
+            match = FEATURES_START.search(buffer)
+        buffer = buffer[match.end():]
+        pos = 0
+
+        chunk = []
+        eof = False
+        while True:
+            # Skip to the next feature
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == ']':
+                break
+            try:
+                if pos == len(buffer):
+                    raise ValueError
+                feature, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # Incomplete feature: read more of the file
+                if eof:
+                    raise ValueError('Truncated GeoJSON in {}'.format(path))
+                data = f.read(read_size)
+                eof = not data
+                buffer = buffer[pos:] + data
+                pos = 0
+                continue
+
+            chunk.append(feature)
+            if len(chunk) == chunksize:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+
+def feature_positions(features):
+    '''Pull the (x, y) positions of a list of GeoJSON features out into one
+    array, e.g. to compute bounds or hulls of many features at once.
+    Features without geometries have no positions.
+
+    :param features: GeoJSON Feature dicts.
+    :type features: list of dict
+    :returns: An (n, 2) array of positions and the offset of the first
+              position of each feature (plus the total number of positions).
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    positions = []
+    counts = np.zeros(len(features), dtype=int)
+    for i, feature in enumerate(features):
+        geometry = feature.get('geometry')
+        if not geometry:
+            continue
+        if geometry['type'] == 'GeometryCollection':
+            geom_positions = list(chain.from_iterable(
+                _positions(g) for g in geometry['geometries']
+            ))
+        else:
+            geom_positions = _positions(geometry)
+        positions += geom_positions
+        counts[i] = len(geom_positions)
+
+    offsets = np.zeros(len(features) + 1, dtype=int)
+    np.cumsum(counts, out=offsets[1:])
+
+    # Flattening is much faster than converting nested lists, as long as
+    # there are no z values
+    flat = list(chain.from_iterable(positions))
+    if len(flat) == 2 * len(positions):
+        xy = np.array(flat, dtype=float).reshape(-1, 2)
+    else:
+        xy = np.array([p[:2] for p in positions], dtype=float).reshape(-1, 2)
+
+    return xy, offsets
+
+
+def _positions(geometry):
+    positions = geometry['coordinates']
+    depth = POSITION_DEPTHS[geometry['type']]
+    if depth == 0:
+        return [positions] if positions else []
+    for _ in range(depth - 1):
+        positions = list(chain.from_iterable(positions))
+    return positions
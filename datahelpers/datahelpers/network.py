@@ -1,123 +1,553 @@
-import utm
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import LineString
 
+from .geometry import (boxes, coordinate_arrays, cut_lines, interpolate_points,
+                       pairwise_distances, pairwise_intersections,
+                       project_points, query_bulk)
+from .utm import gdf_to_utm
 
-def group_endpoints(gdf, dist_threshold=0.1, precision=1):
+
+# Offsets to the neighbouring grid cells that need to be checked for close
+# points. Only half of the neighbourhood is needed: every pair of adjacent
+# cells is then visited exactly once.
+HALF_NEIGHBOURHOOD = ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def group_endpoints(gdf, tolerance=0.1):
+    '''Snap together the endpoints of lines that are within some distance
+    tolerance of one another: every group of (transitively) close endpoints
+    is moved to the group's mean coordinate.
+
+    Lon-lat layers are converted to UTM so that the tolerance is in meters,
+    otherwise it is in the units of the layer's CRS.
+
+    :param gdf: A GeoDataFrame where the `geometry` column is all LineStrings.
+    :type gdf: geopandas.GeoDataFrame
+    :param tolerance: The maximum distance between endpoints to snap.
+    :type tolerance: float
+    :returns: geopandas.GeoDataFrame
+
+    '''
     crs = gdf.crs
+    gdf = _to_projected(gdf)
+
+    coords, offsets = coordinate_arrays(gdf.geometry)
+    firsts = offsets[:-1]
+    lasts = offsets[1:] - 1
+    coords = _snap_ends(coords, firsts, lasts, tolerance)
+
+    gdf = gdf.copy()
+    gdf['geometry'] = gpd.GeoSeries(_lines(coords, offsets), index=gdf.index,
+                                    crs=gdf.crs)
+
+    return _to_crs(gdf, crs)
+
+
+def node_ends(gdf, tolerance=0.1, intersections=True):
+    '''Create a routable network out of a layer of lines, such that lines
+    only meet end-to-end:
+
+    1) Endpoints within `tolerance` of one another are snapped together.
+    2) Endpoints within `tolerance` of the interior of another line
+       ("T-junctions") are moved onto the nearest such line, which will be
+       split at that point.
+    3) If `intersections` is True, lines that cross one another will both be
+       split at the crossing.
+    4) The lines are split, and the endpoints are snapped together again so
+       that new ends are exactly shared.
+
+    Lines are only split more than twice the tolerance away from their ends at
+    T-junctions, and more than the tolerance away from them at crossings.
+    Lon-lat layers are converted to UTM so that the tolerance is in meters.
+
+    :param gdf: A GeoDataFrame where the `geometry` column is all LineStrings.
+    :type gdf: geopandas.GeoDataFrame
+    :param tolerance: The snapping distance.
+    :type tolerance: float
+    :param intersections: Whether to split lines where they cross.
+    :type intersections: bool
+    :returns: geopandas.GeoDataFrame, with one row per split line. The index is
+              reset.
+
+    '''
+    crs = gdf.crs
+    gdf = _to_projected(gdf)
+
+    # Step 1: endpoint-endpoint snapping
+    coords, offsets = coordinate_arrays(gdf.geometry)
+    firsts = offsets[:-1]
+    lasts = offsets[1:] - 1
+    coords = _snap_ends(coords, firsts, lasts, tolerance)
+    lines = _lines(coords, offsets)
+
+    # Step 2: endpoint-line snapping. Ends are numbered 2 * i for the start
+    # and 2 * i + 1 for the end of line i.
+    end_positions = np.empty(2 * len(lines), dtype=int)
+    end_positions[0::2] = firsts
+    end_positions[1::2] = lasts
+    end_idx, line_idx, distances = t_junctions(lines,
+                                               coords[end_positions],
+                                               tolerance)
+    if end_idx.size:
+        # Move the ends onto the lines. They won't exactly match the points
+        # the lines are split at: that is taken care of by snapping again.
+        points = interpolate_points([lines[i] for i in line_idx], distances)
+        coords[end_positions[end_idx]] = [(p.x, p.y) for p in points]
+        lines = _lines(coords, offsets)
+
+    # Step 3: line-line intersections
+    if intersections:
+        crossing_idx, crossing_distances = line_intersections(lines,
+                                                              tolerance)
+        line_idx = np.concatenate([line_idx, crossing_idx])
+        distances = np.concatenate([distances, crossing_distances])
+
+    # Step 4: split the lines and snap their new ends together
+    gdf = gdf.copy()
+    gdf['geometry'] = gpd.GeoSeries(lines, index=gdf.index, crs=gdf.crs)
+    gdf = split_lines(gdf, line_idx, distances, tolerance)
+
+    coords, offsets = coordinate_arrays(gdf.geometry)
+    coords = _snap_ends(coords, offsets[:-1], offsets[1:] - 1, tolerance)
+    gdf['geometry'] = gpd.GeoSeries(_lines(coords, offsets), index=gdf.index,
+                                    crs=gdf.crs)
+
+    return _to_crs(gdf, crs)
+
+
+def split_at_ends(gdf, others, tolerance=0.1):
+    '''Split lines wherever the endpoints of other lines meet their interior
+    (within some tolerance), e.g. to connect sidewalks to crossings. Unlike
+    `node_ends`, the other lines are not modified.
+
+    :param gdf: The lines to split.
+    :type gdf: geopandas.GeoDataFrame
+    :param others: The lines whose endpoints may split `gdf`.
+    :type others: geopandas.GeoDataFrame
+    :param tolerance: The maximum distance between an endpoint and a line.
+    :type tolerance: float
+    :returns: geopandas.GeoDataFrame, with one row per split line. The index is
+              reset.
 
-    # Convert to UTM so everything can be calculated in meters
-    gdf_utm = utm.gdf_to_utm(gdf)
-
-    # Step 1: endpoint-endpoint snapping. Use simple strategy of rounding to a
-    # certain precision (in this case, 1 = 1 decimal place, or 0.1 meters)
-    firsts = pd.DataFrame({
-        'coordinates': df['geometry'].apply(lambda x: tuple(np.round(x.coords[0], PRECISION))),
-        'idx': df.index,
-        'type': 'first',
-    })
-    lasts = pd.DataFrame({
-        'coordinates': df['geometry'].apply(lambda x: tuple(np.round(x.coords[-1], PRECISION))),
-        'idx': df.index,
-        'type': 'last',
-    })
-    ends = pd.concat([firsts, lasts])
-    for coord, grp in ends.groupby('coordinates').groups:
-        if grp.shape:
-            # We've got grouped-together endpoints! These should be merged to a new
-            # value. Save this new value back to a new column in the original df.
-            new_x = grp.apply(lambda x: x[0]).mean()
-            new_y = grp.apply(lambda x: x[1]).mean()
-            starts.loc[grp[grp['type'] == 'first']['idx'], 'coordinates'] = (new_x, new_y)
-            lasts.loc[grp[grp['type'] == 'last']['idx'], 'coordinates'] = (new_x, new_y)
-    ends = pd.concat([starts, lasts])
-    ends['geometry'] = ends['coordinates'].apply(lambda x: Point(x))
-    ends = gpd.GeoDataFrame(ends)
-
-    # 'ends' is now a GeoDataFrame of potentially-adjusted end coordinates. We will
-    # use this data structure to query nearby lines - but throw out any that are
-    # just duplicate 'hits' for endpoints. The remaining lines need to be split.
-
-    # Step 2: Update the lines with new ends. When it comes time to split any
-    # sidewalk lines, it will be advantageous to use the 'updated' data, avoiding
-    # the need to track which pieces came from which sidewalks.
-    for sw_idx, grp in ends.groupby('idx'):
-        coords = list(df.loc[sw_idx, 'geometry'].coords)
-        for idx, row in grp.iterrows():
-            if row['type'] == 'start':
-                coords[0] = row['coordinates']
-            else:
-                coords[-1] = row['coordinates']
-        gdf_utm.loc[sw_idx, 'geometry'] = LineString(coords)
-
-    # Convert back to original CRS
-    df = gdf_utm.to_crs(crs)
-
-    return df
-
-
-def node_ends(gdf):
-    # Save CRS for later
+    '''
     crs = gdf.crs
+    gdf = _to_projected(gdf)
+    others = others.to_crs(gdf.crs) if others.crs != gdf.crs else others
+
+    coords, offsets = coordinate_arrays(others.geometry)
+    ends = np.concatenate([coords[offsets[:-1]], coords[offsets[1:] - 1]])
+
+    lines = list(gdf.geometry)
+    _, line_idx, distances = t_junctions(lines, ends, tolerance)
+    gdf = split_lines(gdf, line_idx, distances, tolerance)
+
+    return _to_crs(gdf, crs)
+
+
+def split_lines(gdf, line_idx, distances, tolerance=0.0):
+    '''Split lines at distances along them.
+
+    :param gdf: A GeoDataFrame where the `geometry` column is all LineStrings.
+    :type gdf: geopandas.GeoDataFrame
+    :param line_idx: For each split, the position of the line to split.
+    :type line_idx: array of int
+    :param distances: For each split, the distance along the line.
+    :type distances: array of float
+    :param tolerance: Splits within this distance of another split on the same
+                      line are dropped, to avoid creating tiny lines.
+    :type tolerance: float
+    :returns: geopandas.GeoDataFrame, with one row per piece (in order along
+              the original line). The index is reset.
+
+    '''
+    line_idx = np.asarray(line_idx, dtype=int)
+    distances = np.asarray(distances, dtype=float)
+    n = gdf.shape[0]
+
+    order = np.lexsort((distances, line_idx))
+    line_idx = line_idx[order]
+    distances = distances[order]
+    if distances.size:
+        same_line = np.r_[False, line_idx[1:] == line_idx[:-1]]
+        too_close = np.r_[False, np.diff(distances) <= tolerance]
+        keep = ~(same_line & too_close)
+        line_idx = line_idx[keep]
+        distances = distances[keep]
+
+    splits_at = np.split(distances, np.searchsorted(line_idx, np.arange(1, n)))
+    pieces = cut_lines(gdf.geometry, splits_at)
+
+    rows = np.repeat(np.arange(n), [len(p) for p in pieces])
+    split = gpd.GeoDataFrame(gdf.iloc[rows]).reset_index(drop=True)
+    geometry = [piece for line_pieces in pieces for piece in line_pieces]
+    split['geometry'] = gpd.GeoSeries(geometry, crs=gdf.crs)
+
+    return split
+
+
+def node_features(collections, precision=9):
+    '''Split LineString features wherever they share a vertex with another
+    feature (or themselves), in any of several GeoJSON FeatureCollections.
+    Vertices are considered shared when their coordinates are equal after
+    rounding to some number of decimal places.
+
+    Coordinates are quantized to integer keys and the number of times each
+    key occurs (its "degree") is counted all at once, then every feature is
+    split at its interior vertices that have a degree greater than 1.
+
+    Split features share their `properties` dict with the original feature
+    rather than getting a copy: copy them before modifying them in-place.
+    Features that are not LineStrings are kept as-is and do not take part.
+
+    :param collections: GeoJSON FeatureCollection dicts.
+    :type collections: list of dict
+    :param precision: The number of decimal places to round coordinates to.
+                      e.g. 9 is sub-cm for lon-lat.
+    :type precision: int
+    :returns: A new FeatureCollection dict for each input collection.
+    :rtype: list of dict
+
+    '''
+    lines = [feature for collection in collections
+             for feature in collection['features']
+             if feature['geometry']['type'] == 'LineString']
+
+    counts = np.array([len(f['geometry']['coordinates']) for f in lines],
+                      dtype=int)
+    offsets = np.zeros(len(lines) + 1, dtype=int)
+    np.cumsum(counts, out=offsets[1:])
+
+    keys = _coordinate_keys([c for f in lines
+                             for c in f['geometry']['coordinates']],
+                            precision)
+    if keys.shape[0]:
+        _, inverse, key_counts = np.unique(keys, axis=0, return_inverse=True,
+                                           return_counts=True)
+        degrees = key_counts[inverse.reshape(-1)]
+    else:
+        degrees = np.empty(0, dtype=int)
+
+    # Interior vertices shared with anything else
+    shared = degrees > 1
+    shared[offsets[:-1]] = False
+    shared[np.maximum(offsets[1:] - 1, 0)] = False
+    split_at = np.flatnonzero(shared)
+    bounds = np.searchsorted(split_at, offsets)
+    # Coordinate positions where each line is split, relative to its start
+    owners = np.searchsorted(offsets, split_at, side='right') - 1
+    relative = (split_at - offsets[owners]).tolist()
+    bounds = bounds.tolist()
+    splits = {}
+    for i in np.unique(owners).tolist():
+        splits[id(lines[i])] = relative[bounds[i]:bounds[i + 1]]
+
+    new_collections = []
+    for collection in collections:
+        features = []
+        for feature in collection['features']:
+            indices = splits.get(id(feature))
+            if indices is None:
+                features.append(feature)
+                continue
+            coordinates = feature['geometry']['coordinates']
+            indices = indices + [len(coordinates) - 1]
+            last = 0
+            for index in indices:
+                new_feature = dict(feature)
+                new_feature['geometry'] = dict(
+                    feature['geometry'],
+                    coordinates=coordinates[last:index + 1]
+                )
+                features.append(new_feature)
+                last = index
+        new_collections.append({'type': 'FeatureCollection',
+                                'features': features})
+
+    return new_collections
+
+
+def close_pairs(xy, tolerance):
+    '''Find all pairs of points within some distance of one another. Points
+    are hashed to a grid of tolerance-sized cells, so only points in the same
+    or neighbouring cells need to be compared: near-linear time for anything
+    but extremely dense points.
+
+    :param xy: An (n, 2) array of coordinates.
+    :type xy: numpy.ndarray
+    :param tolerance: The maximum distance between points.
+    :type tolerance: float
+    :returns: Two arrays of point positions, i and j, with i < j.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    xy = np.asarray(xy, dtype=float)
+    n = xy.shape[0]
+    if not n or tolerance <= 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    # Integer cells, offset so that neighbouring cells are never negative
+    cells = np.floor(xy / tolerance).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    height = cells[:, 1].max() + 2
+    keys = cells[:, 0] * height + cells[:, 1]
+
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+
+    pairs_i = []
+    pairs_j = []
+    for dx, dy in HALF_NEIGHBOURHOOD:
+        neighbours = keys + dx * height + dy
+        lo = np.searchsorted(sorted_keys, neighbours, side='left')
+        hi = np.searchsorted(sorted_keys, neighbours, side='right')
+        counts = hi - lo
+        total = counts.sum()
+        if not total:
+            continue
+        # Every point paired with every point in the neighbouring cell
+        i = np.repeat(np.arange(n), counts)
+        starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        j = order[starts + np.arange(total)]
+        if dx == 0 and dy == 0:
+            # Same cell: don't pair points with themselves or pair twice
+            same = i < j
+            i = i[same]
+            j = j[same]
+        pairs_i.append(i)
+        pairs_j.append(j)
+
+    if not pairs_i:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    i = np.concatenate(pairs_i)
+    j = np.concatenate(pairs_j)
+
+    deltas = xy[i] - xy[j]
+    close = (deltas[:, 0]**2 + deltas[:, 1]**2) <= tolerance**2
+
+    return np.minimum(i[close], j[close]), np.maximum(i[close], j[close])
+
+
+def union_find(n, i, j):
+    '''Find the connected components of n items given pairs of connected
+    items, using a vectorized union-find: every round, each component's root
+    is hooked onto the smallest root it is connected to, then paths are
+    compressed by pointer jumping.
+
+    :param n: The number of items.
+    :type n: int
+    :param i: Positions of the first items of connected pairs.
+    :type i: array of int
+    :param j: Positions of the second items of connected pairs.
+    :type j: array of int
+    :returns: The component label of each item: the smallest position in its
+              component.
+    :rtype: numpy.ndarray
+
+    '''
+    parent = np.arange(n)
+    i = np.asarray(i, dtype=int)
+    j = np.asarray(j, dtype=int)
+    while i.size:
+        root_i = parent[i]
+        root_j = parent[j]
+        differ = root_i != root_j
+        if not differ.any():
+            break
+        root_i = root_i[differ]
+        root_j = root_j[differ]
+        # Hook
+        np.minimum.at(parent, np.maximum(root_i, root_j),
+                      np.minimum(root_i, root_j))
+        # Compress
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+        # Pairs already in the same component are done
+        i = i[differ]
+        j = j[differ]
+
+    return parent
+
+
+def t_junctions(lines, ends, tolerance):
+    '''Find endpoints that are within some tolerance of the interior of a line
+    (more than twice the tolerance from either of its ends), i.e. that should
+    be joined to it.
+
+    :param lines: The lines.
+    :type lines: list of shapely.geometry.LineString
+    :param ends: An (n, 2) array of endpoint coordinates.
+    :type ends: numpy.ndarray
+    :param tolerance: The maximum distance between an endpoint and a line.
+    :type tolerance: float
+    :returns: The positions of the endpoints that meet lines, the positions of
+              the (nearest) lines they meet and the distances along those
+              lines.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+    points = list(gpd.points_from_xy(ends[:, 0], ends[:, 1]))
+    lines_series = gpd.GeoSeries(lines)
+
+    bounds = np.concatenate([ends - tolerance, ends + tolerance], axis=1)
+    end_idx, line_idx = query_bulk(lines_series.sindex,
+                                   gpd.GeoSeries(boxes(bounds)))
+
+    hit_points = [points[i] for i in end_idx]
+    hit_lines = [lines[i] for i in line_idx]
+    distances_to = pairwise_distances(hit_points, hit_lines)
+    distances_along = project_points(hit_lines, hit_points)
+    lengths = lines_series.length.values[line_idx]
+
+    meets = (distances_to <= tolerance) & \
+            (distances_along > 2 * tolerance) & \
+            (distances_along < lengths - 2 * tolerance)
+    end_idx = end_idx[meets]
+    line_idx = line_idx[meets]
+    distances_to = distances_to[meets]
+    distances_along = distances_along[meets]
+
+    if not end_idx.size:
+        return end_idx, line_idx, distances_along
+
+    # Only join each endpoint to its nearest line
+    order = np.lexsort((line_idx, distances_to, end_idx))
+    first = np.r_[True, end_idx[order][1:] != end_idx[order][:-1]]
+    nearest = order[first]
+
+    return end_idx[nearest], line_idx[nearest], distances_along[nearest]
+
+
+def line_intersections(lines, tolerance):
+    '''Find the points at which lines cross one another. Every line is split
+    at the crossings more than the tolerance from its ends, whether or not the
+    crossing is also in the interior of the other line.
+
+    :param lines: The lines.
+    :type lines: list of shapely.geometry.LineString
+    :param tolerance: The minimum distance from the end of a line to split it.
+    :type tolerance: float
+    :returns: The positions of the lines to split and the distances along
+              them, up to two per crossing.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    lines_series = gpd.GeoSeries(lines)
+    i, j = query_bulk(lines_series.sindex, lines_series)
+    # Each pair once, and no line with itself
+    pair = i < j
+    i = i[pair]
+    j = j[pair]
+
+    intersections = pairwise_intersections([lines[k] for k in i],
+                                           [lines[k] for k in j])
+
+    # Overlapping (collinear) lines are ignored
+    point_i = []
+    point_j = []
+    xy = []
+    for k, geometry in enumerate(intersections):
+        if geometry.is_empty:
+            continue
+        if geometry.geom_type == 'Point':
+            parts = [geometry]
+        elif geometry.geom_type == 'MultiPoint':
+            parts = list(geometry.geoms)
+        else:
+            continue
+        for part in parts:
+            point_i.append(i[k])
+            point_j.append(j[k])
+            xy.append((part.x, part.y))
+
+    if not xy:
+        return np.empty(0, dtype=int), np.empty(0)
+
+    point_i = np.array(point_i, dtype=int)
+    point_j = np.array(point_j, dtype=int)
+    xy = np.array(xy)
+    points = list(gpd.points_from_xy(xy[:, 0], xy[:, 1]))
+    lengths = lines_series.length.values
+
+    line_idx = np.concatenate([point_i, point_j])
+    distances = np.concatenate([
+        project_points([lines[k] for k in point_i], points),
+        project_points([lines[k] for k in point_j], points)
+    ])
+
+    # Each line is split where the crossing is in its own interior. A
+    # crossing within the tolerance of one line's end still splits the other
+    # line: the end is then snapped to the new node.
+    interior = (distances > tolerance) & \
+               (distances < lengths[line_idx] - tolerance)
+
+    return line_idx[interior], distances[interior]
+
+
+def _coordinate_keys(coordinates, precision):
+    # Quantize (2D or 3D) coordinates to integers. If dimensions are mixed,
+    # missing values get a key of their own, so e.g. a 2D coordinate never
+    # matches a 3D one.
+    dimensions = set(len(c) for c in coordinates)
+    if len(dimensions) > 1:
+        width = max(dimensions)
+        coordinates = [list(c) + [np.nan] * (width - len(c))
+                       for c in coordinates]
+    coords = np.array(coordinates, dtype=float).reshape(len(coordinates), -1)
+
+    missing = np.isnan(coords)
+    keys = np.rint(np.where(missing, 0, coords) * 10.0**precision)
+    keys = keys.astype(np.int64)
+    keys[missing] = np.iinfo(np.int64).min
+
+    return keys
+
+
+def _snap_ends(coords, firsts, lasts, tolerance):
+    # Snap together close endpoints, given the positions of the first and last
+    # coordinates of every line in a flat array of coordinates.
+    coords = coords.copy()
+    positions = np.concatenate([firsts, lasts])
+    ends = coords[positions]
+
+    i, j = close_pairs(ends, tolerance)
+    if not i.size:
+        return coords
+    groups = union_find(ends.shape[0], i, j)
+
+    counts = np.bincount(groups, minlength=ends.shape[0])
+    mean_x = np.bincount(groups, weights=ends[:, 0],
+                         minlength=ends.shape[0]) / np.maximum(counts, 1)
+    mean_y = np.bincount(groups, weights=ends[:, 1],
+                         minlength=ends.shape[0]) / np.maximum(counts, 1)
+
+    # Only move grouped ends - others keep their exact coordinates
+    grouped = counts[groups] > 1
+    coords[positions[grouped], 0] = mean_x[groups[grouped]]
+    coords[positions[grouped], 1] = mean_y[groups[grouped]]
+
+    return coords
+
+
+def _lines(coords, offsets):
+    coords = coords.tolist()
+    return [LineString(coords[start:end])
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _to_projected(gdf):
+    # Lon-lat data is converted to UTM so that everything can be calculated in
+    # meters
+    if gdf.crs is not None and gdf.crs.is_geographic:
+        return gdf_to_utm(gdf)
+    return gdf
+
 
-    # Convert to UTM so everything can be calculated in meters
-    gdf_utm = utm.gdf_to_utm(gdf)
-
-    # Step 3: query for places where endpoints meet lines, implying that the line
-    # needs to be split.
-    for idx, row in ends.iterrows():
-        point = row['geometry']
-
-        bounds = []
-        bounds.append(point.x - DIST_THRESHOLD)
-        bounds.append(point.y - DIST_THRESHOLD)
-        bounds.append(point.x + DIST_THRESHOLD)
-        bounds.append(point.y + DIST_THRESHOLD)
-
-        hits = list(df.sindex.intersection(bounds))
-        sw_rows = df.iloc[hits]
-        sw_rows = sw_rows[sw_rows.distance(point) < DIST_THRESHOLD]
-
-        lengths = sw_rows['geometry'].length
-        distances_along = sw_rows.project(point)
-        not_starts = distances_along > (DIST_THRESHOLD * 2)
-        not_lasts = distances_along < (lengths - DIST_THRESHOLD * 2)
-        not_ends = not_starts & not_lasts
-
-        if not_ends.any():
-            # Grab the closest one and split it
-            sorted_distances = distances_along[not_ends].sort_values()
-            idx2 = sorted_distances.index[0]
-            distance = sorted_distances.iloc[0]
-
-            # There are non-endpoint hits - these geometries should be split at
-            # the projected point(s).
-            df.loc[idx2, 'split'].append(distance)
-
-            # The original point should also be set to the projected point
-            new_point = df.loc[idx2, 'geometry'].interpolate(distance)
-
-            ends.loc[idx, 'geometry'] = new_point
-
-    # Step 4: split the lines
-    new_rows = []
-    need_splitting = df[df['split'].apply(len) > 0]
-    for idx, row in need_splitting.iterrows():
-        geometry = row['geometry']
-        for distance in sorted(set(row['split']), reverse=True):
-            # print('--------------')
-            # print(geometry.wkt)
-            # print(list(geometry.coords))
-            # print(geometry.length, distance)
-            x = dh.geometry.cut(geometry, distance)
-            geometry, tail = dh.geometry.cut(geometry, distance)
-            new_row = df.loc[idx].copy(deep=True)
-            new_row['geometry'] = tail
-            new_rows.append(new_row)
-        df.loc[idx, 'geometry'] = geometry
-
-    new_df = gpd.GeoDataFrame(new_rows)
-
-    combined_df = gpd.GeoDataFrame(pd.concat([df, new_df]))
-    combined_df.crs = crs
-    df_wgs84 = combined_df.to_crs(4326)
-
-    dh.io.gdf_to_geojson(df_wgs84, output[0])
+def _to_crs(gdf, crs):
+    if crs is not None and gdf.crs != crs:
+        return gdf.to_crs(crs)
+    return gdf
@@ -0,0 +1,715 @@
+'''Read layers of OpenStreetMap data straight from an extract (.osm.pbf, or
+.osm XML), in one streaming pass over the file.
+
+    layers = {
+        'sidewalks': osm.Layer('way', accept={'footway': ['sidewalk']},
+                               keep=['surface']),
+        'kerbs': osm.Layer('node', accept={'kerb': None}, keep=['kerb']),
+    }
+    gdfs = osm.read_osm('extract.osm.pbf', layers, bbox=bbox)
+
+Every element is checked against every layer, so one pass fills all of them
+and an element can be in more than one. The coordinates of the nodes in the
+bounding box are kept in a `NodeStore` (compact arrays sorted by id, which
+can be memory-mapped for large extracts) and the geometries of the ways are
+looked up in it once the whole file has been read. As with osmosis'
+`clipIncompleteEntities`, ways lose the nodes outside of the bounding box,
+and are left out if fewer than two remain. Relations are skipped.
+
+PBF files are decoded here (zlib or lzma blobs, dense or plain nodes), so no
+protobuf or OSM library is needed.
+
+'''
+from collections import OrderedDict
+import lzma
+import os
+import shutil
+import struct
+import tempfile
+import xml.etree.ElementTree as ET
+import zlib
+
+import geopandas as gpd
+import numpy as np
+
+from .geometry import lines, points
+from .instrumentation import count, timed
+
+
+# Coordinates are stored as integers in units of 1e-7 degrees, the precision
+# of the OSM database
+SCALE = 10**7
+
+# Nanodegrees per stored unit
+NANO = 10**9 // SCALE
+
+# Node ids and coordinates are copied into the store this many at a time
+# when reading XML
+CHUNKSIZE = 2**16
+
+# PBF features that this reader can decode
+FEATURES = ('OsmSchema-V0.6', 'DenseNodes')
+
+# The largest PBF block allowed by the format
+MAX_BLOB = 32 * 2**20
+
+WGS84 = 4326
+
+
+class Layer:
+    '''Which elements of an extract go in a layer, and which of their tags
+    are kept as columns.
+
+    :param element: 'way' or 'node'.
+    :type element: str
+    :param accept: Tags that elements must have, as {key: values}: every key
+                   must be present, with one of its values (or any value if
+                   values is None), e.g. {'highway': ['footway', 'path']}.
+    :type accept: dict
+    :param reject: Tags that elements must not have, as {key: values}: an
+                   element with any of these keys, with one of its values (or
+                   any value if values is None), is left out.
+    :type reject: dict
+    :param keep: The tags to keep as columns. Elements without a tag have
+                 None in its column.
+    :type keep: list of str
+
+    '''
+    def __init__(self, element, accept=None, reject=None, keep=None):
+        if element not in ('way', 'node'):
+            raise ValueError('Unknown element type: {}'.format(element))
+        self.element = element
+        self.accept = _value_sets(accept)
+        self.reject = _value_sets(reject)
+        self.keep = list(keep or [])
+
+    def matches(self, tags):
+        for key, values in self.accept.items():
+            value = tags.get(key)
+            if value is None or (values is not None and value not in values):
+                return False
+        for key, values in self.reject.items():
+            value = tags.get(key)
+            if value is not None and (values is None or value in values):
+                return False
+        return True
+
+
+class NodeStore:
+    '''The ids and coordinates of nodes, as arrays sorted by id, for looking
+    up the coordinates of many nodes at once. Nodes are added in chunks
+    (e.g. the blocks of a PBF file); if they weren't added in order of id,
+    they are sorted when the store is closed.
+
+    :param directory: If given, a directory in which the ids and coordinates
+                      are written as they are added and then memory-mapped,
+                      rather than kept in memory. It must be empty or not
+                      exist, and it is removed by `clear`.
+    :type directory: str
+
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.ids = np.zeros(0, dtype=np.int64)
+        # lon, lat in 1e-7 degrees
+        self.coords = np.zeros((0, 2), dtype=np.int32)
+        self._sorted = True
+        self._last = None
+        self._id_chunks = []
+        self._coord_chunks = []
+        self._files = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._files = (
+                open(os.path.join(directory, 'ids.bin'), 'wb'),
+                open(os.path.join(directory, 'coords.bin'), 'wb'),
+            )
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def add(self, ids, coords):
+        '''Add nodes.
+
+        :param ids: The node ids.
+        :type ids: numpy.ndarray of int64
+        :param coords: An (n, 2) array of their lon, lat in 1e-7 degrees.
+        :type coords: numpy.ndarray of int32
+
+        '''
+        if not ids.shape[0]:
+            return
+        if self._sorted:
+            self._sorted = bool(np.all(ids[1:] > ids[:-1])) and \
+                (self._last is None or ids[0] > self._last)
+        self._last = ids[-1]
+        ids = ids.astype('<i8', copy=False)
+        coords = coords.astype('<i4', copy=False)
+        if self._files is None:
+            self._id_chunks.append(ids)
+            self._coord_chunks.append(coords)
+        else:
+            self._files[0].write(ids.tobytes())
+            self._files[1].write(coords.tobytes())
+
+    def close(self):
+        '''Finish adding nodes, so that they can be looked up.'''
+        if self._files is None:
+            if self._id_chunks:
+                self.ids = np.concatenate(self._id_chunks)
+                self.coords = np.concatenate(self._coord_chunks)
+            self._id_chunks = []
+            self._coord_chunks = []
+            if not self._sorted:
+                order = np.argsort(self.ids, kind='mergesort')
+                self.ids = self.ids[order]
+                self.coords = self.coords[order]
+        else:
+            for f in self._files:
+                f.close()
+            self._files = None
+            ids_path, coords_path = self._paths()
+            if not self._sorted:
+                # Sorting needs the ids and the reordered coordinates in
+                # memory, once
+                ids = np.fromfile(ids_path, dtype='<i8')
+                order = np.argsort(ids, kind='mergesort')
+                ids[order].tofile(ids_path)
+                del ids
+                coords = np.memmap(coords_path, dtype='<i4', mode='r+')
+                coords[:] = coords.reshape(-1, 2)[order].ravel()
+                coords.flush()
+                del coords
+            self.ids = _memmap(ids_path, '<i8')
+            self.coords = _memmap(coords_path, '<i4').reshape(-1, 2)
+        self._sorted = True
+
+    def lookup(self, ids):
+        '''The coordinates of nodes.
+
+        :param ids: Node ids.
+        :type ids: numpy.ndarray of int64
+        :returns: An (n, 2) array of lon, lat in degrees (NaN for nodes that
+                  aren't in the store) and a boolean array of which nodes
+                  are.
+        :rtype: tuple of numpy.ndarray
+
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        coords = np.full((ids.shape[0], 2), np.nan)
+        if not len(self):
+            return coords, np.zeros(ids.shape[0], dtype=bool)
+        positions = np.searchsorted(self.ids, ids)
+        positions[positions == len(self)] = 0
+        found = self.ids[positions] == ids
+        coords[found] = self.coords[positions[found]] / SCALE
+        return coords, found
+
+    def clear(self):
+        '''Release the arrays and remove the store's directory, if any.'''
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+            self._files = None
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.coords = np.zeros((0, 2), dtype=np.int32)
+        self._id_chunks = []
+        self._coord_chunks = []
+        if self.directory is not None and os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+    def _paths(self):
+        return (os.path.join(self.directory, 'ids.bin'),
+                os.path.join(self.directory, 'coords.bin'))
+
+
+@timed
+def read_osm(path, layers, bbox=None, memmap=False, tempdir=None):
+    '''Read layers from an OSM extract in one pass.
+
+    :param path: The path of an .osm.pbf (or .pbf) file, or of an .osm XML
+                 file.
+    :type path: str
+    :param layers: The layers to read, by name.
+    :type layers: dict of str to Layer
+    :param bbox: If given, the area to read, as (west, south, east, north)
+                 in degrees. Nodes outside of it are left out.
+    :type bbox: tuple of float
+    :param memmap: Whether to keep node coordinates in memory-mapped files
+                   rather than in memory, for extracts with more nodes than
+                   fit in memory. The files are removed afterwards.
+    :type memmap: bool
+    :param tempdir: Where to create the memory-mapped files. By default, the
+                    system's temporary directory.
+    :type tempdir: str
+    :returns: OrderedDict of a GeoDataFrame (lon-lat, WGS84) for every layer,
+              in the order of `layers`, with a column for every kept tag and
+              the OSM ids of the elements as the index.
+
+    '''
+    directory = None
+    if memmap:
+        directory = os.path.join(tempfile.mkdtemp(dir=tempdir), 'nodes')
+    store = NodeStore(directory=directory)
+
+    extract = _Extract(layers, bbox, store)
+    try:
+        if path.lower().endswith('.pbf'):
+            _read_pbf(path, extract)
+        else:
+            _read_xml(path, extract)
+        store.close()
+        count('osm.nodes_stored', len(store))
+        return extract.layers(store)
+    finally:
+        store.clear()
+        if directory is not None:
+            shutil.rmtree(os.path.dirname(directory), ignore_errors=True)
+
+
+class _Extract:
+    # What has been read of every layer, while the file is being read
+    def __init__(self, layers, bbox, store):
+        self.names = list(layers)
+        self.store = store
+        self.bbox = None
+        if bbox is not None:
+            west, south, east, north = bbox
+            self.bbox = (int(round(west * SCALE)), int(round(south * SCALE)),
+                         int(round(east * SCALE)), int(round(north * SCALE)))
+        self.way_layers = [(name, layer) for name, layer in layers.items()
+                           if layer.element == 'way']
+        self.node_layers = [(name, layer) for name, layer in layers.items()
+                            if layer.element == 'node']
+        # Nodes without any of these tags can't be in a node layer
+        self.node_keys = set()
+        for _, layer in self.node_layers:
+            self.node_keys.update(layer.accept)
+        # The node ids of ways, or the coordinates of nodes, are in 'refs'
+        self.rows = {name: {'ids': [], 'tags': [], 'refs': []}
+                     for name in self.names}
+        self.layer_specs = layers
+
+    def inside(self, coords):
+        if self.bbox is None:
+            return np.ones(coords.shape[0], dtype=bool)
+        west, south, east, north = self.bbox
+        return (coords[:, 0] >= west) & (coords[:, 0] <= east) & \
+            (coords[:, 1] >= south) & (coords[:, 1] <= north)
+
+    def add_nodes(self, ids, coords):
+        inside = self.inside(coords)
+        if not inside.all():
+            ids = ids[inside]
+            coords = coords[inside]
+        self.store.add(ids, coords)
+
+    def add_tagged_node(self, node_id, coords, tags):
+        # coords: lon, lat in 1e-7 degrees
+        if self.bbox is not None:
+            west, south, east, north = self.bbox
+            if not (west <= coords[0] <= east and south <= coords[1] <= north):
+                return
+        for name, layer in self.node_layers:
+            if layer.matches(tags):
+                rows = self.rows[name]
+                rows['ids'].append(node_id)
+                rows['tags'].append([tags.get(key) for key in layer.keep])
+                rows['refs'].append(coords)
+
+    def way_matches(self, tags):
+        return [name for name, layer in self.way_layers
+                if layer.matches(tags)]
+
+    def add_way(self, way_id, names, tags, refs):
+        for name in names:
+            rows = self.rows[name]
+            rows['ids'].append(way_id)
+            rows['tags'].append([tags.get(key)
+                                 for key in self.layer_specs[name].keep])
+            rows['refs'].append(refs)
+
+    def layers(self, store):
+        gdfs = OrderedDict()
+        for name in self.names:
+            layer = self.layer_specs[name]
+            rows = self.rows[name]
+            ids = np.array(rows['ids'], dtype=np.int64)
+            if layer.element == 'node':
+                coords = np.array(rows['refs'],
+                                  dtype=float).reshape(-1, 2) / SCALE
+                geometries = points(coords)
+                kept = np.ones(ids.shape[0], dtype=bool)
+            else:
+                geometries, kept = _way_geometries(rows['refs'], store)
+            tags = [row for row, k in zip(rows['tags'], kept.tolist()) if k]
+            data = OrderedDict()
+            for i, key in enumerate(layer.keep):
+                data[key] = [row[i] for row in tags]
+            data['geometry'] = geometries
+            gdfs[name] = gpd.GeoDataFrame(data, index=ids[kept],
+                                          geometry='geometry', crs=WGS84)
+            count('osm.{}'.format(name), gdfs[name].shape[0])
+        return gdfs
+
+
+def _way_geometries(refs, store):
+    # The lines of ways from the coordinates of their nodes, without the
+    # nodes that aren't in the store. Ways left with fewer than two nodes
+    # are dropped.
+    counts = np.array([r.shape[0] for r in refs], dtype=np.int64)
+    if refs:
+        all_refs = np.concatenate(refs)
+    else:
+        all_refs = np.zeros(0, dtype=np.int64)
+    coords, found = store.lookup(all_refs)
+    way_index = np.repeat(np.arange(counts.shape[0]), counts)
+    found_counts = np.bincount(way_index[found], minlength=counts.shape[0])
+    kept = found_counts >= 2
+    found &= kept[way_index]
+    offsets = np.zeros(kept.sum() + 1, dtype=np.int64)
+    np.cumsum(found_counts[kept], out=offsets[1:])
+    return lines(coords[found], offsets), kept
+
+
+def _read_pbf(path, extract):
+    with open(path, 'rb') as f:
+        for blob_type, data in _blobs(f):
+            if blob_type == 'OSMHeader':
+                _check_header(data)
+            elif blob_type == 'OSMData':
+                _read_block(data, extract)
+
+
+def _blobs(f):
+    # The type and decompressed data of every block of a PBF file
+    while True:
+        head = f.read(4)
+        if not head:
+            return
+        if len(head) < 4:
+            raise ValueError('Truncated PBF file')
+        size, = struct.unpack('>I', head)
+        blob_type = None
+        datasize = 0
+        for number, _, value in _fields(memoryview(f.read(size))):
+            if number == 1:
+                blob_type = bytes(value).decode('utf-8')
+            elif number == 3:
+                datasize = value
+        if datasize > MAX_BLOB:
+            raise ValueError('PBF block too large: {}'.format(datasize))
+        blob = memoryview(f.read(datasize))
+        if len(blob) < datasize:
+            raise ValueError('Truncated PBF file')
+        yield blob_type, _decompress(blob)
+        count('osm.blocks_read')
+
+
+def _decompress(blob):
+    for number, _, value in _fields(blob):
+        if number == 1:
+            return value
+        elif number == 3:
+            return memoryview(zlib.decompress(value))
+        elif number == 4:
+            return memoryview(lzma.decompress(value))
+        elif number in (5, 6, 7):
+            raise ValueError('Unsupported PBF compression (bzip2, lz4 or '
+                             'zstd)')
+    return memoryview(b'')
+
+
+def _check_header(data):
+    for number, _, value in _fields(data):
+        if number == 4:
+            feature = bytes(value).decode('utf-8')
+            if feature not in FEATURES:
+                raise ValueError('Unsupported PBF feature: {}'.format(
+                    feature))
+
+
+def _read_block(data, extract):
+    # A PrimitiveBlock: a string table shared by its groups of elements, and
+    # the scale and offset of coordinates
+    strings = []
+    groups = []
+    granularity = 100
+    lat_offset = 0
+    lon_offset = 0
+    for number, _, value in _fields(data):
+        if number == 1:
+            strings = [bytes(s).decode('utf-8')
+                       for n, _, s in _fields(value) if n == 1]
+        elif number == 2:
+            groups.append(value)
+        elif number == 17:
+            granularity = value
+        elif number == 19:
+            lat_offset = _int64(value)
+        elif number == 20:
+            lon_offset = _int64(value)
+
+    def to_units(lons, lats):
+        # Coordinates in 1e-7 degrees
+        lons = lon_offset + granularity * np.asarray(lons, dtype=np.int64)
+        lats = lat_offset + granularity * np.asarray(lats, dtype=np.int64)
+        return np.column_stack([(lons + NANO // 2) // NANO,
+                                (lats + NANO // 2) // NANO]).astype(np.int32)
+
+    # The ways in any of the layers, whose node ids are decoded together
+    ways = []
+    n_ways = 0
+    for group in groups:
+        for number, _, value in _fields(group):
+            if number == 2:
+                _read_dense(value, strings, to_units, extract)
+            elif number == 1:
+                _read_node(value, strings, to_units, extract)
+            elif number == 3:
+                n_ways += 1
+                way = _read_way(value, strings, extract)
+                if way is not None:
+                    ways.append(way)
+    count('osm.ways_read', n_ways)
+
+    if ways:
+        refs = _delta_coded([way[3] for way in ways])
+        for (way_id, names, tags, _), way_refs in zip(ways, refs):
+            extract.add_way(way_id, names, tags, way_refs)
+
+
+def _read_dense(data, strings, to_units, extract):
+    ids = lats = lons = keys_vals = None
+    for number, _, value in _fields(data):
+        if number == 1:
+            ids = np.cumsum(_packed(value, signed=True))
+        elif number == 8:
+            lats = np.cumsum(_packed(value, signed=True))
+        elif number == 9:
+            lons = np.cumsum(_packed(value, signed=True))
+        elif number == 10:
+            keys_vals = _packed(value)
+    if ids is None:
+        return
+    coords = to_units(lons, lats)
+    extract.add_nodes(ids, coords)
+    count('osm.nodes_read', ids.shape[0])
+
+    if keys_vals is None or not keys_vals.shape[0] or not extract.node_keys:
+        return
+    # Every node's tags are key, value string indexes followed by a 0
+    keys = set(i for i, s in enumerate(strings) if s in extract.node_keys)
+    if not keys:
+        return
+    ends = np.flatnonzero(keys_vals == 0)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    tagged = np.flatnonzero(ends > starts)
+    keys_vals = keys_vals.tolist()
+    for i, start, end in zip(tagged.tolist(), starts[tagged].tolist(),
+                             ends[tagged].tolist()):
+        node_keys = keys_vals[start:end:2]
+        if keys.isdisjoint(node_keys):
+            continue
+        tags = {strings[k]: strings[v] for k, v
+                in zip(node_keys, keys_vals[start + 1:end:2])}
+        extract.add_tagged_node(int(ids[i]), coords[i].tolist(), tags)
+
+
+def _read_node(data, strings, to_units, extract):
+    node_id = 0
+    keys = []
+    vals = []
+    lat = lon = 0
+    for number, _, value in _fields(data):
+        if number == 1:
+            node_id = _zigzag(value)
+        elif number == 2:
+            keys = _varints(value)
+        elif number == 3:
+            vals = _varints(value)
+        elif number == 8:
+            lat = _zigzag(value)
+        elif number == 9:
+            lon = _zigzag(value)
+    coords = to_units([lon], [lat])
+    extract.add_nodes(np.array([node_id], dtype=np.int64), coords)
+    count('osm.nodes_read')
+    if keys and not extract.node_keys.isdisjoint(strings[k] for k in keys):
+        tags = {strings[k]: strings[v] for k, v in zip(keys, vals)}
+        extract.add_tagged_node(node_id, coords[0].tolist(), tags)
+
+
+def _read_way(data, strings, extract):
+    way_id = 0
+    keys = []
+    vals = []
+    refs = None
+    for number, _, value in _fields(data):
+        if number == 1:
+            way_id = value
+        elif number == 2:
+            keys = _varints(value)
+        elif number == 3:
+            vals = _varints(value)
+        elif number == 8:
+            refs = value
+    if not keys or refs is None:
+        return None
+    tags = {strings[k]: strings[v] for k, v in zip(keys, vals)}
+    names = extract.way_matches(tags)
+    if not names:
+        return None
+    return way_id, names, tags, refs
+
+
+def _read_xml(path, extract):
+    ids = []
+    coords = []
+    way_id = None
+    tags = {}
+    refs = []
+    for event, element in ET.iterparse(path, events=('start', 'end')):
+        tag = element.tag
+        if event == 'start':
+            if tag in ('node', 'way', 'relation'):
+                tags = {}
+                refs = []
+            continue
+        if tag == 'tag':
+            tags[element.get('k')] = element.get('v')
+        elif tag == 'nd':
+            refs.append(int(element.get('ref')))
+        elif tag == 'node':
+            node_id = int(element.get('id'))
+            lonlat = [int(round(float(element.get('lon')) * SCALE)),
+                      int(round(float(element.get('lat')) * SCALE))]
+            ids.append(node_id)
+            coords.append(lonlat)
+            count('osm.nodes_read')
+            if len(ids) == CHUNKSIZE:
+                extract.add_nodes(np.array(ids, dtype=np.int64),
+                                  np.array(coords, dtype=np.int32))
+                ids = []
+                coords = []
+            if tags and not extract.node_keys.isdisjoint(tags):
+                extract.add_tagged_node(node_id, lonlat, tags)
+            element.clear()
+        elif tag == 'way':
+            way_id = int(element.get('id'))
+            count('osm.ways_read')
+            names = extract.way_matches(tags)
+            if names:
+                extract.add_way(way_id, names, tags,
+                                np.array(refs, dtype=np.int64))
+            element.clear()
+        elif tag == 'relation':
+            element.clear()
+    extract.add_nodes(np.array(ids, dtype=np.int64),
+                      np.array(coords, dtype=np.int32).reshape(-1, 2))
+
+
+def _fields(buf):
+    # The (field number, wire type, value) of every field of a protobuf
+    # message: ints for varints, memoryviews for everything else
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 2:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type: {}'.format(
+                wire))
+        yield key >> 3, wire, value
+
+
+def _varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _varints(buf):
+    # Packed varints, for short arrays (e.g. the tags of a way)
+    values = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        value, pos = _varint(buf, pos)
+        values.append(value)
+    return values
+
+
+def _packed(buf, signed=False):
+    # Packed varints, decoded all at once: every byte below 0x80 ends a
+    # value, and the others contribute 7 bits each, least significant first
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if not data.shape[0]:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shifts = 7 * (np.arange(data.shape[0]) - np.repeat(starts,
+                                                       ends - starts + 1))
+    values = np.bitwise_or.reduceat(
+        (data & 0x7f).astype(np.uint64) << shifts.astype(np.uint64), starts
+    )
+    if signed:
+        return (values >> np.uint64(1)).astype(np.int64) ^ \
+            -(values & np.uint64(1)).astype(np.int64)
+    return values.astype(np.int64)
+
+
+def _delta_coded(buffers):
+    # Arrays of packed, delta-coded sint64s (e.g. the node ids of ways),
+    # decoded all at once
+    bounds = np.zeros(len(buffers) + 1, dtype=np.int64)
+    np.cumsum([len(buf) for buf in buffers], out=bounds[1:])
+    data = np.frombuffer(b''.join(buffers), dtype=np.uint8)
+    # The number of values in every array: the number of last bytes
+    counts = np.diff(np.searchsorted(np.flatnonzero(data < 0x80), bounds))
+    values = np.cumsum(_packed(data, signed=True))
+    # Restart the sums at the first value of every array
+    starts = np.cumsum(counts) - counts
+    values -= np.repeat(np.concatenate([[0], values])[starts], counts)
+    return np.split(values, starts[1:])
+
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _int64(value):
+    # A varint int64, which is encoded as unsigned
+    return value - 2**64 if value >= 2**63 else value
+
+
+def _value_sets(tags):
+    if not tags:
+        return {}
+    return {key: None if values is None else frozenset(values)
+            for key, values in tags.items()}
+
+
+def _memmap(path, dtype):
+    if not os.path.getsize(path):
+        # Empty files can't be memory-mapped
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
@@ -1,83 +1,118 @@
 import geopandas as gpd
 import numpy as np
-from shapely.geometry import Point
 
-from .geometry import cut
+from .geometry import (boxes, coordinate_arrays, cut_lines,
+                       pairwise_distances, points, project_points, query_bulk)
+from .instrumentation import timed
+from .tiling import TILE_SIZE, map_tiles
 
 
-def network_sidewalks(sidewalks, paths_list, tolerance=1e-1, precision=3):
+@timed
+def network_sidewalks(sidewalks, paths_list, tolerance=1e-1, precision=3,
+                      max_workers=1, tile_size=TILE_SIZE, store=None):
     '''Create a network from (potentially) independently-generated sidewalks
     and other paths. Sidewalks will be split into multiple lines wherever
     their endpoints (nearly) intersect other paths on their same layer, within
     some distance tolerance.
 
+    With more than one worker, sidewalks are split in spatial tiles on a
+    process pool (see `tiling.map_tiles`). The result is the same. With a
+    `tiling.TileStore`, only the tiles whose inputs changed since the last
+    run are split again.
+
     '''
-    ends = []
-    for paths in paths_list:
-        for idx, row in paths.iterrows():
-            ends.append(Point(np.round(row['geometry'].coords[0], precision)))
-            ends.append(Point(np.round(row['geometry'].coords[-1], precision)))
-
-    ends = gpd.GeoDataFrame(geometry=ends)
-    ends['wkt'] = ends.geometry.apply(lambda x: x.wkt)
-    ends = ends.drop_duplicates('wkt')
-    ends = ends.drop('wkt', axis=1)
-
-    splits = []
-    for idx, row in sidewalks.iterrows():
-        line = row['geometry']
-
-        # Expand bounds by tolerance to catch everything in range, order is
-        # left, bottom, right, top
-        bounds = [
-            line.bounds[0] - tolerance,
-            line.bounds[1] - tolerance,
-            line.bounds[2] + tolerance,
-            line.bounds[3] + tolerance
-        ]
-
-        hits = list(ends.sindex.intersection(bounds))
-
-        # Now iterate over and filter
-        distances_along = []
-        for index in hits:
-            loc = ends.index[index]
-            point = ends.loc[loc, 'geometry']
-
-            # Is the point actually within the tolerance distance?
-            if point.distance(line) > tolerance:
-                continue
-
-            # Find closest point on line
-            distance_along = line.project(point)
-
-            # Did you find an endpoint?
-            if (distance_along < 0.01) or \
-               (distance_along >= (line.length - 0.01)):
-                continue
-
-            distances_along.append(distance_along)
-
-        # Split
-        lines = []
-        line1 = line
-        for distance in reversed(sorted(distances_along)):
-            line1, line2 = cut(line1, distance)
-            lines.append(line2)
-
-        lines.append(line1)
-
-        for line in lines:
-            split = dict(row)
-            split['geometry'] = line
-            # Ignore incline for short segments near paths - these are
-            # usually near intersections and are more flat on average.
-            # (8 meters)
-            if line.length < 8:
-                split['incline'] = 0
-            splits.append(split)
-
-    sidewalks_network = gpd.GeoDataFrame(splits)
-    sidewalks_network.crs = sidewalks.crs
+    if max_workers != 1 or store is not None:
+        # Rounded path ends can be up to 10**-precision closer than the ends
+        return map_tiles(network_sidewalks, sidewalks, paths_list,
+                         buffer=tolerance + 10.0**-precision,
+                         tile_size=tile_size, ignore_index=True,
+                         max_workers=max_workers, store=store,
+                         tolerance=tolerance, precision=precision)
+
+    ends = points(path_ends(paths_list, precision))
+
+    lines = list(sidewalks.geometry)
+    lengths = sidewalks.geometry.length.values
+
+    # Expand bounds by tolerance to catch everything in range, order is
+    # left, bottom, right, top. All sidewalks are queried at once.
+    bounds = sidewalks.geometry.bounds.values
+    bounds = bounds + np.array([-tolerance, -tolerance, tolerance, tolerance])
+    line_idx, end_idx = query_bulk(gpd.GeoSeries(ends).sindex,
+                                  gpd.GeoSeries(boxes(bounds)))
+
+    hit_lines = [lines[i] for i in line_idx]
+    hit_ends = [ends[i] for i in end_idx]
+
+    # Is the point actually within the tolerance distance?
+    close = pairwise_distances(hit_ends, hit_lines) <= tolerance
+    line_idx = line_idx[close]
+    hit_lines = [line for line, c in zip(hit_lines, close) if c]
+    hit_ends = [end for end, c in zip(hit_ends, close) if c]
+
+    # Find closest point on line, skipping endpoints
+    distances_along = project_points(hit_lines, hit_ends)
+    not_ends = (distances_along >= 0.01) & \
+               (distances_along < lengths[line_idx] - 0.01)
+    line_idx = line_idx[not_ends]
+    distances_along = distances_along[not_ends]
+
+    # Split
+    order = np.argsort(line_idx, kind='mergesort')
+    splits_at = np.split(distances_along[order],
+                         np.searchsorted(line_idx[order],
+                                         np.arange(1, len(lines))))
+    # Pieces are emitted from the end of each sidewalk back to its start, as
+    # when sidewalks were cut one distance at a time from the far end
+    pieces = [line_pieces[::-1]
+              for line_pieces in cut_lines(lines, splits_at)]
+
+    rows = np.repeat(np.arange(len(lines)), [len(p) for p in pieces])
+    sidewalks_network = gpd.GeoDataFrame(sidewalks.iloc[rows])
+    sidewalks_network = sidewalks_network.reset_index(drop=True)
+    geometry = [piece for line_pieces in pieces for piece in line_pieces]
+    sidewalks_network['geometry'] = gpd.GeoSeries(geometry,
+                                                  crs=sidewalks.crs)
+
+    # Ignore incline for short segments near paths - these are usually near
+    # intersections and are more flat on average. (8 meters)
+    short = sidewalks_network.geometry.length.values < 8
+    if short.any():
+        sidewalks_network.loc[short, 'incline'] = 0
 
     return sidewalks_network
+
+
+@timed
+def path_ends(paths_list, precision):
+    '''The distinct (rounded) endpoints of the paths in multiple layers, in
+    order of first appearance.
+
+    :param paths_list: Layers of LineStrings.
+    :type paths_list: list of geopandas.GeoDataFrame
+    :param precision: The number of decimal places to round coordinates to.
+    :type precision: int
+    :returns: An (n, 2) array of coordinates.
+    :rtype: numpy.ndarray
+
+    '''
+    ends = []
+    for paths in paths_list:
+        coords, offsets = coordinate_arrays(paths.geometry)
+        # Start then end of each path
+        layer_ends = np.empty((2 * paths.shape[0], 2))
+        layer_ends[0::2] = coords[offsets[:-1]]
+        layer_ends[1::2] = coords[offsets[1:] - 1]
+        ends.append(layer_ends)
+    if not ends:
+        return np.empty((0, 2))
+    ends = np.concatenate(ends)
+
+    # De-duplicate on the integer grid that rounding maps coordinates to,
+    # which is exact (unlike comparing floats or their text representation)
+    grid = np.rint(ends * 10.0**precision).astype(np.int64)
+    if not grid.shape[0]:
+        return np.round(ends, precision)
+    _, first = np.unique(grid, axis=0, return_index=True)
+
+    return np.round(ends[np.sort(first)], precision)
@@ -1,10 +1,356 @@
+from collections import OrderedDict
 import geopandas as gpd
 import math
+import threading
+
 import numpy as np
+import pandas as pd
+import rasterio as rio
 from scipy.interpolate import RectBivariateSpline
 from rasterio.windows import Window
 
-from .geometry import cut
+from .geometry import coordinate_arrays, cut_many, line_lengths
+from .instrumentation import count, timed
+
+
+# The grid that indexes the footprints of a `DEMCollection`'s files: the
+# number of cells across a typical file, and the most cells per file
+CELLS_ACROSS_FILE = 4
+MAX_CELLS_PER_FILE = 64
+
+
+class TileCache:
+    '''Wraps an open rasterio dataset and keeps its decoded internal blocks
+    (tiles) in a least-recently-used cache of bounded size, so that
+    spatially coherent sampling decompresses each tile once rather than once
+    per point. Can be used anywhere a `dem` dataset is expected: it provides
+    the same `read` method and passes through all other dataset attributes
+    (`transform`, `crs`, `width`, etc). Lookups are thread-safe.
+
+    :param dataset: An open rasterio dataset.
+    :type dataset: rasterio.io.DatasetReader
+    :param max_bytes: The maximum total size of the cached tiles, in bytes.
+    :type max_bytes: int
+
+    '''
+    def __init__(self, dataset, max_bytes=64 * 2**20):
+        self.dataset = dataset
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        # rasterio datasets can't be read from multiple threads at once, so
+        # reads happen under the same lock as cache updates
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the TileCache itself
+        return getattr(self.dataset, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.clear()
+        self.dataset.close()
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+
+    def read(self, indexes=1, window=None):
+        '''Read a window of a single band, assembled from cached tiles. As
+        with rasterio, the parts of the window outside of the raster are
+        clipped off.
+
+        :param indexes: The (1-based) band index.
+        :type indexes: int
+        :param window: The window to read. If not set, reads the whole band.
+        :type window: rasterio.windows.Window
+
+        '''
+        if window is None:
+            window = Window(0, 0, self.dataset.width, self.dataset.height)
+
+        row_start = max(int(window.row_off), 0)
+        col_start = max(int(window.col_off), 0)
+        row_stop = min(int(window.row_off + window.height),
+                       self.dataset.height)
+        col_stop = min(int(window.col_off + window.width), self.dataset.width)
+
+        out = np.empty((max(row_stop - row_start, 0),
+                        max(col_stop - col_start, 0)),
+                       dtype=self.dataset.dtypes[indexes - 1])
+        if not out.size:
+            return out
+
+        block_height, block_width = self.dataset.block_shapes[indexes - 1]
+        for block_row in range(row_start // block_height,
+                               (row_stop - 1) // block_height + 1):
+            for block_col in range(col_start // block_width,
+                                   (col_stop - 1) // block_width + 1):
+                tile = self.tile(indexes, block_row, block_col)
+                # Overlap between the tile and the window, in raster indices
+                r0 = max(row_start, block_row * block_height)
+                r1 = min(row_stop, (block_row + 1) * block_height)
+                c0 = max(col_start, block_col * block_width)
+                c1 = min(col_stop, (block_col + 1) * block_width)
+                out[r0 - row_start:r1 - row_start,
+                    c0 - col_start:c1 - col_start] = \
+                    tile[r0 - block_row * block_height:
+                         r1 - block_row * block_height,
+                         c0 - block_col * block_width:
+                         c1 - block_col * block_width]
+
+        return out
+
+    def tile(self, band, block_row, block_col):
+        '''Get a decoded tile by its block row and column, reading it from
+        the dataset on a cache miss.
+
+        '''
+        key = (band, block_row, block_col)
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+
+            self.misses += 1
+            count('raster_interp.tiles_read')
+            block_height, block_width = self.dataset.block_shapes[band - 1]
+            row_off = block_row * block_height
+            col_off = block_col * block_width
+            tile = self.dataset.read(band, window=Window(
+                col_off,
+                row_off,
+                min(block_width, self.dataset.width - col_off),
+                min(block_height, self.dataset.height - row_off)
+            ))
+            # Tiles are shared between callers - don't let them be modified
+            tile.flags.writeable = False
+
+            self._tiles[key] = tile
+            self.nbytes += tile.nbytes
+            while self.nbytes > self.max_bytes and len(self._tiles) > 1:
+                _, evicted = self._tiles.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+        return tile
+
+
+class DEMCollection:
+    '''A 'virtual mosaic' of many DEM files (e.g. USGS 1/3 arc-second
+    tiles), sampled without merging them into one raster. The files'
+    footprints are indexed by a regular grid, query points are bucketed by
+    the files that cover them and each bucket is sampled in bulk, so only
+    the files that cover some points are visited. Can be used anywhere a
+    single `dem` dataset is expected by `sample` and `interpolated_value`.
+
+    Points on a seam between files, whose interpolation window does not fit
+    in the first file that covers them, are sampled from the next file that
+    covers them (neighbouring USGS tiles overlap by a few pixels).
+
+    At most `max_open` files are kept open at once, each wrapped in a
+    `TileCache`.
+
+    :param paths: Paths to the DEM files, in order of preference. All must
+                  share the same CRS.
+    :type paths: list of str
+    :param max_open: The maximum number of files to keep open.
+    :type max_open: int
+    :param cache_bytes: The size of the tile cache of each open file.
+    :type cache_bytes: int
+
+    '''
+    def __init__(self, paths, max_open=4, cache_bytes=64 * 2**20):
+        self.paths = list(paths)
+        self.max_open = max_open
+        self.cache_bytes = cache_bytes
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+
+        footprints = []
+        self.crs = None
+        for path in self.paths:
+            with rio.open(path) as dataset:
+                footprints.append(tuple(dataset.bounds))
+                if self.crs is None:
+                    self.crs = dataset.crs
+                elif dataset.crs != self.crs:
+                    raise ValueError('DEM {} has a different CRS'.format(path))
+        # left, bottom, right, top of every file
+        self.footprints = np.array(footprints).reshape(-1, 4)
+        self._index_footprints()
+
+    def _index_footprints(self):
+        # A regular grid over the footprints, with the files that overlap
+        # each cell stored CSR-style:
+        # `_cell_files[_cell_indptr[c]:_cell_indptr[c + 1]]`, and whether
+        # the cell is within the file in `_cell_within`. Most cells of a
+        # mosaic are within one file, only those on seams overlap several.
+        footprints = self.footprints
+        if not footprints.shape[0]:
+            self._grid_shape = (0, 0)
+            return
+
+        self._origin = footprints[:, :2].min(axis=0)
+        sizes = footprints[:, 2:] - footprints[:, :2]
+        cell_size = np.median(sizes, axis=0) / CELLS_ACROSS_FILE
+        cell_size[~(cell_size > 0)] = 1.0
+        extent = footprints[:, 2:].max(axis=0) - self._origin
+        # Files much larger than the others shouldn't make a huge grid
+        n_cells = np.prod(np.floor(extent / cell_size) + 1)
+        max_cells = MAX_CELLS_PER_FILE * footprints.shape[0]
+        if n_cells > max_cells:
+            cell_size *= math.sqrt(n_cells / max_cells)
+        self._cell_size = cell_size
+        n_cols, n_rows = (np.floor(extent / cell_size) + 1).astype(int)
+        self._grid_shape = (n_cols, n_rows)
+
+        first = self._cells(footprints[:, 0], footprints[:, 1])
+        last = self._cells(footprints[:, 2], footprints[:, 3])
+        cells = []
+        files = []
+        within = []
+        for i, ((c0, r0), (c1, r1)) in enumerate(zip(first, last)):
+            cols, rows = np.meshgrid(np.arange(c0, c1 + 1),
+                                     np.arange(r0, r1 + 1))
+            cols = cols.ravel()
+            rows = rows.ravel()
+            cells.append(rows * n_cols + cols)
+            files.append(np.full(cols.shape[0], i))
+            # Cells between the cells of the corners hold only points within
+            # the footprint
+            within.append((cols > c0) & (cols < c1) & (rows > r0) &
+                          (rows < r1))
+        cells = np.concatenate(cells)
+        order = np.argsort(cells, kind='mergesort')
+        self._cell_files = np.concatenate(files)[order]
+        self._cell_within = np.concatenate(within)[order]
+        self._cell_indptr = np.searchsorted(cells[order],
+                                            np.arange(n_cols * n_rows + 1))
+
+    def _cells(self, xs, ys):
+        # The (column, row) of the grid cell of every point, clipped to the
+        # grid. Floor division is monotonic, so a point within a footprint is
+        # within the cells of its corners.
+        cols = np.floor((xs - self._origin[0]) / self._cell_size[0])
+        rows = np.floor((ys - self._origin[1]) / self._cell_size[1])
+        n_cols, n_rows = self._grid_shape
+        return np.stack([np.clip(cols, 0, n_cols - 1),
+                         np.clip(rows, 0, n_rows - 1)], axis=-1).astype(int)
+
+    def candidates(self, xs, ys):
+        '''Find the files whose footprints cover each of an array of points.
+
+        :returns: Two arrays: positions of points and, for each, a file that
+                  covers it. Ordered by file, then by point.
+        :rtype: tuple of numpy.ndarray
+
+        '''
+        n_cols, n_rows = self._grid_shape
+        if not n_cols:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        x_min, y_min = self._origin
+        x_max = x_min + n_cols * self._cell_size[0]
+        y_max = y_min + n_rows * self._cell_size[1]
+        inside = (xs >= x_min) & (xs <= x_max) & (ys >= y_min) & (ys <= y_max)
+        idx = np.flatnonzero(inside)
+        cols, rows = self._cells(xs[idx], ys[idx]).T
+        cells = rows * n_cols + cols
+
+        # Every (point, file) pair of a point and a file overlapping its cell
+        starts = self._cell_indptr[cells]
+        counts = self._cell_indptr[cells + 1] - starts
+        points = np.repeat(idx, counts)
+        positions = np.arange(counts.sum()) + \
+            np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        files = self._cell_files[positions]
+
+        # Check the footprints of the cells they aren't known to be within
+        check = np.flatnonzero(~self._cell_within[positions])
+        left, bottom, right, top = self.footprints[files[check]].T
+        px = xs[points[check]]
+        py = ys[points[check]]
+        covered = np.ones(files.shape[0], dtype=bool)
+        covered[check] = (px >= left) & (px <= right) & (py >= bottom) & \
+            (py <= top)
+        points = points[covered]
+        files = files[covered]
+
+        # Points are in order already
+        order = np.argsort(files, kind='mergesort')
+        return points[order], files[order]
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for dataset in self._datasets.values():
+                dataset.close()
+            self._datasets.clear()
+
+    def dataset(self, i):
+        '''Get the i-th file as an open (tile-cached) dataset, closing the
+        least recently used file if too many are open.
+
+        '''
+        with self._lock:
+            dataset = self._datasets.get(i)
+            if dataset is not None:
+                self._datasets.move_to_end(i)
+                return dataset
+
+            dataset = TileCache(rio.open(self.paths[i]),
+                                max_bytes=self.cache_bytes)
+            self._datasets[i] = dataset
+            while len(self._datasets) > self.max_open:
+                _, evicted = self._datasets.popitem(last=False)
+                evicted.close()
+
+        return dataset
+
+    def sample(self, xs, ys, method='bilinear', scaling_factor=1.0):
+        '''Sample arrays of points: see `sample`. Points not covered by any
+        file get a value of NaN.
+
+        '''
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+
+        values = np.full(xs.shape, np.nan)
+        todo = np.ones(xs.shape, dtype=bool)
+        # Only the files that cover some of the points, in order
+        points, files = self.candidates(xs, ys)
+        found, starts = np.unique(files, return_index=True)
+        ends = np.r_[starts[1:], files.shape[0]]
+        for i, start, end in zip(found, starts, ends):
+            idx = points[start:end]
+            idx = idx[todo[idx]]
+            if not idx.size:
+                continue
+
+            sampled = sample(self.dataset(i), xs[idx], ys[idx], method=method,
+                             scaling_factor=scaling_factor)
+            values[idx] = sampled
+            # Points without a full window here may fit in another file
+            todo[idx[~np.isnan(sampled)]] = False
+
+        return values
 
 
 def split_for_inclines(row):
@@ -21,16 +367,12 @@ def split_for_inclines(row):
         rows.append(row)
     else:
         increment = geometry.length / (n + 1)
+        distances = increment * np.arange(1, n + 1)
 
-        line2 = geometry
-        for i in range(n):
-            line1, line2 = cut(line2, increment)
+        for line in cut_many(geometry, distances):
             new_row = dict(row)
-            new_row['geometry'] = line1
+            new_row['geometry'] = line
             rows.append(new_row)
-        new_row = dict(row)
-        new_row['geometry'] = line2
-        rows.append(new_row)
 
     return gpd.GeoDataFrame(rows)
 
@@ -44,11 +386,177 @@ def elevation_change(linestring, dem):
     return end - start
 
 
+def densify(lines, step):
+    '''Place evenly spaced sample points along every line, no more than `step`
+    apart and including both ends of the line. Lines without coordinates
+    (missing or empty) get no samples.
+
+    :param lines: LineStrings, e.g. a GeoSeries, in a projected CRS.
+    :type lines: iterable of shapely.geometry.LineString
+    :param step: The maximum distance between samples.
+    :type step: float
+    :returns: An (n, 2) array of the sample points of all lines, the offsets
+              of each line's samples in it (the samples of line i are
+              xy[offsets[i]:offsets[i + 1]]) and the distance of every
+              sample along its line.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    coords, vertex_offsets = coordinate_arrays(lines)
+    counts = np.diff(vertex_offsets)
+    # Only lines with coordinates are sampled. Their coordinates are
+    # contiguous in coords, so the rest is done for them alone.
+    present = counts > 0
+    if not present.any():
+        return (np.empty((0, 2)), np.zeros(counts.shape[0] + 1, dtype=int),
+                np.empty(0))
+    n_samples = np.zeros(counts.shape[0], dtype=int)
+    firsts = vertex_offsets[:-1][present]
+    counts = counts[present]
+
+    # Cumulative distance to every vertex, running over all lines: the
+    # segments between one line and the next are given a length of 0, so
+    # line i spans [line_starts[i], line_starts[i] + lengths[i]].
+    deltas = np.diff(coords, axis=0)
+    segments = np.sqrt(deltas[:, 0]**2 + deltas[:, 1]**2)
+    segments[firsts[1:] - 1] = 0
+    cumulative = np.zeros(coords.shape[0])
+    np.cumsum(segments, out=cumulative[1:])
+    line_starts = cumulative[firsts]
+    lengths = cumulative[firsts + counts - 1] - line_starts
+
+    n_samples[present] = np.maximum(np.ceil(lengths / step), 1) + 1
+    offsets = np.zeros(n_samples.shape[0] + 1, dtype=int)
+    np.cumsum(n_samples, out=offsets[1:])
+    sample_offsets = offsets[:-1][present]
+
+    # Position of every sample within its line: 0, 1, ..., n_samples - 1
+    line_idx = np.repeat(np.arange(counts.shape[0]), n_samples[present])
+    position = np.arange(offsets[-1]) - sample_offsets[line_idx]
+    distances = lengths[line_idx] * position / \
+        (n_samples[present][line_idx] - 1)
+
+    # Find the segment of every sample, staying within its own line
+    vertex = np.searchsorted(cumulative, line_starts[line_idx] + distances,
+                             side='right') - 1
+    first = firsts[line_idx]
+    vertex = np.clip(vertex, first, first + counts[line_idx] - 2)
+
+    along = line_starts[line_idx] + distances - cumulative[vertex]
+    seglen = cumulative[vertex + 1] - cumulative[vertex]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.clip(along / seglen, 0.0, 1.0)
+    t[~np.isfinite(t)] = 0.0
+    xy = coords[vertex] + t[:, np.newaxis] * (coords[vertex + 1] -
+                                              coords[vertex])
+
+    return xy, offsets, distances
+
+
+@timed
+def sampled_inclines(lines, elevation, step=5.0, max_points=1000000):
+    '''Estimate the mean, maximum and minimum incline along every line by
+    sampling elevations at evenly spaced points (see `densify`), rather than
+    just at its ends. Inclines are signed (rise over run, in the direction of
+    the line), so the maximum is the steepest uphill and the minimum the
+    steepest downhill section. The mean is the end-to-end incline, as in
+    `elevation_change`.
+
+    All points of many lines are sampled in one batch. To keep memory use
+    bounded, lines are processed in chunks of at most about `max_points`
+    samples.
+
+    :param lines: LineStrings, e.g. a GeoSeries, in the (projected) CRS of
+                  the elevation source.
+    :type lines: iterable of shapely.geometry.LineString
+    :param elevation: Either a DEM (see `sample`) or a function that takes
+                      arrays of x and y coordinates and returns elevations,
+                      e.g. a scipy `LinearNDInterpolator` of intersection
+                      elevations. Samples with a NaN elevation are ignored.
+    :type elevation: rasterio.io.DatasetReader, TileCache, DEMCollection or
+                     callable
+    :param step: The maximum distance between samples.
+    :type step: float
+    :param max_points: The approximate maximum number of points to sample at
+                       a time.
+    :type max_points: int
+    :returns: pandas.DataFrame with `incline_mean`, `incline_max` and
+              `incline_min` columns, with the same index as `lines` if it has
+              one. Lines of length 0, and missing or empty lines, get NaN
+              inclines.
+
+    '''
+    index = lines.index if isinstance(lines, pd.Series) else None
+    lines = list(lines)
+    if callable(elevation):
+        def sampler(xs, ys):
+            return np.asarray(elevation(xs, ys), dtype=float).reshape(-1)
+    else:
+        def sampler(xs, ys):
+            return sample(elevation, xs, ys)
+
+    # Estimate the number of samples per line to find the chunk boundaries
+    lengths = np.nan_to_num(line_lengths(lines))
+    n_samples = np.maximum(np.ceil(lengths / step), 1) + 1
+    cumulative = np.cumsum(n_samples)
+    bounds = [0]
+    while bounds[-1] < len(lines):
+        done = cumulative[bounds[-1] - 1] if bounds[-1] else 0
+        end = np.searchsorted(cumulative, done + max_points, side='right')
+        # Always make progress, even with a very long line
+        bounds.append(max(int(end), bounds[-1] + 1))
+
+    means = np.full(len(lines), np.nan)
+    maxes = np.full(len(lines), np.nan)
+    mins = np.full(len(lines), np.nan)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        xy, offsets, distances = densify(lines[start:end], step)
+        # Lines without samples (missing or empty) keep NaN inclines. The
+        # samples of the others are contiguous.
+        sampled = np.flatnonzero(np.diff(offsets) > 0)
+        if not sampled.size:
+            continue
+        offsets = np.r_[offsets[sampled], offsets[-1]]
+        z = sampler(xy[:, 0], xy[:, 1])
+
+        # Inclines of the sections between consecutive samples. Every line
+        # has at least 2 samples, so at least one section.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inclines = np.diff(z) / np.diff(distances)
+        inclines[~np.isfinite(inclines)] = np.nan
+        within = np.ones(inclines.shape[0], dtype=bool)
+        within[offsets[1:-1] - 1] = False
+        inclines = inclines[within]
+        # Each line's sections start at its first sample, less the dropped
+        # section for every line before it
+        section_offsets = offsets[:-1] - np.arange(sampled.shape[0])
+
+        sampled = sampled + start
+        maxes[sampled] = np.fmax.reduceat(inclines, section_offsets)
+        mins[sampled] = np.fmin.reduceat(inclines, section_offsets)
+
+        rise = z[offsets[1:] - 1] - z[offsets[:-1]]
+        run = distances[offsets[1:] - 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means[sampled] = np.where(run > 0, rise / run, np.nan)
+
+    return pd.DataFrame({
+        'incline_mean': means,
+        'incline_max': maxes,
+        'incline_min': mins,
+    }, index=index, columns=['incline_mean', 'incline_max', 'incline_min'])
+
+
+@timed
 def interpolated_value(x, y, dem, method='bilinear', scaling_factor=1.0):
     '''Given a point (x, y), find the interpolated value in the raster using
     bilinear interpolation.
 
     '''
+    if isinstance(dem, DEMCollection):
+        return dem.sample([x], [y], method=method,
+                          scaling_factor=scaling_factor)[0]
+
     methods = {
         'spline': bivariate_spline,
         'bilinear': bilinear
@@ -96,6 +604,124 @@ def interpolated_value(x, y, dem, method='bilinear', scaling_factor=1.0):
     return scaling_factor * interpolated
 
 
+@timed
+def sample(dem, xs, ys, method='bilinear', scaling_factor=1.0):
+    '''Given arrays of x and y coordinates, find the interpolated values in
+    the raster. Gives the same results as calling `interpolated_value` for
+    every point, but points are grouped by the raster's internal blocks so
+    that each block (plus a small halo for windows that straddle a block
+    edge) is read once, and the interpolation is done in bulk.
+
+    Points too close to the edge of the raster for a full interpolation
+    window get a value of NaN.
+
+    :param dem: An open rasterio dataset, `TileCache` or `DEMCollection`.
+    :type dem: rasterio.io.DatasetReader
+    :param xs: x coordinates, in the CRS of the DEM.
+    :type xs: array-like of floats
+    :param ys: y coordinates, in the CRS of the DEM.
+    :type ys: array-like of floats
+    :param method: The interpolation method: 'bilinear' or 'spline'.
+    :type method: str
+    :param scaling_factor: A multiplier applied to the interpolated values.
+    :type scaling_factor: float
+    :returns: numpy.ndarray of interpolated values.
+
+    '''
+    if isinstance(dem, DEMCollection):
+        return dem.sample(xs, ys, method=method, scaling_factor=scaling_factor)
+
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    count('raster_interp.points', xs.shape[0])
+
+    # Window size and position of the point within it: see
+    # interpolated_value.
+    if method == 'bilinear':
+        dim = 2
+        offset = 0
+        interpolator = bilinear_many
+    elif method == 'spline':
+        dim = 3
+        offset = 1
+        interpolator = bivariate_spline_many
+    else:
+        raise ValueError('Invalid interpolation method {} selected'.format(
+            method
+        ))
+
+    # In-DEM index coordinates
+    inv = ~dem.transform
+    _x, _y = inv * (xs, ys)
+    _x = np.asarray(_x, dtype=float)
+    _y = np.asarray(_y, dtype=float)
+
+    offset_x = np.floor(_x).astype(int) - offset
+    offset_y = np.floor(_y).astype(int) - offset
+    dx = _x - offset_x
+    dy = _y - offset_y
+
+    values = np.full(xs.shape, np.nan)
+
+    in_bounds = (offset_x >= 0) & (offset_y >= 0) & \
+                (offset_x + dim <= dem.width) & (offset_y + dim <= dem.height)
+    idx = np.nonzero(in_bounds)[0]
+    if not idx.size:
+        return values
+
+    # Group points by the block that contains their window's first pixel
+    block_height, block_width = dem.block_shapes[0]
+    block_row = offset_y[idx] // block_height
+    block_col = offset_x[idx] // block_width
+    n_block_cols = -(-dem.width // block_width)
+    keys = block_row * n_block_cols + block_col
+
+    order = np.argsort(keys, kind='mergesort')
+    idx = idx[order]
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], keys.size]
+
+    for start, end in zip(starts, ends):
+        members = idx[start:end]
+        row_off = int(keys[start] // n_block_cols) * block_height
+        col_off = int(keys[start] % n_block_cols) * block_width
+        # Include enough of the next block to fit windows on the block edge
+        height = min(block_height + dim - 1, dem.height - row_off)
+        width = min(block_width + dim - 1, dem.width - col_off)
+        arr = dem.read(1, window=Window(col_off, row_off, width, height))
+
+        values[members] = interpolator(
+            arr.astype(float),
+            offset_y[members] - row_off,
+            offset_x[members] - col_off,
+            dx[members],
+            dy[members]
+        )
+
+    return scaling_factor * values
+
+
+def check_coverage(values, xs, ys):
+    '''Raise a ValueError if any point could not be sampled (see `sample`),
+    naming the first such point, rather than passing on NaN values.
+
+    :param values: The sampled values.
+    :type values: numpy.ndarray
+    :param xs: x coordinates of the points, in the CRS of the DEM.
+    :type xs: array-like of floats
+    :param ys: y coordinates of the points, in the CRS of the DEM.
+    :type ys: array-like of floats
+
+    '''
+    missing = np.flatnonzero(np.isnan(values))
+    if missing.size:
+        i = missing[0]
+        raise ValueError('Point ({}, {}) is not covered by the DEM'.format(
+            xs[i], ys[i]
+        ))
+
+
 def bivariate_spline(dx, dy, arr):
     nrow, ncol = arr.shape
 
@@ -115,3 +741,32 @@ def bilinear(dx, dy, arr):
     bottom = dx * arr[1, 0] + (1 - dx) * arr[1, 1]
 
     return dy * top + (1 - dy) * bottom
+
+
+def bilinear_many(arr, rows, cols, dx, dy):
+    # Vectorized version of `bilinear`, where rows and cols give the top-left
+    # corner of each point's 2x2 window in arr.
+    top = dx * arr[rows, cols] + (1 - dx) * arr[rows, cols + 1]
+    bottom = dx * arr[rows + 1, cols] + (1 - dx) * arr[rows + 1, cols + 1]
+
+    return dy * top + (1 - dy) * bottom
+
+
+def bivariate_spline_many(arr, rows, cols, dx, dy):
+    # Vectorized version of `bivariate_spline`, where rows and cols give the
+    # top-left corner of each point's 3x3 window in arr. With 3 samples per
+    # axis, the degree-2 interpolating spline is a quadratic polynomial, so
+    # it is evaluated directly using Lagrange basis polynomials. Note that,
+    # as in `bivariate_spline`, dx runs along window rows and dy along columns.
+    def basis(t):
+        return [(t - 1) * (t - 2) / 2, -t * (t - 2), t * (t - 1) / 2]
+
+    bx = basis(dx)
+    by = basis(dy)
+
+    result = np.zeros(dx.shape)
+    for i in range(3):
+        for j in range(3):
+            result += bx[i] * by[j] * arr[rows + i, cols + j]
+
+    return result
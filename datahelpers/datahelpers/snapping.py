@@ -0,0 +1,195 @@
+'''Snap points to lines in bulk: to the nearest line of a layer
+(`snap_points`, `snap_ends`), or to the line with a given key
+(`snap_to_keys`), e.g. curb ramps to the sidewalk they belong to.
+
+Points are snapped all at once, and the result is a GeoDataFrame with, for
+every point, the position of the line it was snapped to (`line`, -1 if none),
+the distance to it (`distance`), the distance along the line to the snapped
+point (`distance_along`) and the snapped point itself (`geometry`).
+
+'''
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from .geometry import (boxes, coordinate_arrays, interpolate_points,
+                       line_lengths, lines, pairwise_distances, points,
+                       project_points, query_bulk, query_nearest)
+from .instrumentation import count, timed
+
+
+@timed
+def snap_points(geometries, targets, max_distance=None, search_radius=None,
+                normalized=False):
+    '''Snap points to the nearest of a layer of lines.
+
+    :param geometries: The points to snap.
+    :type geometries: geopandas.GeoSeries
+    :param targets: The lines to snap to.
+    :type targets: geopandas.GeoSeries
+    :param max_distance: If set, points farther than this from every line
+                         aren't snapped.
+    :type max_distance: float
+    :param search_radius: If set, only lines whose bounding box intersects
+                          the square of this radius around a point are
+                          candidates, as in a spatial index query by box. The
+                          nearest of them is used, even if it is farther
+                          away than the radius.
+    :type search_radius: float
+    :param normalized: Whether `distance_along` is a fraction of the line's
+                       length rather than a distance.
+    :type normalized: bool
+    :returns: geopandas.GeoDataFrame with the index of `geometries`.
+
+    '''
+    count('snapping.points', len(geometries))
+    if search_radius is not None:
+        line_idx = _nearest_in_boxes(_list(geometries), targets,
+                                     search_radius, max_distance)
+    else:
+        line_idx, _ = query_nearest(_list(geometries), _list(targets),
+                                    max_distance=max_distance)
+    return _snapped(geometries, targets, line_idx, normalized)
+
+
+@timed
+def snap_to_keys(geometries, keys, targets, target_keys, normalized=False):
+    '''Snap points to particular lines: each point to the line with its key,
+    e.g. curb ramps (by `sw_pkey`) to sidewalks (by `pkey`). Points are
+    joined to lines all at once rather than by looking up every key. If
+    keys are repeated in `target_keys`, the first line with the key is used.
+
+    :param geometries: The points to snap.
+    :type geometries: geopandas.GeoSeries
+    :param keys: The key of the line to snap every point to. Points whose
+                 key is missing (or isn't a key of any line, or whose line is
+                 empty) aren't snapped.
+    :type keys: array-like
+    :param targets: The lines to snap to.
+    :type targets: geopandas.GeoSeries
+    :param target_keys: The key of every line.
+    :type target_keys: array-like
+    :param normalized: Whether `distance_along` is a fraction of the line's
+                       length rather than a distance.
+    :type normalized: bool
+    :returns: geopandas.GeoDataFrame with the index of `geometries`.
+
+    '''
+    count('snapping.points', len(geometries))
+    line_idx = key_positions(keys, target_keys)
+    valid = np.array([g is not None and not g.is_empty
+                      for g in _list(targets)], dtype=bool)
+    line_idx[(line_idx >= 0) & ~valid[np.maximum(line_idx, 0)]] = -1
+    return _snapped(geometries, targets, line_idx, normalized)
+
+
+@timed
+def snap_ends(paths, targets, max_distance=None, search_radius=None):
+    '''Move the ends of lines to the nearest point on the nearest of a layer
+    of lines, e.g. to connect paths to a sidewalk network.
+
+    :param paths: The lines whose ends are snapped.
+    :type paths: geopandas.GeoSeries
+    :param targets: The lines to snap to.
+    :type targets: geopandas.GeoSeries
+    :param max_distance: If set, ends farther than this from every line stay
+                         where they are.
+    :type max_distance: float
+    :param search_radius: If set, only lines whose bounding box intersects
+                          the square of this radius around an end are
+                          candidates (see `snap_points`). Ends without any
+                          candidate stay where they are.
+    :type search_radius: float
+    :returns: list of shapely.geometry.LineString
+
+    '''
+    coords, offsets = coordinate_arrays(paths)
+    coords = coords.copy()
+    ends = np.concatenate([offsets[:-1], offsets[1:] - 1])
+    snapped = snap_points(gpd.GeoSeries(points(coords[ends])), targets,
+                          max_distance=max_distance,
+                          search_radius=search_radius)
+    found = snapped['line'].values >= 0
+    coords[ends[found]] = coordinate_arrays(
+        snapped['geometry'].values[found]
+    )[0]
+    return lines(coords, offsets)
+
+
+def key_positions(keys, target_keys):
+    '''The position in target_keys of (the first of) every key, or -1 if it
+    isn't there or is missing.
+
+    :returns: numpy.ndarray of int
+
+    '''
+    target_keys = pd.Series(np.asarray(target_keys))
+    first = np.flatnonzero(~target_keys.duplicated().values)
+    index = pd.Index(target_keys.values[first])
+    keys = pd.Series(np.asarray(keys))
+    positions = index.get_indexer(keys.values)
+    found = (positions >= 0) & keys.notnull().values
+    return np.where(found, first[np.maximum(positions, 0)], -1)
+
+
+def _nearest_in_boxes(geometries, targets, radius, max_distance):
+    # The nearest of the targets whose bounding boxes intersect a box around
+    # every geometry, first come first served on ties
+    bounds = np.array([g.bounds for g in geometries], dtype=float)
+    bounds = bounds.reshape(-1, 4) + np.array([-radius, -radius,
+                                               radius, radius])
+    targets = _list(targets)
+    i, j = query_bulk(gpd.GeoSeries(targets).sindex,
+                      gpd.GeoSeries(boxes(bounds)))
+    d = pairwise_distances([geometries[k] for k in i],
+                           [targets[k] for k in j])
+    if max_distance is not None:
+        i = i[d <= max_distance]
+        j = j[d <= max_distance]
+        d = d[d <= max_distance]
+
+    line_idx = np.full(len(geometries), -1, dtype=int)
+    order = np.lexsort((j, d, i))
+    i = i[order]
+    first = np.ones(i.shape[0], dtype=bool)
+    first[1:] = i[1:] != i[:-1]
+    line_idx[i[first]] = j[order][first]
+    return line_idx
+
+
+def _snapped(geometries, targets, line_idx, normalized):
+    index = getattr(geometries, 'index', None)
+    crs = getattr(targets, 'crs', None)
+    geometries = _list(geometries)
+    targets = _list(targets)
+
+    found = np.flatnonzero(line_idx >= 0)
+    hit_lines = [targets[i] for i in line_idx[found]]
+    hit_points = [geometries[i] for i in found]
+
+    distance = np.full(len(geometries), np.nan)
+    distance_along = np.full(len(geometries), np.nan)
+    snapped = [None] * len(geometries)
+    along = project_points(hit_lines, hit_points)
+    for i, point in zip(found.tolist(), interpolate_points(hit_lines, along)):
+        snapped[i] = point
+    distance[found] = pairwise_distances(hit_points, hit_lines)
+    if normalized:
+        lengths = line_lengths(hit_lines)
+        along = along / np.where(lengths > 0, lengths, 1.0)
+    distance_along[found] = along
+
+    return gpd.GeoDataFrame({
+        'line': line_idx,
+        'distance': distance,
+        'distance_along': distance_along,
+        'geometry': snapped,
+    }, index=index, geometry='geometry', crs=crs)
+
+
+def _list(geometries):
+    # A GeoSeries' geometries are converted all at once, rather than by
+    # iterating over it
+    if isinstance(geometries, gpd.GeoSeries):
+        return np.asarray(geometries.values, dtype=object).tolist()
+    return list(geometries)
@@ -0,0 +1,326 @@
+import json
+import struct
+
+import numpy as np
+
+
+# The number of children of every node
+NODE_SIZE = 16
+
+MAGIC = b'DHRTREE1'
+
+# magic, node size, (reserved), number of items, number of nodes
+HEADER = struct.Struct('<8sIIQQ')
+
+# Internal nodes: the bounds of their children and the position of their
+# first child. Leaves: the bounds and id of an item.
+NODE_DTYPE = np.dtype([
+    ('minx', '<f8'),
+    ('miny', '<f8'),
+    ('maxx', '<f8'),
+    ('maxy', '<f8'),
+    ('index', '<u8'),
+])
+
+# Byte ranges of items in a data file, by item id
+RANGE_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('length', '<u8'),
+])
+
+HILBERT_MAX = 2**16 - 1
+
+
+class PackedRTree:
+    '''A static, packed R-tree of bounding boxes. Items are sorted along a
+    Hilbert curve (by the centers of their boxes) and grouped into full
+    nodes of `node_size`, level by level, as in FlatGeobuf's index. Nodes are
+    stored root first in one flat array, so a saved tree can be memory-mapped
+    and searched without reading all of it.
+
+    The tree can also store the byte range of every item in a data file
+    (e.g. the features of a GeoJSON file), so that consumers can read just
+    the items in a bounding box: see `read_features`.
+
+    :param nodes: The nodes, root first (see NODE_DTYPE).
+    :type nodes: numpy.ndarray
+    :param num_items: The number of items (leaves).
+    :type num_items: int
+    :param node_size: The number of children of every node.
+    :type node_size: int
+    :param ranges: The byte ranges of items, by item id (see RANGE_DTYPE).
+    :type ranges: numpy.ndarray
+
+    '''
+    def __init__(self, nodes, num_items, node_size=NODE_SIZE, ranges=None):
+        self.nodes = nodes
+        self.num_items = num_items
+        self.node_size = node_size
+        self.ranges = ranges
+        self.level_bounds = level_bounds(num_items, node_size)
+
+    @classmethod
+    def build(cls, boxes, ranges=None, node_size=NODE_SIZE):
+        '''Build a tree.
+
+        :param boxes: An (n, 4) array of (minx, miny, maxx, maxy) bounds,
+                      one per item. Item ids are positions in this array.
+                      Empty items have NaN bounds, and are never found.
+        :type boxes: numpy.ndarray
+        :param ranges: An (n, 2) array of the byte offset and length of
+                       every item in a data file.
+        :type ranges: numpy.ndarray
+        :param node_size: The number of children of every node.
+        :type node_size: int
+
+        '''
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        n = boxes.shape[0]
+        bounds = level_bounds(n, node_size)
+        nodes = np.zeros(bounds[-1][1] if bounds else 0, dtype=NODE_DTYPE)
+
+        if n:
+            order = np.argsort(hilbert_values(boxes), kind='mergesort')
+            start, end = bounds[0]
+            leaves = nodes[start:end]
+            leaves['minx'], leaves['miny'] = boxes[order, 0], boxes[order, 1]
+            leaves['maxx'], leaves['maxy'] = boxes[order, 2], boxes[order, 3]
+            leaves['index'] = order
+
+            # Each level up bounds groups of node_size nodes of the level below
+            # (fmin/fmax skip the NaN bounds of empty items)
+            for (child_start, child_end), (start, end) in zip(bounds[:-1],
+                                                              bounds[1:]):
+                firsts = np.arange(child_start, child_end, node_size)
+                children = nodes[child_start:child_end]
+                groups = firsts - child_start
+                parents = nodes[start:end]
+                parents['minx'] = np.fmin.reduceat(children['minx'], groups)
+                parents['miny'] = np.fmin.reduceat(children['miny'], groups)
+                parents['maxx'] = np.fmax.reduceat(children['maxx'], groups)
+                parents['maxy'] = np.fmax.reduceat(children['maxy'], groups)
+                parents['index'] = firsts
+
+            # Store the root first
+            nodes = _root_first(nodes, bounds)
+
+        if ranges is not None:
+            ranges = np.asarray(ranges).reshape(-1, 2)
+            packed = np.empty(n, dtype=RANGE_DTYPE)
+            packed['offset'] = ranges[:, 0]
+            packed['length'] = ranges[:, 1]
+            ranges = packed
+
+        return cls(nodes, n, node_size=node_size, ranges=ranges)
+
+    @classmethod
+    def load(cls, path):
+        '''Memory-map a tree written by `save`.'''
+        with open(path, 'rb') as f:
+            magic, node_size, _, num_items, num_nodes = HEADER.unpack(
+                f.read(HEADER.size)
+            )
+            f.seek(0, 2)
+            size = f.tell()
+        if magic != MAGIC:
+            raise ValueError('{} is not a packed R-tree'.format(path))
+
+        offset = HEADER.size
+        nodes = np.empty(0, dtype=NODE_DTYPE)
+        if num_nodes:
+            nodes = np.memmap(path, dtype=NODE_DTYPE, mode='r',
+                              offset=offset, shape=(num_nodes,))
+        offset += num_nodes * NODE_DTYPE.itemsize
+        ranges = None
+        if num_items and size >= offset + num_items * RANGE_DTYPE.itemsize:
+            ranges = np.memmap(path, dtype=RANGE_DTYPE, mode='r',
+                               offset=offset, shape=(num_items,))
+
+        return cls(nodes, num_items, node_size=node_size, ranges=ranges)
+
+    def save(self, path):
+        '''Write the tree (and item byte ranges, if any) to a file.'''
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.node_size, 0, self.num_items,
+                                self.nodes.shape[0]))
+            f.write(np.ascontiguousarray(self.nodes).tobytes())
+            if self.ranges is not None:
+                f.write(np.ascontiguousarray(self.ranges).tobytes())
+
+    def search(self, minx, miny, maxx, maxy):
+        '''Find the items whose boxes intersect a bounding box.
+
+        :returns: The ids of the items, in ascending order.
+        :rtype: numpy.ndarray
+
+        '''
+        if not self.num_items:
+            return np.empty(0, dtype=np.int64)
+
+        # Positions of the nodes to check, from the root down, one level at
+        # a time. Levels are stored root first, so flip the bounds.
+        num_nodes = self.nodes.shape[0]
+        levels = [(num_nodes - end, num_nodes - start)
+                  for start, end in self.level_bounds][::-1]
+        frontier = np.array([0])
+        for depth, (start, end) in enumerate(levels):
+            nodes = self.nodes[frontier]
+            hit = (nodes['minx'] <= maxx) & (nodes['maxx'] >= minx) & \
+                (nodes['miny'] <= maxy) & (nodes['maxy'] >= miny)
+            frontier = frontier[hit]
+            if depth == len(levels) - 1:
+                break
+
+            # Children of the remaining nodes. The last node of a level can
+            # have fewer than node_size children.
+            first = self.nodes['index'][frontier].astype(np.int64)
+            child_end = levels[depth + 1][1]
+            frontier = (first[:, np.newaxis] +
+                        np.arange(self.node_size)).reshape(-1)
+            frontier = frontier[frontier < child_end]
+
+        return np.sort(self.nodes['index'][frontier].astype(np.int64))
+
+
+def level_bounds(num_items, node_size=NODE_SIZE):
+    '''The [start, end) positions of each level of a packed R-tree, leaves
+    first, when the leaves are stored first.
+
+    '''
+    if not num_items:
+        return []
+    sizes = [num_items]
+    while sizes[-1] > 1:
+        sizes.append(-(-sizes[-1] // node_size))
+    bounds = []
+    start = 0
+    for size in sizes:
+        bounds.append((start, start + size))
+        start += size
+    return bounds
+
+
+def _root_first(nodes, bounds):
+    # Reverse the order of levels (keeping the order within levels) and
+    # update the child positions of internal nodes to match.
+    num_nodes = nodes.shape[0]
+    reordered = np.concatenate([nodes[start:end]
+                                for start, end in bounds[::-1]])
+    # Leaves first, the first node of level l is at bounds[l][0]. Root
+    # first, it is at num_nodes - bounds[l][1].
+    n_leaves = bounds[0][1]
+    internal = reordered[:num_nodes - n_leaves]
+    child = internal['index'].astype(np.int64)
+    starts = np.array([start for start, _ in bounds])
+    ends = np.array([end for _, end in bounds])
+    level = np.searchsorted(ends, child, side='right')
+    internal['index'] = num_nodes - ends[level] + (child - starts[level])
+    reordered[:num_nodes - n_leaves] = internal
+    return reordered
+
+
+def hilbert_values(boxes, extent=None):
+    '''The position of the center of every box along a Hilbert curve over a
+    2**16 by 2**16 grid covering the extent of the boxes.
+
+    :param boxes: An (n, 4) array of (minx, miny, maxx, maxy) bounds. Empty
+                  items have NaN bounds.
+    :type boxes: numpy.ndarray
+    :param extent: The (minx, miny, maxx, maxy) extent of the grid. Defaults
+                   to the extent of the boxes.
+    :type extent: tuple of float
+    :returns: numpy.ndarray of uint32.
+
+    '''
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    # Empty items (NaN bounds) go first
+    empty = np.isnan(boxes).any(axis=1)
+    if extent is None:
+        if empty.all():
+            extent = (0.0, 0.0, 1.0, 1.0)
+        else:
+            extent = (boxes[~empty, 0].min(), boxes[~empty, 1].min(),
+                      boxes[~empty, 2].max(), boxes[~empty, 3].max())
+    width = max(extent[2] - extent[0], 1e-300)
+    height = max(extent[3] - extent[1], 1e-300)
+
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    x = np.clip(HILBERT_MAX * (cx - extent[0]) / width, 0, HILBERT_MAX)
+    y = np.clip(HILBERT_MAX * (cy - extent[1]) / height, 0, HILBERT_MAX)
+    x[empty] = 0
+    y[empty] = 0
+    x = np.floor(x).astype(np.uint32)
+    y = np.floor(y).astype(np.uint32)
+
+    return _hilbert(x, y)
+
+
+def _hilbert(x, y):
+    # Vectorized 16-bit Hilbert curve index of grid cells, after
+    # http://threadlocalmutex.com/?p=126 (as used by FlatGeobuf)
+    x = np.asarray(x, dtype=np.uint32)
+    y = np.asarray(y, dtype=np.uint32)
+    mask = np.uint32(0xFFFF)
+
+    a = x ^ y
+    b = mask ^ a
+    c = mask ^ (x | y)
+    d = x & (y ^ mask)
+
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+
+    for shift in (2, 4):
+        a, b, c, d = A, B, C, D
+        A = (a & (a >> shift)) ^ (b & (b >> shift))
+        B = (a & (b >> shift)) ^ (b & ((a ^ b) >> shift))
+        C = C ^ ((a & (c >> shift)) ^ (b & (d >> shift)))
+        D = D ^ ((b & (c >> shift)) ^ ((a ^ b) & (d >> shift)))
+
+    a, b, c, d = A, B, C, D
+    C = C ^ ((a & (c >> 8)) ^ (b & (d >> 8)))
+    D = D ^ ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+
+    i0 = x ^ y
+    i1 = b | (mask ^ (i0 | a))
+
+    def interleave(v):
+        v = (v | (v << 8)) & np.uint32(0x00FF00FF)
+        v = (v | (v << 4)) & np.uint32(0x0F0F0F0F)
+        v = (v | (v << 2)) & np.uint32(0x33333333)
+        v = (v | (v << 1)) & np.uint32(0x55555555)
+        return v
+
+    return (interleave(i1) << 1) | interleave(i0)
+
+
+def read_features(data_path, index_path, bounds):
+    '''Read the GeoJSON features whose bounding boxes intersect a bounding
+    box, using a packed R-tree with byte ranges (e.g. as written by
+    merge.py) to read only those features from the data file.
+
+    :param data_path: The path to the GeoJSON file.
+    :type data_path: str
+    :param index_path: The path to its index.
+    :type index_path: str
+    :param bounds: The (minx, miny, maxx, maxy) bounding box.
+    :type bounds: tuple of float
+    :returns: generator of GeoJSON Feature dicts, in file order.
+
+    '''
+    tree = PackedRTree.load(index_path)
+    if tree.ranges is None:
+        raise ValueError('{} has no byte ranges'.format(index_path))
+    items = tree.search(*bounds)
+    ranges = tree.ranges[items]
+    with open(data_path, 'rb') as f:
+        for offset, length in zip(ranges['offset'].tolist(),
+                                  ranges['length'].tolist()):
+            f.seek(offset)
+            yield json.loads(f.read(length).decode('utf-8'))
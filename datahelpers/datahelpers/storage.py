@@ -0,0 +1,181 @@
+from collections import OrderedDict
+import numbers
+import os
+import threading
+
+import geopandas as gpd
+import pandas as pd
+
+from .instrumentation import count, timed
+from .io import gdf_to_geojson
+
+
+WGS84 = 4326
+
+# File extensions of the columnar binary (GeoParquet) format. Geometries are
+# stored as WKB and the CRS is stored in the file metadata.
+BINARY_EXTENSIONS = ('.parquet', '.geoparquet')
+
+
+class LayerCache:
+    '''An in-process cache of binary layers, keyed by the path they were
+    written to. When multiple pipeline stages run in the same process (e.g.
+    `snakemake all`, where `run:` blocks execute in the Snakemake process),
+    a stage that reads a layer written by a previous stage gets it straight
+    from memory instead of re-parsing the file.
+
+    Entries remember the size and modification time of the file at the time
+    it was written and are discarded if the file has since changed on disk.
+    Only binary layers are cached, as they round-trip exactly: a cached read
+    returns the same data as reading the file.
+
+    :param max_layers: The maximum number of layers to keep in memory, least
+                       recently used layers are evicted first. 0 disables the
+                       cache.
+    :type max_layers: int
+
+    '''
+    def __init__(self, max_layers=16):
+        self.max_layers = max_layers
+        self.hits = 0
+        self.misses = 0
+        self._layers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, path, gdf):
+        if not self.max_layers:
+            return
+        key = os.path.abspath(path)
+        with self._lock:
+            self._layers[key] = (_file_signature(path), gdf.copy())
+            self._layers.move_to_end(key)
+            while len(self._layers) > self.max_layers:
+                self._layers.popitem(last=False)
+
+    def get(self, path):
+        key = os.path.abspath(path)
+        with self._lock:
+            entry = self._layers.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            signature, gdf = entry
+            if signature != _file_signature(path):
+                # The file was changed by something else - stale
+                del self._layers[key]
+                self.misses += 1
+                return None
+            self._layers.move_to_end(key)
+            self.hits += 1
+        # Stages modify their inputs in-place, so always hand out a copy
+        return gdf.copy()
+
+    def clear(self):
+        with self._lock:
+            self._layers.clear()
+
+
+cache = LayerCache()
+
+
+@timed
+def read_layer(path):
+    '''Read a layer written by `write_layer` (or any GeoJSON file), using the
+    in-process cache when possible. Layers without a CRS are assumed to be
+    lon-lat (WGS84), as is the case for GeoJSON.
+
+    :param path: Path to a GeoJSON or GeoParquet file.
+    :type path: str
+    :returns: geopandas.GeoDataFrame
+
+    '''
+    gdf = cache.get(path)
+    if gdf is None:
+        count('storage.files_read')
+        if is_binary(path):
+            gdf = gpd.read_parquet(path)
+        else:
+            gdf = gpd.read_file(path)
+    count('storage.rows_read', gdf.shape[0])
+    if gdf.crs is None:
+        gdf.crs = WGS84
+
+    return gdf
+
+
+@timed
+def write_layer(gdf, path):
+    '''Write a layer to disk, in the columnar binary format if the path ends
+    in `.parquet` (kept in the in-process cache for later stages), otherwise
+    as GeoJSON. As with GeoJSON, the index is not kept.
+
+    The binary format needs every column to hold a single type: columns that
+    mix numbers of different types, e.g. after concatenating layers, are
+    written as floats, and columns that mix other types are an error (see
+    `single_typed`).
+
+    :param gdf: A layer with a `geometry` column.
+    :type gdf: geopandas.GeoDataFrame or pandas.DataFrame
+    :param path: The output path.
+    :type path: str
+
+    '''
+    if not isinstance(gdf, gpd.GeoDataFrame):
+        # e.g. the result of pd.concat-ing GeoDataFrames
+        gdf = gpd.GeoDataFrame(gdf, geometry='geometry')
+    gdf = gdf.reset_index(drop=True)
+    count('storage.rows_written', gdf.shape[0])
+
+    if is_binary(path):
+        gdf = single_typed(gdf)
+        gdf.to_parquet(path)
+        cache.put(path, gdf)
+    else:
+        gdf_to_geojson(gdf, path)
+
+
+def is_binary(path):
+    return os.path.splitext(path)[1].lower() in BINARY_EXTENSIONS
+
+
+def single_typed(gdf):
+    '''Convert the (non-geometry) object columns whose values are numbers of
+    mixed types (e.g. ints, floats and booleans) to floats. Missing values
+    stay missing.
+
+    :param gdf: A layer.
+    :type gdf: geopandas.GeoDataFrame
+    :returns: geopandas.GeoDataFrame, a copy if any column was converted.
+    :raises ValueError: If a column mixes other types, e.g. numbers and
+                        strings: convert it explicitly first.
+
+    '''
+    converted = {}
+    for name in gdf.columns:
+        column = gdf[name]
+        if name == gdf.geometry.name or column.dtype != object:
+            continue
+        present = column.notnull().values
+        types = set(type(value) for value in column.values[present])
+        if len(types) < 2:
+            continue
+        if not all(issubclass(t, numbers.Number) for t in types):
+            raise ValueError('Column {} has values of mixed types: {}'.format(
+                name, ', '.join(sorted(t.__name__ for t in types))
+            ))
+        converted[name] = column.astype(float)
+    if not converted:
+        return gdf
+
+    gdf = gdf.copy()
+    for name, column in converted.items():
+        gdf[name] = column
+    return gdf
+
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
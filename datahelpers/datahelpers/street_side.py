@@ -0,0 +1,136 @@
+import numpy as np
+
+from .geometry import (coordinate_arrays, interpolate_points, line_lengths,
+                       project_points)
+
+
+LEFT = 'left'
+RIGHT = 'right'
+UNKNOWN = 'unknown'
+
+
+def street_sides(sidewalks, streets):
+    '''Classify which side of its street each sidewalk is on, using the
+    midpoint of the sidewalk and the sign of the cross product with the
+    street segment found by walking the street's coordinates up to the
+    midpoint's projection (as the Seattle `infer_sidewalk_offsets` rule
+    always has).
+
+    Note that the segment used is the one *before* the segment that contains
+    the projection - for the first segment, the closing segment from the
+    street's last coordinate to its first - or the last segment if the walk
+    ends without passing the projection. This reproduces the segment
+    indexing of the per-row implementation, so that sides (and the offsets
+    derived from them) stay the same.
+
+    :param sidewalks: Sidewalk lines.
+    :type sidewalks: geopandas.GeoSeries or list of LineStrings
+    :param streets: For each sidewalk, its street. Missing streets (None) and
+                    missing or empty sidewalks get a side of 'unknown'.
+    :type streets: geopandas.GeoSeries or list of LineStrings
+    :returns: 'left', 'right' or 'unknown' for every sidewalk.
+    :rtype: numpy.ndarray
+
+    '''
+    sidewalks = list(sidewalks)
+    streets = list(streets)
+
+    # Missing and empty geometries have no coordinates
+    sidewalk_coords, sidewalk_offsets = coordinate_arrays(sidewalks)
+    street_coords, street_offsets = coordinate_arrays(streets)
+    known = (np.diff(sidewalk_offsets) > 0) & (np.diff(street_offsets) > 0)
+
+    sides = np.full(len(sidewalks), UNKNOWN, dtype=object)
+    idx = np.flatnonzero(known)
+    if not idx.size:
+        return sides
+    sidewalks = [sidewalks[i] for i in idx]
+    streets = [streets[i] for i in idx]
+
+    # The midpoint of each sidewalk and its projection onto the street
+    midpoints = interpolate_points(sidewalks, 0.5 * line_lengths(sidewalks))
+    distances = project_points(streets, midpoints)
+    midpoints = coordinate_arrays(midpoints)[0]
+
+    coords, offsets = coordinate_arrays(streets)
+    counts = np.diff(offsets)
+    first, second = _segments(coords, offsets, counts, distances)
+
+    ds = coords[second] - coords[first]
+    dp = midpoints - coords[first]
+    cross_product = ds[:, 0] * dp[:, 1] - ds[:, 1] * dp[:, 0]
+
+    sides[idx] = np.where(cross_product > 0, LEFT, RIGHT)
+
+    return sides
+
+
+def infer_offsets(sidewalks, streets, widths, margin=7.5, scale=1.0):
+    '''Infer the side of the street and the signed offset from the street
+    centerline of every sidewalk (positive on the right, negative on the
+    left), given the width of each street: offset = (width / 2 + margin).
+
+    :param sidewalks: Sidewalk lines.
+    :type sidewalks: geopandas.GeoSeries or list of LineStrings
+    :param streets: For each sidewalk, its street (or None).
+    :type streets: geopandas.GeoSeries or list of LineStrings
+    :param widths: For each sidewalk, the width of its street.
+    :type widths: array of float
+    :param margin: Distance from the edge of the street to the sidewalk.
+    :type margin: float
+    :param scale: Factor applied to offsets, e.g. to convert feet to meters.
+    :type scale: float
+    :returns: The side ('left', 'right' or 'unknown') and offset (0 for
+              unknown sides) of every sidewalk.
+    :rtype: tuple of numpy.ndarray
+
+    '''
+    sides = street_sides(sidewalks, streets)
+    widths = np.asarray(widths, dtype=float)
+
+    sign = np.where(sides == RIGHT, 1, -1)
+    offsets = sign * (widths / 2 + margin)
+    offsets = offsets * scale
+    offsets[sides == UNKNOWN] = 0
+
+    return sides, offsets
+
+
+def _segments(coords, offsets, counts, distances):
+    # For every line (coords[offsets[i]:offsets[i + 1]]), the positions of
+    # the start and end coordinates of the segment to test against, as
+    # described in `street_sides`.
+    n = counts.shape[0]
+    first = np.empty(n, dtype=int)
+    second = np.empty(n, dtype=int)
+
+    # Lines with the same number of coordinates are processed together, so
+    # that cumulative lengths are summed in the same order as walking each
+    # line would.
+    for count in np.unique(counts):
+        lines = np.flatnonzero(counts == count)
+        starts = offsets[lines]
+        positions = starts[:, np.newaxis] + np.arange(count)
+        xy = coords[positions]
+        deltas = np.diff(xy, axis=1)
+        cumulative = np.cumsum(np.sqrt(deltas[..., 0]**2 + deltas[..., 1]**2),
+                               axis=1)
+
+        # The first coordinate past the projected distance (1-based: the
+        # segment lengths start at coordinate 1)
+        past = cumulative > distances[lines, np.newaxis]
+        found = past.any(axis=1)
+        j = np.argmax(past, axis=1) + 1
+
+        # Segment (j - 2, j - 1), where j - 2 = -1 wraps around to the last
+        # coordinate
+        seg_first = np.where(j >= 2, j - 2, count - 1)
+        seg_second = j - 1
+        # Otherwise, use the last segment
+        seg_first = np.where(found, seg_first, count - 2)
+        seg_second = np.where(found, seg_second, count - 1)
+
+        first[lines] = starts + seg_first
+        second[lines] = starts + seg_second
+
+    return first, second
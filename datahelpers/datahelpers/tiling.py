@@ -0,0 +1,492 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import inspect
+import multiprocessing
+import os
+import pickle
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from .geometry import boxes, query_bulk, to_wkb
+
+
+# The default width and height of tiles, in CRS units (meters, in UTM)
+TILE_SIZE = 2000.0
+
+# The column holding the position of each row of a primary layer in the
+# whole layer, added to the primary layer of every tile
+ROW = '_tile_row'
+
+# How worker processes are started: not by forking, which is unsafe from a
+# multi-threaded process like Snakemake. Forkserver isn't available on
+# Windows.
+START_METHOD = 'forkserver' \
+    if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# The hash of the datahelpers sources, see `code_fingerprint`
+_fingerprint = None
+
+
+class Tile:
+    '''A square of a grid over a primary layer: the rows of the primary layer
+    that the tile owns and, for every context layer, the rows of that layer
+    within a buffer of the owned rows. Rows are positions, not index labels,
+    and are in ascending order.
+
+    :param key: The (column, row) of the tile in the grid.
+    :type key: tuple of int
+    :param rows: The positions of the primary rows that the tile owns.
+    :type rows: numpy.ndarray
+    :param halo: The positions of the primary rows within the buffer of the
+                 owned rows (including the owned rows).
+    :type halo: numpy.ndarray
+    :param context_rows: For each context layer, the positions of the rows
+                         within the buffer of the owned rows.
+    :type context_rows: list of numpy.ndarray
+
+    '''
+    def __init__(self, key, rows, halo, context_rows):
+        self.key = key
+        self.rows = rows
+        self.halo = halo
+        self.context_rows = context_rows
+
+
+def make_tiles(primary, context=(), buffer=0.0, tile_size=TILE_SIZE,
+               halo=True):
+    '''Partition a layer into the squares of a grid aligned with the origin.
+    Each row is owned by the tile containing the center of its bounds, and
+    tiles are ordered row by row of the grid. Rows of the primary and context
+    layers whose bounds are within `buffer` of the bounds of an owned row are
+    included in a tile's halo and context, so tiles overlap by the buffer: it
+    should be at least the distance within which the operation run on the
+    tiles looks for neighbouring features. Rows with empty geometries are
+    owned by the first tile.
+
+    :param primary: The layer to partition.
+    :type primary: geopandas.GeoDataFrame
+    :param context: Other layers needed by the operation.
+    :type context: list of geopandas.GeoDataFrame
+    :param buffer: The overlap between tiles.
+    :type buffer: float
+    :param tile_size: The width and height of tiles.
+    :type tile_size: float
+    :param halo: Whether to find the primary rows in the overlap zones. If
+                 not, tiles' halos are just their owned rows.
+    :type halo: bool
+    :returns: list of Tile
+
+    '''
+    bounds = primary.geometry.bounds.values.astype(float).reshape(-1, 4)
+    n = bounds.shape[0]
+    if not n:
+        return []
+
+    empty = np.isnan(bounds).any(axis=1)
+    cx = (bounds[:, 0] + bounds[:, 2]) / 2
+    cy = (bounds[:, 1] + bounds[:, 3]) / 2
+    cells = np.zeros((n, 2), dtype=np.int64)
+    if not empty.all():
+        # The grid is fixed, rather than fitted to the data, so that tiles
+        # stay the same when features are edited (see TileStore)
+        cells[~empty, 0] = np.floor(cx[~empty] / tile_size)
+        cells[~empty, 1] = np.floor(cy[~empty] / tile_size)
+        if empty.any():
+            first = np.lexsort((cells[~empty, 0], cells[~empty, 1]))[0]
+            cells[empty] = cells[~empty][first]
+
+    # Number the tiles row by row
+    keys, tile_of = np.unique(cells[:, ::-1], axis=0, return_inverse=True)
+    tile_of = tile_of.reshape(-1)
+    n_tiles = keys.shape[0]
+    order = np.argsort(tile_of, kind='mergesort')
+    rows = np.split(order, np.searchsorted(tile_of[order],
+                                           np.arange(1, n_tiles)))
+
+    if halo:
+        halo = _within(bounds, tile_of, n_tiles, primary, buffer)
+    else:
+        halo = rows
+    context_rows = [_within(bounds, tile_of, n_tiles, layer, buffer)
+                    for layer in context]
+
+    return [
+        Tile((int(keys[i, 1]), int(keys[i, 0])), rows[i],
+             np.union1d(halo[i], rows[i]),
+             [layer_rows[i] for layer_rows in context_rows])
+        for i in range(n_tiles)
+    ]
+
+
+def _within(bounds, tile_of, n_tiles, layer, buffer):
+    # For every tile, the positions of the rows of a layer whose bounds
+    # intersect the buffered bounds of any row that the tile owns
+    empty = [np.empty(0, dtype=np.int64)] * n_tiles
+    valid = np.flatnonzero(~np.isnan(bounds).any(axis=1))
+    if not layer.shape[0] or not valid.size:
+        return empty
+
+    expanded = bounds[valid] + np.array([-buffer, -buffer, buffer, buffer])
+    query, hit = query_bulk(layer.sindex, gpd.GeoSeries(boxes(expanded)))
+    pairs = np.unique(tile_of[valid][query] * layer.shape[0] + hit)
+    tiles = pairs // layer.shape[0]
+    hits = pairs % layer.shape[0]
+
+    return np.split(hits, np.searchsorted(tiles, np.arange(1, n_tiles)))
+
+
+def map_tiles(func, primary, context=(), buffer=0.0, tile_size=TILE_SIZE,
+              halo=False, ignore_index=False, max_workers=None, progress=None,
+              store=None, **kwargs):
+    '''Run an operation on the spatial tiles of a layer on a process pool,
+    then stitch the results back together.
+
+    The operation is called as `func(primary_tile, context_tiles, **kwargs)`,
+    where `primary_tile` holds the rows of the primary layer that the tile
+    owns (plus its halo, if `halo` is set) with their positions in the whole
+    layer in a ROW column, and `context_tiles` is a list of the context
+    layers' rows near the tile. It must return a DataFrame that keeps the
+    ROW column of the primary rows each of its rows came from, as when
+    passing primary rows through with extra or split rows.
+
+    Results are stitched by keeping only the rows that came from owned
+    primary rows, which de-duplicates the rows computed for the overlap
+    zones, and sorting them by primary row (stably), so the result is the
+    same as running the operation on the whole layer at once, as long as
+    the operation only looks at features within `buffer` of each primary
+    row.
+
+    With a `store`, tiles whose inputs (the contents of their primary rows
+    and of the context rows near them) are unchanged since the last run are
+    not processed again: their results are read from the store.
+
+    :param func: The operation. Must be picklable, e.g. a module-level
+                 function.
+    :type func: callable
+    :param primary: The layer to partition.
+    :type primary: geopandas.GeoDataFrame
+    :param context: Other layers needed by the operation.
+    :type context: list of geopandas.GeoDataFrame
+    :param buffer: The overlap between tiles.
+    :type buffer: float
+    :param tile_size: The width and height of tiles.
+    :type tile_size: float
+    :param halo: Whether to also pass primary rows in the overlap zone.
+    :type halo: bool
+    :param ignore_index: Whether to renumber the rows of the result from 0,
+                         rather than keeping the index of the results.
+    :type ignore_index: bool
+    :param max_workers: The number of processes. Defaults to the number of
+                        CPUs. With 1, tiles are processed in this process.
+    :type max_workers: int
+    :param progress: If set, called with the number of tiles processed so far
+                     and the number of tiles to process after every tile.
+    :type progress: callable
+    :param store: The results of previous runs.
+    :type store: TileStore
+    :param kwargs: Passed on to `func`.
+    :returns: pandas.DataFrame (or geopandas.GeoDataFrame, if that's what
+              `func` returns)
+
+    '''
+    tiles = make_tiles(primary, context, buffer=buffer, tile_size=tile_size,
+                       halo=halo)
+    if not tiles:
+        result = func(_primary_tile(primary, np.empty(0, dtype=np.int64)),
+                      [layer.iloc[:0] for layer in context], **kwargs)
+        return result.drop(columns=[ROW])
+
+    results = [None] * len(tiles)
+    if store is not None:
+        params = parameters_hash(func, [primary] + list(context),
+                                 buffer=buffer, tile_size=tile_size,
+                                 halo=halo, kwargs=sorted(kwargs.items()))
+        primary_hashes = row_hashes(primary)
+        context_hashes = [row_hashes(layer) for layer in context]
+        hashes = [
+            inputs_hash(params, [primary_hashes[tile.rows],
+                                 primary_hashes[tile.halo] if halo else []] +
+                        [layer_hashes[rows] for layer_hashes, rows
+                         in zip(context_hashes, tile.context_rows)])
+            for tile in tiles
+        ]
+        results = store.load(tiles, hashes)
+
+    dirty = [i for i, result in enumerate(results) if result is None]
+    tasks = [
+        (func,
+         _primary_tile(primary, tiles[i].halo if halo else tiles[i].rows),
+         [layer.iloc[rows] for layer, rows in zip(context,
+                                                  tiles[i].context_rows)],
+         kwargs)
+        for i in dirty
+    ]
+    computed = run(_call, tasks, max_workers=max_workers, progress=progress)
+    for i, result in zip(dirty, computed):
+        results[i] = _owned(result, tiles[i])
+
+    if store is not None:
+        store.save(tiles, hashes, results, dirty)
+
+    return _splice(results, tiles, ignore_index=ignore_index)
+
+
+def _primary_tile(primary, rows):
+    tile = primary.iloc[rows].copy()
+    tile[ROW] = rows
+    return tile
+
+
+def _call(func, primary_tile, context_tiles, kwargs):
+    return func(primary_tile, context_tiles, **kwargs)
+
+
+def run(func, tasks, max_workers=None, progress=None):
+    '''Call a function with every one of a list of argument tuples on a
+    process pool, returning the results in the same order as the tasks.
+
+    :param func: The function. Must be picklable: worker processes are
+                 started fresh (see `START_METHOD`), not forked.
+    :type func: callable
+    :param tasks: The arguments of each call.
+    :type tasks: list of tuple
+    :param max_workers: The number of processes. Defaults to the number of
+                        CPUs. With 1, the calls are made in this process.
+    :type max_workers: int
+    :param progress: If set, called with the number of tasks done so far and
+                     the total number of tasks after every task.
+    :type progress: callable
+    :returns: list of results
+
+    '''
+    total = len(tasks)
+    results = []
+    for result in imap(func, tasks, max_workers=max_workers):
+        results.append(result)
+        if progress is not None:
+            progress(len(results), total)
+    return results
+
+
+def imap(func, tasks, max_workers=None):
+    '''Like `run`, but yield the results one at a time as they're done, in
+    the same order as the tasks.
+
+    :param func: The function. Must be picklable: worker processes are
+                 started fresh (see `START_METHOD`), not forked.
+    :type func: callable
+    :param tasks: The arguments of each call.
+    :type tasks: list of tuple
+    :param max_workers: The number of processes. Defaults to the number of
+                        CPUs. With 1, the calls are made in this process.
+    :type max_workers: int
+    :returns: generator of results
+
+    '''
+    if max_workers == 1 or len(tasks) < 2:
+        for task in tasks:
+            yield func(*task)
+        return
+
+    context = multiprocessing.get_context(START_METHOD)
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=context) as executor:
+        futures = [executor.submit(func, *task) for task in tasks]
+        for future in futures:
+            yield future.result()
+
+
+def stitch(results, tiles, ignore_index=False):
+    '''Stitch the results of an operation on tiles together: see
+    `map_tiles`.
+
+    :param results: The result of the operation for every tile, each with a
+                    ROW column.
+    :type results: list of pandas.DataFrame
+    :param tiles: The tiles.
+    :type tiles: list of Tile
+    :param ignore_index: Whether to renumber the rows of the result from 0.
+    :type ignore_index: bool
+    :returns: pandas.DataFrame (or geopandas.GeoDataFrame)
+
+    '''
+    owned = [_owned(result, tile) for result, tile in zip(results, tiles)]
+    return _splice(owned, tiles, ignore_index=ignore_index)
+
+
+def _owned(result, tile):
+    # The rows of a tile's result that came from the rows it owns, with ROW
+    # as positions in the tile's owned rows: a result that doesn't depend on
+    # where the tile's rows are in the whole layer, so it can be reused when
+    # other tiles change.
+    rows = result[ROW].values
+    local = np.minimum(np.searchsorted(tile.rows, rows),
+                       max(tile.rows.shape[0] - 1, 0))
+    owned = np.flatnonzero(tile.rows[local] == rows)
+    result = result.iloc[owned].copy()
+    result[ROW] = local[owned]
+    return result
+
+
+def _splice(owned, tiles, ignore_index=False):
+    # Put the owned results of tiles back in the order of the whole layer
+    kept = []
+    for result, tile in zip(owned, tiles):
+        result = result.copy()
+        result[ROW] = tile.rows[result[ROW].values]
+        kept.append(result)
+
+    stitched = pd.concat(kept)
+    order = np.argsort(stitched[ROW].values, kind='mergesort')
+    stitched = stitched.iloc[order].drop(columns=[ROW])
+    if isinstance(owned[0], gpd.GeoDataFrame):
+        stitched = gpd.GeoDataFrame(stitched, crs=owned[0].crs)
+    if ignore_index:
+        stitched = stitched.reset_index(drop=True)
+
+    return stitched
+
+
+class TileStore:
+    '''The per-tile results of a stage, kept on disk so that later runs of
+    the stage only process the tiles whose inputs changed (plus the tiles
+    whose overlap zones reach the changes), and splice them into the
+    results of the others.
+
+    Each tile's result (anything that pickles) is stored in a file named for
+    the tile and a hash of its inputs and of the stage's parameters (see
+    `inputs_hash`). A result is reused if the file for the tile's current
+    hash exists. Saving replaces the files of changed tiles and removes those
+    of tiles that no longer exist.
+
+    :param root: The directory to store results in.
+    :type root: str
+
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, tiles, hashes):
+        '''The stored results of tiles, None for tiles without a stored
+        result for their current inputs.
+
+        '''
+        results = []
+        for tile, digest in zip(tiles, hashes):
+            path = self._path(tile, digest)
+            if os.path.exists(path):
+                results.append(pd.read_pickle(path))
+                self.hits += 1
+            else:
+                results.append(None)
+                self.misses += 1
+        return results
+
+    def save(self, tiles, hashes, results, changed):
+        '''Store the results of the changed tiles (by position in `tiles`)
+        and remove results that are no longer current.
+
+        '''
+        os.makedirs(self.root, exist_ok=True)
+        for i in changed:
+            path = self._path(tiles[i], hashes[i])
+            fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+            os.close(fd)
+            pd.to_pickle(results[i], tmp)
+            os.replace(tmp, path)
+
+        current = {os.path.basename(self._path(tile, digest))
+                   for tile, digest in zip(tiles, hashes)}
+        for name in os.listdir(self.root):
+            if name.endswith('.pkl') and name not in current:
+                os.remove(os.path.join(self.root, name))
+
+    def _path(self, tile, digest):
+        return os.path.join(self.root, '{}_{}_{}.pkl'.format(
+            tile.key[0], tile.key[1], digest
+        ))
+
+
+def row_hashes(gdf):
+    '''A 64-bit hash of the contents (geometry and attributes, but not the
+    index) of every row of a layer.
+
+    :returns: numpy.ndarray of uint64
+
+    '''
+    frame = pd.DataFrame(gdf.drop(columns=['geometry']))
+    frame['geometry'] = to_wkb(gdf['geometry'].values)
+    return pd.util.hash_pandas_object(frame, index=False).values
+
+
+def parameters_hash(func, layers, **params):
+    '''A hash of an operation, its code (see `code_fingerprint`), its
+    parameters and the columns of its input layers, which decide what a
+    tile's result is, other than its inputs.
+
+    :returns: str
+
+    '''
+    schemas = [[(str(c), str(t)) for c, t in layer.dtypes.items()]
+               for layer in layers]
+    name = '{}.{}'.format(func.__module__, func.__qualname__)
+    data = pickle.dumps((name, code_fingerprint(func), schemas,
+                         sorted(params.items())), protocol=4)
+    return hashlib.sha256(data).hexdigest()
+
+
+def code_fingerprint(func=None):
+    '''A hash of the source of every datahelpers module and of the versions
+    of the libraries that geometry operations depend on, so that results
+    stored by a previous version of the code aren't reused. For a function
+    from outside of datahelpers, the source of its module is included too.
+
+    :param func: The operation.
+    :type func: callable
+    :returns: str
+
+    '''
+    global _fingerprint
+    if _fingerprint is None:
+        digest = hashlib.sha256()
+        package = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(package)):
+            if name.endswith('.py'):
+                digest.update(name.encode('utf-8'))
+                with open(os.path.join(package, name), 'rb') as f:
+                    digest.update(f.read())
+        versions = [np.__version__, pd.__version__, gpd.__version__,
+                    shapely.__version__]
+        digest.update(' '.join(versions).encode('utf-8'))
+        _fingerprint = digest.hexdigest()
+
+    module = inspect.getmodule(func) if func is not None else None
+    if module is None or module.__name__.split('.')[0] == __package__:
+        return _fingerprint
+    try:
+        source = inspect.getsource(module)
+    except (OSError, TypeError):
+        # e.g. defined interactively: the function's name has to do
+        return _fingerprint
+    return hashlib.sha256((_fingerprint + source).encode('utf-8')).hexdigest()
+
+
+def inputs_hash(params, row_hash_arrays):
+    '''A hash of the inputs of a tile: the hashes of the rows of each of its
+    layers, in order, and of the operation's parameters.
+
+    :returns: str
+
+    '''
+    digest = hashlib.sha256(params.encode('utf-8'))
+    for hashes in row_hash_arrays:
+        hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+        digest.update(np.uint64(hashes.shape[0]).tobytes())
+        digest.update(hashes.tobytes())
+    return digest.hexdigest()
@@ -1,10 +1,16 @@
+from .instrumentation import count, timed
+
+
 def lonlat_to_utm_epsg(lon, lat):
     utm_zone_epsg = 32700 - 100 * round((45 + lat) / 90.) + \
         round((183 + lon) / 6.)
     return int(utm_zone_epsg)
 
 
+@timed
 def gdf_to_utm(gdf):
+    count('utm.rows', gdf.shape[0])
+
     # Convert to wgs84 to get lon-lat info
     gdf_wgs84 = gdf.to_crs(4326)
 
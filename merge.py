@@ -1,8 +1,12 @@
+import argparse
 import json
 import os
 
+import numpy as np
 from shapely.geometry import MultiPoint, mapping
 
+import datahelpers as dh
+
 
 CITY_DATA = [{
     "name": "Seattle",
@@ -22,44 +26,137 @@ CITY_DATA = [{
 }]
 
 
-def merge_geojson(datasets):
-    merged = {"type": "FeatureCollection", "features": []}
+def merge_geojson(datasets, path, regions_path, index_path=None,
+                  chunksize=dh.io.CHUNKSIZE):
+    """Merge the transportation data of cities into one FeatureCollection,
+    streaming features from the inputs to the output a chunk at a time, and
+    write a FeatureCollection of the regions the cities cover.
+
+    The convex hull of each city is kept up to date from its running hull
+    and the coordinates of each chunk, so no city's coordinates are ever all
+    in memory.
+
+    :param datasets: City metadata, as in CITY_DATA.
+    :type datasets: list of dict
+    :param path: The path of the merged transportation data.
+    :type path: str
+    :param regions_path: The path of the regions.
+    :type regions_path: str
+    :param index_path: If set, the path of a packed R-tree of the bounds of
+                       the merged features and their byte ranges in the
+                       merged file (see datahelpers.spatial_index).
+    :type index_path: str
+    :param chunksize: The number of features read at a time.
+    :type chunksize: int
+
+    """
     datasets_metadata = {"type": "FeatureCollection", "features": []}
-    for dataset in datasets:
-        with open(dataset["transportation_data"]) as f:
-            fc = json.load(f)
+    boxes = []
+    ranges = []
+
+    with open(path, "w") as f:
+        # The output is byte-for-byte identical to json.dump-ing the whole
+        # FeatureCollection at once. Features are ASCII (json.dumps escapes
+        # everything else), so their byte ranges are their string lengths.
+        header = '{"type": "FeatureCollection", "features": ['
+        f.write(header)
+        position = len(header)
+        first = True
 
-        points = []
-        for feature in fc["features"]:
-            merged["features"].append(feature)
-            points += feature["geometry"]["coordinates"]
+        for dataset in datasets:
+            hull_points = np.empty((0, 2))
+            for features in dh.io.iter_features(dataset["transportation_data"],
+                                                chunksize=chunksize):
+                serialized = [json.dumps(feature) for feature in features]
+                if not first:
+                    f.write(", ")
+                    position += 2
+                f.write(", ".join(serialized))
+                first = False
 
-        points = MultiPoint(points)
-        hull = points.convex_hull
+                lengths = np.array([len(s) for s in serialized])
+                offsets = position + np.cumsum(lengths + 2) - lengths - 2
+                position = offsets[-1] + lengths[-1]
 
-        bounds = list(hull.bounds);
+                xy, starts = dh.io.feature_positions(features)
+                hull_points = _hull_points(np.vstack([hull_points, xy]))
 
-        datasets_metadata["features"].append({
-            "type": "Feature",
-            "geometry": mapping(hull),
-            "properties": {
-                "bounds": bounds,
-                "key": dataset["key"],
-                "name": dataset["name"],
-                "lon": dataset["center"][0],
-                "lat": dataset["center"][1],
-                "zoom": dataset["center"][2],
-            }
-        })
+                if index_path is not None:
+                    ranges.append(np.column_stack([offsets, lengths]))
+                    boxes.append(_feature_bounds(xy, starts))
 
-    return merged, datasets_metadata
+            hull = MultiPoint(hull_points.tolist()).convex_hull
+
+            bounds = list(hull.bounds)
+
+            datasets_metadata["features"].append({
+                "type": "Feature",
+                "geometry": mapping(hull),
+                "properties": {
+                    "bounds": bounds,
+                    "key": dataset["key"],
+                    "name": dataset["name"],
+                    "lon": dataset["center"][0],
+                    "lat": dataset["center"][1],
+                    "zoom": dataset["center"][2],
+                }
+            })
+
+        f.write("]}")
+
+    with open(regions_path, "w") as f:
+        json.dump(datasets_metadata, f)
+
+    if index_path is not None:
+        tree = dh.spatial_index.PackedRTree.build(
+            np.vstack(boxes) if boxes else np.empty((0, 4)),
+            ranges=np.vstack(ranges) if ranges else np.empty((0, 2)),
+        )
+        tree.save(index_path)
+
+
+def _hull_points(xy):
+    # The vertices of the convex hull of some points: the only points needed
+    # to compute the hull of these points plus any others.
+    if xy.shape[0] < 3:
+        return xy
+    hull = MultiPoint(xy.tolist()).convex_hull
+    if hull.geom_type == "Polygon":
+        return np.array(hull.exterior.coords)[:-1]
+    return np.array(hull.coords)
+
+
+def _feature_bounds(xy, starts):
+    # The (minx, miny, maxx, maxy) bounds of every feature. Features without
+    # positions get NaN bounds, which no search matches.
+    boxes = np.full((starts.size - 1, 4), np.nan)
+    nonempty = starts[1:] > starts[:-1]
+    if nonempty.any():
+        groups = starts[:-1][nonempty]
+        boxes[nonempty, :2] = np.minimum.reduceat(xy, groups)
+        boxes[nonempty, 2:] = np.maximum.reduceat(xy, groups)
+    return boxes
 
 
 if __name__ == "__main__":
-    merged, datasets_metadata = merge_geojson(CITY_DATA)
+    parser = argparse.ArgumentParser(
+        description="Merge the transportation data of all cities."
+    )
+    parser.add_argument("--index", action="store_true",
+                        help="Also write a spatial index of the merged "
+                             "features, for bounding box reads.")
+    parser.add_argument("--graph", action="store_true",
+                        help="Also write a routable graph of the merged "
+                             "features.")
+    args = parser.parse_args()
+
     if not os.path.exists("./merged"):
         os.mkdir("./merged")
-    with open("./merged/transportation.geojson", "w") as f:
-        json.dump(merged, f)
-    with open("./merged/regions.geojson", "w") as f:
-        json.dump(datasets_metadata, f)
+    index_path = None
+    if args.index:
+        index_path = "./merged/transportation.geojson.rtree"
+    merge_geojson(CITY_DATA, "./merged/transportation.geojson",
+                  "./merged/regions.geojson", index_path=index_path)
+    if args.graph:
+        dh.graph.export_graph("./merged/transportation.geojson",
+                              "./merged/transportation.graph")